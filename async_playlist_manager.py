@@ -0,0 +1,158 @@
+"""
+AsyncPlaylistManager - Awaitable PlaylistManager calls for the Discord event loop
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from models import Playlist, PlaylistSummary, SearchResult, Track
+from playlist_manager import PlaylistManager
+from guild_playback import GuildPlayback, PlaybackState
+from smart_playlist import SmartRule
+
+logger = logging.getLogger(__name__)
+
+class AsyncPlaylistManager:
+    """Runs PlaylistManager (and so all SQLite work) on one dedicated thread
+
+    Calls are queued on a single-worker executor, so database access is
+    serialized on the DB thread while the event loop keeps servicing voice
+    packets and gateway heartbeats.
+    """
+
+    def __init__(self, playlist_manager: PlaylistManager):
+        self.manager = playlist_manager
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='beathoven-db')
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking callable on the DB thread and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the DB thread once queued calls have finished"""
+        self._executor.shutdown(wait=wait)
+
+    async def playback(self, guild_id: int = 0) -> GuildPlayback:
+        """A guild's player state"""
+        return await self.run(self.manager.playback, guild_id)
+
+    async def snapshot(self, guild_id: int = 0) -> PlaybackState:
+        """A guild's latest consistent PlaybackState"""
+        return await self.run(self.manager.snapshot, guild_id)
+
+    async def enqueue(self, track: Track, guild_id: int = 0, front: bool = False) -> Optional[int]:
+        """Queue a track, returning its queue position or None if the queue is full"""
+        return await self.run(self.manager.enqueue, track, guild_id, front)
+
+    async def get_queue(self, guild_id: int = 0, offset: int = 0, limit: int = 10) -> List[Track]:
+        """One page of a guild's queue"""
+        return await self.run(self.manager.get_queue, guild_id, offset, limit)
+
+    async def queue_length(self, guild_id: int = 0) -> int:
+        """Number of tracks in a guild's queue"""
+        return await self.run(self.manager.queue_length, guild_id)
+
+    async def remove_from_queue(self, index: int, guild_id: int = 0) -> Optional[Track]:
+        """Take a track out of a guild's queue"""
+        return await self.run(self.manager.remove_from_queue, index, guild_id)
+
+    async def clear_queue(self, guild_id: int = 0) -> int:
+        """Empty a guild's queue"""
+        return await self.run(self.manager.clear_queue, guild_id)
+
+    async def get_all_playlists(self, guild_id: int = 0) -> List[Playlist]:
+        """Get all of a guild's own playlists"""
+        return await self.run(self.manager.get_all_playlists, guild_id)
+
+    async def get_playlist_summaries(self, guild_id: int = 0) -> List[PlaylistSummary]:
+        """Get track counts and durations of the playlists a guild sees"""
+        return await self.run(self.manager.get_playlist_summaries, guild_id)
+
+    async def get_playlist(self, name: str, guild_id: int = 0) -> Optional[Playlist]:
+        """Get a playlist by name"""
+        return await self.run(self.manager.get_playlist, name, guild_id)
+
+    async def get_tracks(self, name: str, offset: int = 0, limit: int = 100, guild_id: int = 0) -> List[Track]:
+        """Get one page of a playlist's tracks"""
+        return await self.run(self.manager.get_tracks, name, offset, limit, guild_id)
+
+    async def get_track_count(self, name: str, guild_id: int = 0) -> Optional[int]:
+        """Number of tracks in a playlist, or None if it does not exist"""
+        return await self.run(self.manager.get_track_count, name, guild_id)
+
+    async def search_tracks(self, query: str, limit: int = 20, guild_id: Optional[int] = None) -> List[SearchResult]:
+        """Search the track library by title/artist prefix"""
+        return await self.run(self.manager.search_tracks, query, limit, guild_id)
+
+    async def create_playlist(self, name: str, tracks: List[Track] = None,
+                              playlist_type: str = "local", description: str = "",
+                              guild_id: int = 0) -> Optional[Playlist]:
+        """Create a new playlist"""
+        return await self.run(self.manager.create_playlist, name, tracks, playlist_type, description, guild_id)
+
+    async def create_smart_playlist(self, name: str, rule: SmartRule, description: str = "",
+                                    guild_id: int = 0) -> Optional[Playlist]:
+        """Create a smart playlist from a rule"""
+        return await self.run(self.manager.create_smart_playlist, name, rule, description, guild_id)
+
+    async def delete_playlist(self, name: str, guild_id: int = 0) -> bool:
+        """Delete a playlist"""
+        return await self.run(self.manager.delete_playlist, name, guild_id)
+
+    async def add_track(self, playlist_name: str, track: Track, guild_id: int = 0) -> bool:
+        """Add track to playlist"""
+        return await self.run(self.manager.add_track, playlist_name, track, guild_id)
+
+    async def remove_track(self, playlist_name: str, index: int, guild_id: int = 0) -> bool:
+        """Remove track from playlist"""
+        return await self.run(self.manager.remove_track, playlist_name, index, guild_id)
+
+    async def move_track(self, playlist_name: str, old_index: int, new_index: int, guild_id: int = 0) -> bool:
+        """Move track within playlist"""
+        return await self.run(self.manager.move_track, playlist_name, old_index, new_index, guild_id)
+
+    async def set_current_playlist(self, name: str, guild_id: int = 0) -> bool:
+        """Set a guild's current playlist"""
+        return await self.run(self.manager.set_current_playlist, name, guild_id)
+
+    async def get_current_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Get a guild's current track"""
+        return await self.run(self.manager.get_current_track, guild_id)
+
+    async def set_track_index(self, index: int, guild_id: int = 0) -> Optional[Track]:
+        """Set a guild's current track index"""
+        return await self.run(self.manager.set_track_index, index, guild_id)
+
+    async def set_playing(self, playing: bool, guild_id: int = 0) -> None:
+        """Set a guild's playing state"""
+        await self.run(self.manager.set_playing, playing, guild_id)
+
+    async def set_paused(self, paused: bool, guild_id: int = 0) -> None:
+        """Set a guild's paused state"""
+        await self.run(self.manager.set_paused, paused, guild_id)
+
+    async def set_volume(self, volume: int, guild_id: int = 0) -> None:
+        """Set a guild's volume (0-100)"""
+        await self.run(self.manager.set_volume, volume, guild_id)
+
+    async def set_repeat_mode(self, mode: str, guild_id: int = 0) -> None:
+        """Set a guild's repeat mode (none, one, all)"""
+        await self.run(self.manager.set_repeat_mode, mode, guild_id)
+
+    async def set_shuffle(self, mode: str, guild_id: int = 0) -> bool:
+        """Set a guild's shuffle mode (off, on, weighted)"""
+        return await self.run(self.manager.set_shuffle, mode, guild_id)
+
+    async def next_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Advance a guild to and return its next track"""
+        return await self.run(self.manager.next_track, guild_id)
+
+    async def peek_next(self, n: int = 1, guild_id: int = 0) -> List[Track]:
+        """The tracks a guild's next n next_track() calls would return, without advancing"""
+        return await self.run(self.manager.peek_next, n, guild_id)
+
+    async def previous_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Send a guild back to and return its previous track"""
+        return await self.run(self.manager.previous_track, guild_id)
@@ -0,0 +1,274 @@
+"""Online backups of the Beathoven database
+
+Snapshots are taken with the SQLite backup API while the bot keeps running,
+gzip-compressed into timestamped files and pruned to BACKUP_RETENTION copies:
+
+    python backup.py backup
+    python backup.py list
+    python backup.py restore backups/beathoven-20240101-030000.db.gz
+    python backup.py restore --guild 1234 backups/shards/guild-1234/beathoven-20240101-030000.db.gz
+
+Backups also cover the shard of every guild in BEATHOVEN_SHARDED_GUILDS,
+each in its own folder under shards/ in the backup directory. Restore
+replaces the live database file, so stop the bot and web UI first.
+"""
+import os
+import sys
+import glob
+import gzip
+import shutil
+import sqlite3
+import logging
+import argparse
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+import dotenv
+from database import Database, SHARDED_GUILDS
+
+dotenv.load_dotenv(os.path.join(os.getcwd(), '.env'), override=True)
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv('BACKUP_DIR')  # default: backups/ next to the database
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', 24))  # 0 disables scheduled backups
+BACKUP_RETENTION = int(os.getenv('BACKUP_RETENTION', 7))
+
+# Pages copied per backup step, and the pause between steps that lets
+# other connections take the write lock. 256 pages is 1 MB at the default
+# 4 KB page size.
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+
+SNAPSHOT_PREFIX = 'beathoven-'
+SNAPSHOT_SUFFIX = '.db.gz'
+
+def _default_db_path() -> str:
+    db_path = os.getenv('BEATHOVEN_DB')
+    if not db_path:
+        raise ValueError("BEATHOVEN_DB environment variable not set")
+    return db_path
+
+def _backup_dir(db_path: str, backup_dir: Optional[str] = None) -> str:
+    return backup_dir or BACKUP_DIR or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'backups')
+
+def _shard_backup_dir(shard_path: str, db_path: str, backup_dir: Optional[str] = None) -> str:
+    name = os.path.splitext(os.path.basename(shard_path))[0]
+    return os.path.join(_backup_dir(db_path, backup_dir), 'shards', name)
+
+def shard_paths(db_path: Optional[str] = None) -> List[str]:
+    """Database files of sharded guilds (those never opened have no file yet)"""
+    db_path = db_path or _default_db_path()
+    paths = (Database.shard_path(guild_id, db_path) for guild_id in sorted(SHARDED_GUILDS))
+    return [path for path in paths if os.path.exists(path)]
+
+def list_snapshots(db_path: Optional[str] = None, backup_dir: Optional[str] = None) -> List[str]:
+    """Snapshot paths, oldest first"""
+    directory = _backup_dir(db_path or _default_db_path(), backup_dir)
+    return sorted(glob.glob(os.path.join(directory, f'{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}')))
+
+def backup_database(db_path: Optional[str] = None, backup_dir: Optional[str] = None,
+                    retention: int = BACKUP_RETENTION,
+                    pages: int = BACKUP_PAGES_PER_STEP, step_sleep: float = BACKUP_STEP_SLEEP) -> dict:
+    """Write a compressed snapshot of the live database and prune old ones.
+
+    The copy runs inside one read transaction on the source, so it sees a
+    consistent snapshot and never restarts however often the bot commits;
+    under WAL that read transaction does not block writers.
+    """
+    db_path = db_path or _default_db_path()
+    directory = _backup_dir(db_path, backup_dir)
+    os.makedirs(directory, exist_ok=True)
+
+    # Microseconds keep back-to-back snapshots apart and sorting by name
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    snapshot = os.path.join(directory, f'{SNAPSHOT_PREFIX}{stamp}{SNAPSHOT_SUFFIX}')
+    raw_path = snapshot[:-len('.gz')] + '.tmp'
+
+    start = time.perf_counter()
+    src = sqlite3.connect(db_path, timeout=5.0)
+    dst = sqlite3.connect(raw_path)
+    try:
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+        def progress(status, remaining, total):
+            # Give the bot's writers a window between batches
+            time.sleep(step_sleep)
+
+        src.backup(dst, pages=pages, progress=progress)
+        src.rollback()
+        page_count = dst.execute('PRAGMA page_count').fetchone()[0]
+    except BaseException:
+        dst.close()
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        raise
+    finally:
+        src.close()
+    dst.close()
+    copy_seconds = time.perf_counter() - start
+
+    try:
+        with open(raw_path, 'rb') as raw, gzip.open(snapshot + '.part', 'wb', compresslevel=6) as packed:
+            shutil.copyfileobj(raw, packed, 1 << 20)
+        os.replace(snapshot + '.part', snapshot)
+        raw_bytes = os.path.getsize(raw_path)
+    finally:
+        os.remove(raw_path)
+        if os.path.exists(snapshot + '.part'):
+            os.remove(snapshot + '.part')
+    seconds = time.perf_counter() - start
+
+    removed = []
+    if retention > 0:
+        snapshots = list_snapshots(db_path, directory)
+        for old in snapshots[:-retention]:
+            os.remove(old)
+            removed.append(old)
+
+    stats = {
+        'path': snapshot,
+        'pages': page_count,
+        'bytes': raw_bytes,
+        'compressed_bytes': os.path.getsize(snapshot),
+        'copy_seconds': copy_seconds,
+        'seconds': seconds,
+        'removed': removed
+    }
+    logger.info(f"Backed up {raw_bytes / 1e6:.1f} MB to {snapshot} "
+                f"({stats['compressed_bytes'] / 1e6:.1f} MB compressed) in {seconds:.2f}s "
+                f"(copy {copy_seconds:.2f}s, {raw_bytes / 1e6 / max(copy_seconds, 1e-9):.0f} MB/s); "
+                f"pruned {len(removed)} old snapshot(s)")
+    return stats
+
+def backup_all(db_path: Optional[str] = None, backup_dir: Optional[str] = None, **kwargs) -> List[dict]:
+    """Back up the main database and then every guild shard (see backup_database)
+
+    A failed shard is logged and skipped so the others are still backed
+    up; the error is raised once all have been tried.
+    """
+    db_path = db_path or _default_db_path()
+    results = [backup_database(db_path, backup_dir, **kwargs)]
+    failed = None
+    for shard in shard_paths(db_path):
+        try:
+            results.append(backup_database(shard, _shard_backup_dir(shard, db_path, backup_dir), **kwargs))
+        except Exception as e:
+            logger.error(f"Backup of shard {shard} failed: {e}")
+            failed = e
+    if failed is not None:
+        raise failed
+    return results
+
+def restore_database(snapshot: str, db_path: Optional[str] = None, quick: bool = False) -> dict:
+    """Replace the database with a snapshot after checking its integrity.
+
+    The snapshot is unpacked next to the database and only swapped in with
+    an atomic rename once PRAGMA integrity_check (or quick_check) passes,
+    so a bad snapshot never touches the live file. Stop the bot first.
+    """
+    db_path = db_path or _default_db_path()
+    restore_path = db_path + '.restore'
+
+    start = time.perf_counter()
+    try:
+        with gzip.open(snapshot, 'rb') as packed, open(restore_path, 'wb') as raw:
+            shutil.copyfileobj(packed, raw, 1 << 20)
+        unpack_seconds = time.perf_counter() - start
+
+        check_start = time.perf_counter()
+        conn = sqlite3.connect(restore_path)
+        try:
+            rows = conn.execute('PRAGMA quick_check' if quick else 'PRAGMA integrity_check').fetchall()
+        finally:
+            conn.close()
+        check_seconds = time.perf_counter() - check_start
+        if rows != [('ok',)]:
+            problems = '; '.join(row[0] for row in rows[:5])
+            raise ValueError(f"Snapshot {snapshot} failed integrity check: {problems}")
+
+        # A WAL left over from the old file would be replayed onto the new one
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        os.replace(restore_path, db_path)
+    finally:
+        if os.path.exists(restore_path):
+            os.remove(restore_path)
+    seconds = time.perf_counter() - start
+
+    stats = {
+        'path': db_path,
+        'bytes': os.path.getsize(db_path),
+        'unpack_seconds': unpack_seconds,
+        'check_seconds': check_seconds,
+        'seconds': seconds
+    }
+    logger.info(f"Restored {stats['bytes'] / 1e6:.1f} MB from {snapshot} in {seconds:.2f}s "
+                f"(unpack {unpack_seconds:.2f}s, integrity check {check_seconds:.2f}s)")
+    return stats
+
+class BackupScheduler:
+    """Daemon thread backing up the main database and its shards every BACKUP_INTERVAL_HOURS"""
+
+    def __init__(self, db_path: Optional[str] = None, interval_hours: float = BACKUP_INTERVAL_HOURS):
+        self.db_path = db_path or _default_db_path()
+        self.interval = interval_hours * 3600
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='db-backup', daemon=True)
+        self._thread.start()
+        logger.info(f"Scheduled database backups every {self.interval / 3600:g}h")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                backup_all(self.db_path)
+            except Exception as e:
+                logger.error(f"Scheduled backup failed: {e}", exc_info=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('backup', help='write a compressed snapshot now')
+    sub.add_parser('list', help='list snapshots, oldest first')
+    restore = sub.add_parser('restore', help='replace the database with a snapshot')
+    restore.add_argument('snapshot')
+    restore.add_argument('--guild', type=int, help='restore this sharded guild\'s database instead of the main one')
+    restore.add_argument('--quick', action='store_true', help='use quick_check instead of integrity_check')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        db_path = _default_db_path()
+        if args.command == 'backup':
+            backup_all(db_path)
+        elif args.command == 'list':
+            snapshots = list_snapshots(db_path)
+            for shard in shard_paths(db_path):
+                snapshots += list_snapshots(shard, _shard_backup_dir(shard, db_path))
+            for snapshot in snapshots:
+                print(f"{snapshot}  {os.path.getsize(snapshot) / 1e6:8.1f} MB")
+        elif args.guild is not None:
+            restore_database(args.snapshot, Database.shard_path(args.guild, db_path), quick=args.quick)
+        else:
+            restore_database(args.snapshot, db_path, quick=args.quick)
+    except Exception as e:
+        logger.error(f"{args.command.capitalize()} failed: {e}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
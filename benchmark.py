@@ -0,0 +1,362 @@
+"""Micro-benchmarks for the Beathoven database layer
+
+Run one benchmark at a time against a throwaway database:
+
+    python benchmark.py connections
+    python benchmark.py reorder --tracks 10000
+    python benchmark.py import --tracks 100000
+    python benchmark.py search --tracks 200000 --ops 50
+    python benchmark.py backup --tracks 1000000
+    python benchmark.py memory --tracks 100000
+    python benchmark.py codec --tracks 10000
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+def _fresh_database(tmp_dir: str):
+    """Create a Database singleton backed by a new file in tmp_dir"""
+    os.environ['BEATHOVEN_DB'] = os.path.join(tmp_dir, 'bench.db')
+    from database import Database
+    Database._instance = None
+    return Database()
+
+def _make_tracks(count: int, prefix: str = 'track'):
+    """Build count distinct local tracks"""
+    from models import Track
+    return [
+        Track(title=f"{prefix} {i}", url=f"/music/{prefix}_{i}.mp3", type='local', duration=180 + i % 120)
+        for i in range(count)
+    ]
+
+def _report(label: str, ops: int, elapsed: float):
+    print(f"{label:<28} {ops:>8} ops  {elapsed:8.3f}s  {ops / elapsed:12,.0f} ops/sec")
+
+def bench_connections(args):
+    """Compare connect-per-call against the pooled WAL connections"""
+    from models import Playlist
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+        tracks = _make_tracks(args.tracks)
+        db.add_playlist(Playlist(name='bench', tracks=tracks))
+
+        def legacy_update_track_play(url, track_type):
+            # Pre-pool behaviour: new connection and rollback journal per call
+            with sqlite3.connect(db.db_path) as conn:
+                conn.execute('''
+                    UPDATE tracks
+                    SET play_count = play_count + 1, last_played_at = ?
+                    WHERE url = ? AND type = ?
+                ''', (datetime.now(), url, track_type))
+                conn.commit()
+
+        def legacy_get_track_count(name):
+            with sqlite3.connect(db.db_path) as conn:
+                return conn.execute('''
+                    SELECT COUNT(*) FROM playlist_tracks pt
+                    JOIN playlists p ON p.id = pt.playlist_id WHERE p.name = ?
+                ''', (name,)).fetchone()[0]
+
+        def pooled_get_track_count(name):
+            with db._connection() as conn:
+                return conn.execute('''
+                    SELECT COUNT(*) FROM playlist_tracks pt
+                    JOIN playlists p ON p.id = pt.playlist_id WHERE p.name = ?
+                ''', (name,)).fetchone()[0]
+
+        # The legacy path must run against a rollback-journal database to be
+        # a fair "before" measurement, so it goes first on its own file
+        db.close()
+        conn = sqlite3.connect(db.db_path)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+
+        start = time.perf_counter()
+        for i in range(args.ops):
+            legacy_get_track_count('bench')
+        _report('connect-per-call reads', args.ops, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(args.ops):
+            track = tracks[i % len(tracks)]
+            legacy_update_track_play(track.url, track.type)
+        _report('connect-per-call writes', args.ops, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(args.ops):
+            pooled_get_track_count('bench')
+        _report('pooled WAL reads', args.ops, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(args.ops):
+            track = tracks[i % len(tracks)]
+            db.update_track_play(track.url, track.type)
+        _report('pooled WAL writes', args.ops, time.perf_counter() - start)
+
+        db.close()
+
+def bench_reorder(args):
+    """Drag-and-drop reorders: full playlist rewrite vs single-row gap moves"""
+    import random
+    from models import Playlist
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+        db.add_playlist(Playlist(name='bench', tracks=_make_tracks(args.tracks)))
+        rng = random.Random(42)
+
+        # Before: load, reorder in memory, rewrite every junction row
+        legacy_ops = max(1, args.ops // 100)
+        start = time.perf_counter()
+        for _ in range(legacy_ops):
+            playlist = db.get_playlist('bench')
+            playlist.move_track(rng.randrange(args.tracks), rng.randrange(args.tracks))
+            db.update_playlist(playlist)
+        _report('update_playlist rewrite', legacy_ops, time.perf_counter() - start)
+
+        # After: one position update per move
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            db.move_track('bench', rng.randrange(args.tracks), rng.randrange(args.tracks))
+        _report('move_track (gap positions)', args.ops, time.perf_counter() - start)
+
+        # Worst case for gaps: keep dropping onto the same slot
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            db.move_track('bench', args.tracks - 1, 1)
+        _report('move_track same slot', args.ops, time.perf_counter() - start)
+
+        db.close()
+
+def bench_import(args):
+    """Bulk import through a staged temp table vs per-track add_playlist"""
+    from models import Playlist
+
+    per_playlist = max(1, args.tracks // args.playlists)
+
+    def build(prefix):
+        return [
+            Playlist(name=f"{prefix} {p}", tracks=_make_tracks(per_playlist, prefix=f"{prefix}{p}"))
+            for p in range(args.playlists)
+        ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+
+        playlists = build('legacy')
+        start = time.perf_counter()
+        for playlist in playlists:
+            db.add_playlist(playlist)
+        _report('add_playlist per track', per_playlist * args.playlists, time.perf_counter() - start)
+
+        playlists = build('bulk')
+        stats = db.bulk_import_playlists(playlists)
+        _report('bulk_import_playlists', stats['tracks'], stats['seconds'])
+
+        # Re-importing the same library exercises the upsert path
+        stats = db.bulk_import_playlists(playlists)
+        _report('bulk re-import (upserts)', stats['tracks'], stats['seconds'])
+
+        db.close()
+
+def bench_search(args):
+    """Ranked prefix search latency over a large library"""
+    import random
+    from models import Track, Playlist
+
+    words = ['love', 'night', 'dance', 'blue', 'heart', 'fire', 'dream', 'rain', 'summer', 'city',
+             'moon', 'river', 'gold', 'wild', 'star', 'road', 'home', 'light', 'storm', 'ocean']
+    rng = random.Random(7)
+    tracks = [
+        Track(title=' '.join(rng.sample(words, 3)) + f" {i}", url=f"/music/{i}.mp3", type='local',
+              artist=f"Artist {i % 5000}")
+        for i in range(args.tracks)
+    ]
+    queries = ['lov', 'night dan', 'artist 42', 'storm ocean li', 'zzz', 'b', str(args.tracks // 2)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+        stats = db.bulk_import_playlists([
+            Playlist(name=f"list {p}", tracks=tracks[p::args.playlists]) for p in range(args.playlists)
+        ])
+        _report('import with FTS triggers', stats['tracks'], stats['seconds'])
+
+        for query in queries:
+            start = time.perf_counter()
+            for _ in range(args.ops):
+                results = db.search_tracks(query)
+            elapsed = time.perf_counter() - start
+            print(f"search {query!r:<18} {len(results):>3} hits  {elapsed / args.ops * 1000:8.3f} ms/query")
+
+        db.close()
+
+def bench_backup(args):
+    """Online backup and restore timings, and write latency while backing up"""
+    import threading
+    from models import Playlist
+    from backup import backup_database, restore_database
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+        tracks = _make_tracks(args.tracks)
+        db.bulk_import_playlists([
+            Playlist(name=f"list {p}", tracks=tracks[p::args.playlists]) for p in range(args.playlists)
+        ])
+        print(f"database size {os.path.getsize(db.db_path) / 1e6:.1f} MB")
+
+        # Keep committing plays while the snapshot is copied
+        latencies = []
+        stop = threading.Event()
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                track = tracks[i % len(tracks)]
+                start = time.perf_counter()
+                db.update_track_play(track.url, track.type)
+                latencies.append(time.perf_counter() - start)
+                i += 1
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        stats = backup_database(db.db_path, os.path.join(tmp_dir, 'backups'))
+        stop.set()
+        thread.join()
+        print(f"backup    {stats['bytes'] / 1e6:8.1f} MB  {stats['seconds']:8.3f}s  "
+              f"(copy {stats['copy_seconds']:.3f}s, {stats['compressed_bytes'] / 1e6:.1f} MB compressed)")
+        print(f"writes during backup {len(latencies):>6}  max latency {max(latencies) * 1000:8.3f} ms")
+
+        db.close()
+        stats = restore_database(stats['path'], db.db_path)
+        print(f"restore   {stats['bytes'] / 1e6:8.1f} MB  {stats['seconds']:8.3f}s  "
+              f"(unpack {stats['unpack_seconds']:.3f}s, check {stats['check_seconds']:.3f}s)")
+
+def bench_memory(args):
+    """Bytes per track in memory: the old dataclass, the slotted Track and PlaylistColumns"""
+    import tracemalloc
+    from dataclasses import dataclass, field
+    from typing import Optional
+    from models import Playlist, PlaylistColumns
+    from database import _parse_timestamp, _row_to_track
+
+    @dataclass
+    class LegacyTrack:
+        """models.Track before it had __slots__"""
+        title: str
+        url: str
+        duration: Optional[int] = None
+        type: str = "youtube"
+        added_at: datetime = field(default_factory=datetime.now)
+        artist: Optional[str] = None
+        thumbnail_url: Optional[str] = None
+
+    def legacy_row_to_track(row):
+        url, title, artist, duration, ttype, added, thumb = row
+        return LegacyTrack(url=url, title=title, artist=artist, duration=duration, type=ttype,
+                           added_at=_parse_timestamp(added), thumbnail_url=thumb)
+
+    def measure(label, load):
+        # Built straight from the cursor, so the strings each track keeps are counted
+        tracemalloc.start()
+        loaded = load()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{label:<28} {args.tracks:>8} tracks  {size / 1e6:8.1f} MB  {size / args.tracks:8.0f} bytes/track")
+        return loaded
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = _fresh_database(tmp_dir)
+        tracks = _make_tracks(args.tracks)
+        for i, track in enumerate(tracks):
+            track.artist = f"Artist {i % 500}"
+        db.bulk_import_playlists([
+            Playlist(name=f"list {p}", tracks=tracks[p::args.playlists]) for p in range(args.playlists)
+        ])
+        del tracks
+
+        def load_rows(row_to_track):
+            with db._connection() as conn:
+                return [row_to_track(row) for row in conn.execute('''
+                    SELECT url, title, artist, duration, type, added_at, thumbnail_url FROM tracks
+                ''')]
+
+        legacy = measure('dataclass Track', lambda: load_rows(legacy_row_to_track))
+        del legacy
+        slotted = measure('slotted Track', lambda: load_rows(_row_to_track))
+        del slotted
+        measure('get_all_playlists()', db.get_all_playlists)
+
+        def load_columns():
+            with db._connection() as conn:
+                return PlaylistColumns.from_rows(conn.execute(
+                    'SELECT CAST(title AS BLOB), CAST(url AS BLOB), duration, type, play_count FROM tracks'))
+        measure('PlaylistColumns', load_columns)
+
+        db.close()
+
+def bench_codec(args):
+    """Playlist JSON encode/decode: to_dict + json against codec (orjson and stdlib)"""
+    import json
+    import codec
+    from models import Playlist
+
+    playlist = Playlist(name='bench', tracks=_make_tracks(args.tracks))
+    ops = max(1, args.ops // 100)
+
+    def run(label, encode, decode):
+        start = time.perf_counter()
+        for _ in range(ops):
+            body = encode()
+        elapsed = time.perf_counter() - start
+        print(f"{label + ' encode':<28} {ops:>8} ops  {elapsed:8.3f}s  {ops / elapsed:8.1f} playlists/sec  "
+              f"{len(body) * ops / elapsed / 1e6:8.1f} MB/s")
+        start = time.perf_counter()
+        for _ in range(ops):
+            decoded = decode(body)
+        elapsed = time.perf_counter() - start
+        print(f"{label + ' decode':<28} {ops:>8} ops  {elapsed:8.3f}s  {ops / elapsed:8.1f} playlists/sec")
+        assert len(decoded.tracks) == args.tracks
+
+    run('to_dict + json', lambda: json.dumps(playlist.to_dict()).encode(),
+        lambda body: Playlist.from_dict(json.loads(body)))
+    fast = codec.orjson
+    if fast is not None:
+        run('codec (orjson)', lambda: codec.encode_playlist(playlist), codec.decode_playlist)
+    codec.orjson = None
+    try:
+        run('codec (stdlib json)', lambda: codec.encode_playlist(playlist), codec.decode_playlist)
+    finally:
+        codec.orjson = fast
+
+BENCHMARKS = {
+    'connections': bench_connections,
+    'reorder': bench_reorder,
+    'import': bench_import,
+    'search': bench_search,
+    'backup': bench_backup,
+    'memory': bench_memory,
+    'codec': bench_codec,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--ops', type=int, default=2000, help='operations per measurement')
+    parser.add_argument('--tracks', type=int, default=100, help='tracks in the benchmark playlist')
+    parser.add_argument('--playlists', type=int, default=20, help='playlists to spread tracks over')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Codec - Tracks and playlists to and from JSON bytes for the web API
+"""
+import json
+from datetime import datetime
+from typing import Iterable, List, Optional, Union
+from models import Playlist, Track
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder writes the same JSON, more slowly
+    orjson = None
+
+PLAYLIST_FIELDS = ('name', 'type', 'description', 'created_at', 'modified_at', 'guild_id')
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def dumps(obj) -> bytes:
+    """UTF-8 JSON of obj, which must be built from dicts, lists, strings, numbers, bools and None"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _encoder.encode(obj).encode()
+
+def loads(data: Union[bytes, str]):
+    """Parse JSON bytes or text"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def encode_tracks(tracks: Iterable[Track]) -> bytes:
+    """A JSON array of tracks in their to_dict() form"""
+    return dumps([track.to_dict() for track in tracks])
+
+def encode_playlist(playlist: Playlist, offset: int = 0, limit: Optional[int] = None) -> bytes:
+    """A playlist and its tracks, or one page of them, as JSON bytes
+
+    Lazy playlists are read a page at a time, so only the requested window
+    of tracks is loaded. track_count is always the full length.
+    """
+    tracks = playlist.tracks if limit is None else playlist.tracks[offset:offset + limit]
+    return dumps({
+        'name': playlist.name,
+        'guild_id': playlist.guild_id,
+        'type': playlist.type,
+        'description': playlist.description,
+        'track_count': len(playlist.tracks),
+        'offset': offset if limit is not None else 0,
+        'tracks': [track.to_dict() for track in tracks],
+        'created_at': _isoformat(playlist.created_at),
+        'modified_at': _isoformat(playlist.modified_at),
+    })
+
+def decode_track(data: dict) -> Track:
+    """Track from its dict form; data is left untouched and unknown keys are ignored"""
+    added_at = data.get('added_at') if 'added_at' in data else datetime.now()
+    track = Track(data['title'], data['url'], data.get('duration'), data.get('type', 'youtube'),
+                  None if isinstance(added_at, str) else added_at, data.get('artist'), data.get('thumbnail_url'))
+    if isinstance(added_at, str):
+        # Parsed once; the text is kept to encode the track again
+        track.set_added_at_iso(added_at)
+    return track
+
+def decode_tracks(data: Union[bytes, str, List[dict]]) -> List[Track]:
+    """Tracks from a JSON array (or its parsed list)"""
+    if isinstance(data, (bytes, str)):
+        data = loads(data)
+    return [decode_track(track) for track in data]
+
+def decode_playlist(data: Union[bytes, str, dict]) -> Playlist:
+    """Playlist from encode_playlist() or Playlist.to_dict() output (JSON or parsed)"""
+    if isinstance(data, (bytes, str)):
+        data = loads(data)
+    fields = {name: data[name] for name in PLAYLIST_FIELDS if name in data}
+    for name in ('created_at', 'modified_at'):
+        if isinstance(fields.get(name), str):
+            fields[name] = datetime.fromisoformat(fields[name])
+    return Playlist(tracks=decode_tracks(data.get('tracks', [])), **fields)
@@ -1,45 +1,655 @@
 """Database management for Beathoven"""
 import os
+import re
+import atexit
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import logging
-from typing import Optional, List
+from typing import Dict, Optional, List, Iterable, Tuple
 import dotenv
-from models import Track, Playlist
+from normalizer import canonical_key
+from models import (Track, Playlist, LazyPlaylist, LazyTrackList, PlaylistColumns, PlaylistSummary,
+                    SearchResult, TrackStats)
+from playlist_cache import PlaylistCache
+from smart_playlist import SmartRule
 
 # Load environment variables from .env file in PWD
 dotenv.load_dotenv(os.path.join(os.getcwd(), '.env'), override=True)
 
 logger = logging.getLogger(__name__)
 
+# Pragmas applied to every pooled connection opened by Database.
+# WAL lets the Flask thread read while the bot writes (and vice versa), and
+# synchronous=NORMAL is safe under WAL - only the last commits can be lost on
+# power failure, never the database itself.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -20000),        # ~20 MB page cache per connection
+    ('mmap_size', 268435456),      # 256 MB memory-mapped I/O
+)
+SQLITE_BUSY_TIMEOUT = 5.0  # seconds to wait on a locked database
+SQLITE_POOL_SIZE = int(os.getenv('BEATHOVEN_DB_POOL_SIZE', 8))
+
+# playlist_tracks.position is sparse: tracks are spaced POSITION_GAP apart so
+# an insert or move can take the midpoint of its neighbours and write one row.
+# When a gap narrows below POSITION_REBALANCE_THRESHOLD the playlist is
+# renumbered in the background; if a gap is fully exhausted it is renumbered
+# inline before the write.
+POSITION_GAP = 1 << 16
+POSITION_REBALANCE_THRESHOLD = 64
+
+# Play counts are buffered in memory and written in one batch every
+# PLAY_FLUSH_INTERVAL seconds, or sooner once PLAY_FLUSH_THRESHOLD plays queue up
+PLAY_FLUSH_INTERVAL = 10.0
+PLAY_FLUSH_THRESHOLD = 100
+
+# Upper bound on full-text matches scored by bm25 for one search
+SEARCH_RANK_CANDIDATES = 2000
+
+# Guilds whose playlists and history live in their own database file under
+# BEATHOVEN_SHARD_DIR, so a busy server's writes don't contend with the rest
+SHARDED_GUILDS = {int(g) for g in os.getenv('BEATHOVEN_SHARDED_GUILDS', '').replace(',', ' ').split()}
+SHARD_DIR = os.getenv('BEATHOVEN_SHARD_DIR')  # default: shards/ next to BEATHOVEN_DB
+
+# Play history is summarised into hourly and daily buckets (unix seconds,
+# UTC). Stats ranges shorter than STATS_HOURLY_RANGE read the hourly rollup,
+# longer ones the daily rollup.
+ROLLUP_BUCKETS = (('play_rollup_hourly', 3600), ('play_rollup_daily', 86400))
+STATS_HOURLY_RANGE = 2 * 86400
+
+# Smart playlist pages and totals kept per database until the next commit
+SMART_CACHE_SIZE = int(os.getenv('BEATHOVEN_SMART_CACHE_SIZE', 64))
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    """Parse a timestamp column as stored by sqlite3"""
+    return datetime.fromisoformat(value) if value else None
+
+def _row_to_track(row) -> Track:
+    """Build a Track from (url, title, artist, duration, type, added_at, thumbnail_url)"""
+    url, title, artist, duration, ttype, added, thumb = row
+    return Track(
+        url=url,
+        title=title,
+        artist=artist,
+        duration=duration,
+        type=ttype,
+        added_at=_parse_timestamp(added),
+        thumbnail_url=thumb
+    )
+
+def _renumber_positions(c: sqlite3.Cursor, playlist_id: Optional[int] = None):
+    """Renumber positions POSITION_GAP apart (one playlist, or all if playlist_id is None)"""
+    c.execute('''
+        UPDATE playlist_tracks SET position = ranked.rank * ?
+        FROM (
+            SELECT playlist_id, track_id,
+                   ROW_NUMBER() OVER (PARTITION BY playlist_id ORDER BY position) - 1 AS rank
+            FROM playlist_tracks
+            WHERE ? IS NULL OR playlist_id = ?
+        ) AS ranked
+        WHERE playlist_tracks.playlist_id = ranked.playlist_id
+          AND playlist_tracks.track_id = ranked.track_id
+    ''', (POSITION_GAP, playlist_id, playlist_id))
+
+def _migrate_gap_positions(c: sqlite3.Cursor):
+    """Dense 0..n-1 positions -> sparse positions POSITION_GAP apart"""
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_playlist_tracks_position
+        ON playlist_tracks (playlist_id, position)
+    ''')
+    _renumber_positions(c)
+
+def _migrate_track_search(c: sqlite3.Cursor):
+    """Full-text index over track titles/artists, kept in sync by triggers"""
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+            title, artist,
+            content='tracks', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+            INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+            INSERT INTO tracks_fts (tracks_fts, rowid, title, artist)
+            VALUES ('delete', old.id, old.title, old.artist);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE OF title, artist ON tracks BEGIN
+            INSERT INTO tracks_fts (tracks_fts, rowid, title, artist)
+            VALUES ('delete', old.id, old.title, old.artist);
+            INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.id, new.title, new.artist);
+        END
+    ''')
+    # Title matches outrank artist matches
+    c.execute("INSERT INTO tracks_fts (tracks_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0)')")
+    c.execute("INSERT INTO tracks_fts (tracks_fts) VALUES ('rebuild')")
+    # Lets search results list the playlists containing each hit
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_playlist_tracks_track
+        ON playlist_tracks (track_id)
+    ''')
+
+def _migrate_hot_query_indexes(c: sqlite3.Cursor):
+    """Covering index for ordered playlist scans and a track type index"""
+    # (playlist_id, position, track_id) answers ordering and neighbour
+    # lookups from the index alone, superseding the version 1 index
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_playlist_tracks_order
+        ON playlist_tracks (playlist_id, position, track_id)
+    ''')
+    c.execute('DROP INDEX IF EXISTS idx_playlist_tracks_position')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tracks_type ON tracks (type)')
+
+def _migrate_play_history(c: sqlite3.Cursor):
+    """Append-only play log plus hourly/daily rollups maintained on flush"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS play_events (
+            id INTEGER PRIMARY KEY,
+            track_id INTEGER NOT NULL REFERENCES tracks (id) ON DELETE CASCADE,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            requester_id INTEGER,
+            started_at TIMESTAMP NOT NULL,
+            duration_played INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_play_events_started ON play_events (started_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_play_events_track ON play_events (track_id)')
+    for table, _ in ROLLUP_BUCKETS:
+        # Keyed guild first so per-guild range queries are one index seek
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                guild_id INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                track_id INTEGER NOT NULL REFERENCES tracks (id) ON DELETE CASCADE,
+                plays INTEGER NOT NULL DEFAULT 0,
+                skips INTEGER NOT NULL DEFAULT 0,
+                seconds_played INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, bucket, track_id)
+            ) WITHOUT ROWID
+        ''')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket)')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_track ON {table} (track_id)')
+
+def _migrate_canonical_keys(c: sqlite3.Cursor):
+    """Key tracks by canonical URL and merge rows that were the same track"""
+    c.execute('ALTER TABLE tracks ADD COLUMN canonical_key TEXT')
+    c.execute('UPDATE tracks SET canonical_key = canonical_key(url, type)')
+    
+    # Every duplicate is folded into the oldest row with the same key
+    c.execute('''
+        CREATE TEMP TABLE track_merges (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)
+    ''')
+    c.execute('''
+        INSERT INTO track_merges (old_id, new_id)
+        SELECT id, keep FROM (
+            SELECT id, MIN(id) OVER (PARTITION BY canonical_key) AS keep FROM tracks
+        ) WHERE id != keep
+    ''')
+    merged = c.execute('SELECT COUNT(*) FROM track_merges').fetchone()[0]
+    entries_removed = 0
+    if merged:
+        c.execute('''
+            UPDATE tracks SET
+                play_count = COALESCE(play_count, 0) + merged.plays,
+                last_played_at = MAX(COALESCE(last_played_at, ''), COALESCE(merged.last_played, ''))
+            FROM (
+                SELECT m.new_id, SUM(COALESCE(t.play_count, 0)) AS plays, MAX(t.last_played_at) AS last_played
+                FROM track_merges m JOIN tracks t ON t.id = m.old_id
+                GROUP BY m.new_id
+            ) AS merged
+            WHERE tracks.id = merged.new_id
+        ''')
+        c.execute("UPDATE tracks SET last_played_at = NULL WHERE last_played_at = ''")
+        
+        # A playlist holding several spellings keeps the earliest entry
+        c.execute('''
+            DELETE FROM playlist_tracks WHERE rowid IN (
+                SELECT rid FROM (
+                    SELECT pt.rowid AS rid,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY pt.playlist_id, COALESCE(m.new_id, pt.track_id)
+                               ORDER BY pt.position
+                           ) AS n
+                    FROM playlist_tracks pt
+                    LEFT JOIN track_merges m ON m.old_id = pt.track_id
+                    WHERE COALESCE(m.new_id, pt.track_id) IN (SELECT new_id FROM track_merges)
+                ) WHERE n > 1
+            )
+        ''')
+        entries_removed = c.rowcount
+        c.execute('''
+            UPDATE playlist_tracks SET track_id = m.new_id
+            FROM track_merges m WHERE playlist_tracks.track_id = m.old_id
+        ''')
+        
+        c.execute('''
+            UPDATE play_events SET track_id = m.new_id
+            FROM track_merges m WHERE play_events.track_id = m.old_id
+        ''')
+        for table, _ in ROLLUP_BUCKETS:
+            c.execute(f'''
+                INSERT INTO {table} (guild_id, bucket, track_id, plays, skips, seconds_played)
+                SELECT r.guild_id, r.bucket, m.new_id, r.plays, r.skips, r.seconds_played
+                FROM {table} r JOIN track_merges m ON m.old_id = r.track_id
+                WHERE true
+                ON CONFLICT (guild_id, bucket, track_id) DO UPDATE SET
+                    plays = plays + excluded.plays,
+                    skips = skips + excluded.skips,
+                    seconds_played = seconds_played + excluded.seconds_played
+            ''')
+            c.execute(f'DELETE FROM {table} WHERE track_id IN (SELECT old_id FROM track_merges)')
+        
+        c.execute('DELETE FROM tracks WHERE id IN (SELECT old_id FROM track_merges)')
+    c.execute('DROP TABLE temp.track_merges')
+    
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_tracks_canonical ON tracks (canonical_key)')
+    logger.info(f"Merged {merged} duplicate tracks by canonical URL "
+                f"({entries_removed} duplicate playlist entries removed)")
+
+def _migrate_guild_scope(c: sqlite3.Cursor):
+    """Scope playlist names to a guild and persist per-guild playback state"""
+    # SQLite can't drop the old UNIQUE(name), so the table is rebuilt.
+    # _migrate runs steps with foreign keys off, which keeps playlist_tracks
+    # rows from cascading away when the old table is dropped.
+    c.execute('''
+        CREATE TABLE playlists_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL DEFAULT 'local',
+            description TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            modified_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (guild_id, name)
+        )
+    ''')
+    c.execute('''
+        INSERT INTO playlists_new (id, guild_id, name, type, description, created_at, modified_at)
+        SELECT id, 0, name, type, description, created_at, modified_at FROM playlists
+    ''')
+    c.execute('DROP TABLE playlists')
+    c.execute('ALTER TABLE playlists_new RENAME TO playlists')
+    
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS guild_playback (
+            guild_id INTEGER PRIMARY KEY,
+            playlist_id INTEGER REFERENCES playlists (id) ON DELETE SET NULL,
+            track_index INTEGER NOT NULL DEFAULT 0,
+            volume INTEGER NOT NULL DEFAULT 100,
+            repeat_mode TEXT NOT NULL DEFAULT 'none',
+            updated_at TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_guild_playback_playlist ON guild_playback (playlist_id)')
+
+def _migrate_playback_shuffle(c: sqlite3.Cursor):
+    """Persist each guild's shuffle mode, seed and cursor"""
+    c.execute("ALTER TABLE guild_playback ADD COLUMN shuffle_mode TEXT NOT NULL DEFAULT 'off'")
+    c.execute('ALTER TABLE guild_playback ADD COLUMN shuffle_seed INTEGER NOT NULL DEFAULT 0')
+    c.execute('ALTER TABLE guild_playback ADD COLUMN shuffle_cursor INTEGER NOT NULL DEFAULT -1')
+
+def _migrate_play_queue(c: sqlite3.Cursor):
+    """Checkpoint table for the per-guild ad-hoc play queues"""
+    # Queued tracks are often one-off URLs, so they are stored whole
+    # rather than as references into tracks
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS play_queue (
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT NOT NULL,
+            artist TEXT,
+            duration INTEGER,
+            type TEXT NOT NULL,
+            added_at TIMESTAMP NOT NULL,
+            thumbnail_url TEXT,
+            PRIMARY KEY (guild_id, position)
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_smart_playlists(c: sqlite3.Cursor):
+    """Rule column for smart playlists and indexes on the columns rules sort by"""
+    # Smart playlists have no playlist_tracks rows; their rule is evaluated
+    # against tracks whenever they are read
+    c.execute('ALTER TABLE playlists ADD COLUMN rule TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tracks_play_count ON tracks (play_count)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tracks_last_played ON tracks (last_played_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tracks_added ON tracks (added_at)')
+
+# Schema migrations as (version, description, function), applied in order to
+# any database whose PRAGMA user_version is lower. Append new steps; never
+# edit or reorder released ones.
+MIGRATIONS = [
+    (1, "gap-based playlist positions", _migrate_gap_positions),
+    (2, "full-text track search", _migrate_track_search),
+    (3, "indexes for hot queries", _migrate_hot_query_indexes),
+    (4, "play history and rollups", _migrate_play_history),
+    (5, "canonical track keys", _migrate_canonical_keys),
+    (6, "guild-scoped playlists", _migrate_guild_scope),
+    (7, "shuffle state", _migrate_playback_shuffle),
+    (8, "play queue checkpoints", _migrate_play_queue),
+    (9, "smart playlists", _migrate_smart_playlists),
+]
+
+# PRAGMA user_version of a fully migrated database
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 class Database:
     _instance = None
+    _shards = {}  # db path -> Database for sharded guilds
+    _shards_lock = threading.Lock()
     
-    def __new__(cls):
+    def __new__(cls, db_path: Optional[str] = None):
+        if db_path is not None:
+            with cls._shards_lock:
+                if db_path not in cls._shards:
+                    shard = super(Database, cls).__new__(cls)
+                    shard._initialized = False
+                    cls._shards[db_path] = shard
+                return cls._shards[db_path]
         if cls._instance is None:
             cls._instance = super(Database, cls).__new__(cls)
             cls._instance._initialized = False
         return cls._instance
     
-    def __init__(self):
+    def __init__(self, db_path: Optional[str] = None):
         if self._initialized:
             return
             
         self._initialized = True
         
-        # Get database path from environment
-        self.db_path = os.getenv('BEATHOVEN_DB')
+        # Shards are opened with an explicit path; the main database comes
+        # from the environment
+        self.db_path = db_path or os.getenv('BEATHOVEN_DB')
         if not self.db_path:
             raise ValueError("BEATHOVEN_DB environment variable not set")
         
+        # Small bounded pool of long-lived connections shared by the bot's
+        # executor threads and Flask's per-request threads
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._pool_created = 0
+        self._local = threading.local()
+        
+        # Write-behind buffer of (url, type) -> [plays, last_played_at]
+        self._play_buffer = {}
+        self._play_buffer_size = 0
+        self._event_buffer = []
+        self._playback_buffer = {}  # guild id -> latest guild_playback row
+        self._play_lock = threading.Lock()
+        self._play_flush_wakeup = threading.Event()
+        self._play_flush_stop = threading.Event()
+        self._play_flush_thread = None
+        atexit.register(self.flush_plays)
+        
+        # Playlists queued for background position rebalancing
+        self._rebalance_pending = set()
+        self._rebalance_lock = threading.Lock()
+        
+        # Dedicated connection that only ever reads PRAGMA data_version, so
+        # every commit made through the pool (or by another process) moves it
+        self._version_conn = None
+        self._version_lock = threading.Lock()
+        
+        # Evaluated smart playlist rules, dropped on any commit
+        self._smart_cache = PlaylistCache(SMART_CACHE_SIZE, self.data_version)
+        
         # Initialize database immediately
         self._init_db()
     
+    @classmethod
+    def for_guild(cls, guild_id: int) -> 'Database':
+        """The database holding a guild's data: its shard if sharded, else the main one
+        
+        The first time a shard is opened, anything the guild still has in
+        the main database is moved into it.
+        """
+        main = cls()
+        if guild_id not in SHARDED_GUILDS:
+            return main
+        db_path = cls.shard_path(guild_id, main.db_path)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with cls._shards_lock:
+            opened = db_path in cls._shards
+        shard = cls(db_path)
+        if not opened:
+            shard._adopt_guild(main, guild_id)
+        return shard
+    
+    @staticmethod
+    def shard_path(guild_id: int, main_path: str) -> str:
+        """File of a sharded guild's database, given the main database's path"""
+        shard_dir = SHARD_DIR or os.path.join(os.path.dirname(os.path.abspath(main_path)), 'shards')
+        return os.path.join(shard_dir, f'guild-{guild_id}.db')
+    
+    def _adopt_guild(self, main: 'Database', guild_id: int):
+        """Move a newly sharded guild's playlists, history, playback and queue out of main
+        
+        The rows are copied only while this shard holds nothing of the
+        guild's, then deleted from main, so an interrupted move is finished
+        on the next open rather than duplicated.
+        """
+        # ATTACH can't run inside a transaction, so use a connection of our own
+        conn = self._open_connection()
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (main.db_path,))
+            guild_tables = ('playlists', 'guild_playback', 'play_queue', 'play_events')
+            
+            def has_rows(schema: str) -> bool:
+                return any(conn.execute(f'SELECT 1 FROM {schema}.{table} WHERE guild_id = ? LIMIT 1',
+                                        (guild_id,)).fetchone() for table in guild_tables)
+            
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if not has_rows('source'):
+                    conn.rollback()
+                    return
+                if not has_rows('main'):
+                    self._copy_guild_rows(conn, guild_id)
+                for table in ('guild_playback', 'play_queue', 'play_events',
+                              'play_rollup_hourly', 'play_rollup_daily', 'playlists'):
+                    conn.execute(f'DELETE FROM source.{table} WHERE guild_id = ?', (guild_id,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Moved guild {guild_id}'s data from {main.db_path} into its shard {self.db_path}")
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _copy_guild_rows(conn: sqlite3.Connection, guild_id: int):
+        """Copy a guild's rows from the attached source database (see _adopt_guild)"""
+        # Every track the guild's playlists or history refer to, matched by canonical key
+        conn.execute('''
+            INSERT INTO tracks (canonical_key, url, title, artist, duration, type, added_at,
+                                thumbnail_url, last_played_at, play_count)
+            SELECT canonical_key, url, title, artist, duration, type, added_at,
+                   thumbnail_url, last_played_at, play_count
+            FROM source.tracks
+            WHERE id IN (
+                SELECT pt.track_id FROM source.playlist_tracks pt
+                JOIN source.playlists p ON p.id = pt.playlist_id WHERE p.guild_id = ?1
+                UNION SELECT track_id FROM source.play_events WHERE guild_id = ?1
+                UNION SELECT track_id FROM source.play_rollup_daily WHERE guild_id = ?1
+                UNION SELECT track_id FROM source.play_rollup_hourly WHERE guild_id = ?1
+            )
+            ORDER BY id
+            ON CONFLICT(canonical_key) DO NOTHING
+        ''', (guild_id,))
+        conn.execute('''
+            INSERT INTO playlists (guild_id, name, type, description, rule, created_at, modified_at)
+            SELECT guild_id, name, type, description, rule, created_at, modified_at
+            FROM source.playlists WHERE guild_id = ? ORDER BY id
+        ''', (guild_id,))
+        # Source ids become shard ids through (guild_id, name) and canonical_key
+        conn.execute('''
+            INSERT INTO playlist_tracks (playlist_id, track_id, position, added_at)
+            SELECT p.id, t.id, pt.position, pt.added_at
+            FROM source.playlist_tracks pt
+            JOIN source.playlists sp ON sp.id = pt.playlist_id
+            JOIN playlists p ON p.guild_id = sp.guild_id AND p.name = sp.name
+            JOIN source.tracks st ON st.id = pt.track_id
+            JOIN tracks t ON t.canonical_key = st.canonical_key
+            WHERE sp.guild_id = ?
+        ''', (guild_id,))
+        conn.execute('''
+            INSERT INTO play_events (track_id, guild_id, requester_id, started_at, duration_played, skipped)
+            SELECT t.id, e.guild_id, e.requester_id, e.started_at, e.duration_played, e.skipped
+            FROM source.play_events e
+            JOIN source.tracks st ON st.id = e.track_id
+            JOIN tracks t ON t.canonical_key = st.canonical_key
+            WHERE e.guild_id = ?
+            ORDER BY e.id
+        ''', (guild_id,))
+        for rollup in ('play_rollup_hourly', 'play_rollup_daily'):
+            conn.execute(f'''
+                INSERT INTO {rollup} (guild_id, bucket, track_id, plays, skips, seconds_played)
+                SELECT r.guild_id, r.bucket, t.id, r.plays, r.skips, r.seconds_played
+                FROM source.{rollup} r
+                JOIN source.tracks st ON st.id = r.track_id
+                JOIN tracks t ON t.canonical_key = st.canonical_key
+                WHERE r.guild_id = ?
+            ''', (guild_id,))
+        # A shared playlist stays behind in main, so its position is dropped
+        # as save_guild_playback() would
+        conn.execute('''
+            INSERT INTO guild_playback (guild_id, playlist_id, track_index, volume, repeat_mode,
+                                        shuffle_mode, shuffle_seed, shuffle_cursor, updated_at)
+            SELECT g.guild_id, p.id, g.track_index, g.volume, g.repeat_mode,
+                   g.shuffle_mode, g.shuffle_seed, g.shuffle_cursor, g.updated_at
+            FROM source.guild_playback g
+            LEFT JOIN source.playlists sp ON sp.id = g.playlist_id
+            LEFT JOIN playlists p ON p.guild_id = sp.guild_id AND p.name = sp.name
+            WHERE g.guild_id = ?
+        ''', (guild_id,))
+        conn.execute('''
+            INSERT INTO play_queue (guild_id, position, url, title, artist, duration, type, added_at, thumbnail_url)
+            SELECT guild_id, position, url, title, artist, duration, type, added_at, thumbnail_url
+            FROM source.play_queue WHERE guild_id = ?
+        ''', (guild_id,))
+    
+    @classmethod
+    def all_instances(cls) -> List['Database']:
+        """The main database (if open) and every open shard"""
+        with cls._shards_lock:
+            shards = list(cls._shards.values())
+        return ([cls._instance] if cls._instance is not None else []) + shards
+    
+    def _open_connection(self) -> sqlite3.Connection:
+        """Open a new connection configured with SQLITE_PRAGMAS"""
+        # Connections move between threads through the pool, but are only
+        # ever used by the thread that has them checked out
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT,
+                               check_same_thread=False)
+        for pragma, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        conn.create_function('canonical_key', 2, canonical_key, deterministic=True)
+        return conn
+    
+    def _checkout(self) -> sqlite3.Connection:
+        """Take a connection from the pool, opening one if the pool has room"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            if self._pool_created < SQLITE_POOL_SIZE:
+                self._pool_created += 1
+                logger.debug(f"Opening pooled database connection {self._pool_created}/{SQLITE_POOL_SIZE}")
+                return self._open_connection()
+        try:
+            return self._pool.get(timeout=SQLITE_BUSY_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("Timed out waiting for a database connection") from None
+    
+    @contextmanager
+    def _connection(self, write: bool = False):
+        """Borrow a pooled connection for one unit of work.
+        
+        Commits on success and rolls back on error. Nested use from the
+        same thread shares the outer connection and transaction. With
+        write=True the transaction is opened IMMEDIATE so positions read
+        inside it cannot be changed by another writer before it commits.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            if write and not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            return
+            
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            if write:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._pool.put(conn)
+    
+    def close(self):
+        """Flush buffered plays and close all idle pooled connections (call on shutdown)"""
+        self._play_flush_stop.set()
+        self._play_flush_wakeup.set()
+        if self._play_flush_thread and self._play_flush_thread is not threading.current_thread():
+            self._play_flush_thread.join()
+        self._play_flush_thread = None
+        self.flush_plays()
+        
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            # Refresh planner statistics for tables whose shape changed
+            conn.execute('PRAGMA optimize')
+            conn.close()
+            with self._pool_lock:
+                self._pool_created -= 1
+                
+        with self._version_lock:
+            if self._version_conn is not None:
+                self._version_conn.close()
+                self._version_conn = None
+    
+    def data_version(self) -> int:
+        """Counter that changes whenever any other connection commits.
+        
+        Cheap enough to poll before every cached read: it touches no tables.
+        """
+        with self._version_lock:
+            if self._version_conn is None:
+                self._version_conn = self._open_connection()
+            return self._version_conn.execute('PRAGMA data_version').fetchone()[0]
+    
     def _init_db(self):
         """Initialize the database schema"""
         logger.info(f"Initializing database at {self.db_path}")
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 c = conn.cursor()
                 
                 # Create migrations table first
@@ -94,7 +704,7 @@ class Database:
                     )
                 ''')
                 
-                conn.commit()
+                self._migrate(conn)
                 logger.info("Database schema initialized successfully")
                 
                 # Verify tables exist
@@ -106,58 +716,214 @@ class Database:
             logger.error(f"Error initializing database: {e}")
             raise
     
+    def _migrate(self, conn: sqlite3.Connection):
+        """Apply every migration newer than the database's PRAGMA user_version"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema version {version} is newer than this "
+                               f"Beathoven supports ({SCHEMA_VERSION})")
+            
+        if version == SCHEMA_VERSION:
+            return
+            
+        # Table rebuilds must not fire ON DELETE actions, so foreign keys are
+        # off while migrating and checked before each step commits. The
+        # pragma is a no-op inside a transaction, hence the explicit commit.
+        conn.commit()
+        conn.execute('PRAGMA foreign_keys = OFF')
+        try:
+            for target, description, migration in MIGRATIONS:
+                if target <= version:
+                    continue
+                logger.info(f"Migrating database schema to version {target}: {description}")
+                # Each step commits with its version bump, so an interrupted
+                # upgrade resumes from the last completed step
+                c = conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    migration(c)
+                    violations = c.execute('PRAGMA foreign_key_check').fetchall()
+                    if violations:
+                        raise RuntimeError(f"Migration to version {target} broke {len(violations)} "
+                                           f"foreign key references, e.g. {violations[0]}")
+                    c.execute(f'PRAGMA user_version = {target}')
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                version = target
+        finally:
+            conn.execute('PRAGMA foreign_keys = ON')
+    
+    def _rebalance_positions(self, c: sqlite3.Cursor, playlist_id: Optional[int] = None):
+        """Renumber positions POSITION_GAP apart, keeping the current order"""
+        _renumber_positions(c, playlist_id)
+    
+    def rebalance_positions(self, playlist_id: Optional[int] = None):
+        """Renumber one playlist's positions (or every playlist's if playlist_id is None)"""
+        with self._connection(write=True) as conn:
+            self._rebalance_positions(conn.cursor(), playlist_id)
+        logger.info(f"Rebalanced positions for playlist {playlist_id if playlist_id is not None else '(all)'}")
+    
+    def _schedule_rebalance(self, playlist_id: int):
+        """Rebalance a playlist on a background thread once its gaps run low"""
+        with self._rebalance_lock:
+            if playlist_id in self._rebalance_pending:
+                return
+            self._rebalance_pending.add(playlist_id)
+            
+        def run():
+            try:
+                self.rebalance_positions(playlist_id)
+            except sqlite3.OperationalError as e:
+                # Busy writers win; the next narrow gap schedules another pass
+                logger.warning(f"Deferred rebalancing playlist {playlist_id}: {e}")
+            except Exception as e:
+                logger.error(f"Error rebalancing playlist {playlist_id}: {e}")
+            finally:
+                with self._rebalance_lock:
+                    self._rebalance_pending.discard(playlist_id)
+                    
+        threading.Thread(target=run, name=f"rebalance-{playlist_id}", daemon=True).start()
+    
+    def _position_between(self, c: sqlite3.Cursor, playlist_id: int,
+                          before: Optional[int], after: Optional[int]) -> Optional[int]:
+        """Pick a position strictly between two neighbours (None means open-ended)"""
+        if before is None and after is None:
+            return 0
+        if before is None:
+            return after - POSITION_GAP
+        if after is None:
+            return before + POSITION_GAP
+        if after - before < 2:
+            return None
+            
+        position = (before + after) // 2
+        if min(position - before, after - position) < POSITION_REBALANCE_THRESHOLD:
+            self._schedule_rebalance(playlist_id)
+        return position
+    
+    def _neighbour_positions(self, c: sqlite3.Cursor, playlist_id: int, index: int,
+                             exclude_track_id: Optional[int] = None):
+        """Positions of the tracks that would surround a track placed at index"""
+        c.execute('''
+            SELECT position FROM playlist_tracks
+            WHERE playlist_id = ? AND track_id IS NOT ?
+            ORDER BY position
+            LIMIT 2 OFFSET ?
+        ''', (playlist_id, exclude_track_id, max(index - 1, 0)))
+        rows = [row[0] for row in c.fetchall()]
+        if index == 0:
+            return None, (rows[0] if rows else None)
+        return (rows[0] if rows else None), (rows[1] if len(rows) > 1 else None)
+    
+    def _position_for_index(self, c: sqlite3.Cursor, playlist_id: int, index: int,
+                            exclude_track_id: Optional[int] = None) -> int:
+        """Position that places a track at index, rebalancing inline if the gap is exhausted"""
+        before, after = self._neighbour_positions(c, playlist_id, index, exclude_track_id)
+        position = self._position_between(c, playlist_id, before, after)
+        if position is None:
+            logger.info(f"Position gap exhausted in playlist {playlist_id}, rebalancing")
+            self._rebalance_positions(c, playlist_id)
+            before, after = self._neighbour_positions(c, playlist_id, index, exclude_track_id)
+            position = self._position_between(c, playlist_id, before, after)
+        return position
+    
+    def _upsert_track(self, c: sqlite3.Cursor, track: Track, now: datetime) -> int:
+        """Insert a track or refresh its metadata, returning its id"""
+        c.execute('''
+            INSERT INTO tracks (canonical_key, url, title, artist, duration, type, added_at, thumbnail_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(canonical_key) DO UPDATE SET
+                title=excluded.title,
+                artist=excluded.artist,
+                duration=excluded.duration,
+                thumbnail_url=excluded.thumbnail_url
+            RETURNING id
+        ''', (canonical_key(track.url, track.type), track.url, track.title, track.artist,
+              track.duration, track.type, track.added_at or now, track.thumbnail_url))
+        return c.fetchone()[0]
+    
+    def _insert_playlist_tracks(self, c: sqlite3.Cursor, playlist_id: int, tracks: Iterable[Track],
+                                now: datetime):
+        """Upsert tracks and add them to an empty playlist in order
+        
+        Like bulk_import_playlists, a second spelling of a track (same
+        canonical URL) is dropped: the first keeps its position and metadata.
+        """
+        seen = set()
+        for i, track in enumerate(tracks):
+            key = canonical_key(track.url, track.type)
+            if key in seen:
+                continue
+            seen.add(key)
+            track_id = self._upsert_track(c, track, now)
+            c.execute('''
+                INSERT INTO playlist_tracks (playlist_id, track_id, position, added_at)
+                VALUES (?, ?, ?, ?)
+            ''', (playlist_id, track_id, i * POSITION_GAP, now))
+    
+    def _get_playlist_id(self, c: sqlite3.Cursor, name: str, guild_id: int = 0) -> Optional[int]:
+        """Look up the id of a playlist whose tracks can be edited (None for smart playlists)"""
+        c.execute('SELECT id FROM playlists WHERE guild_id = ? AND name = ? AND rule IS NULL', (guild_id, name))
+        row = c.fetchone()
+        return row[0] if row else None
+    
+    def _touch_playlist(self, c: sqlite3.Cursor, playlist_id: int, now: datetime):
+        """Bump a playlist's modified_at"""
+        c.execute('UPDATE playlists SET modified_at = ? WHERE id = ?', (now, playlist_id))
+    
+    def _track_at(self, c: sqlite3.Cursor, playlist_id: int, index: int):
+        """Get (track_id, position) of the track at a list index, or None"""
+        if index < 0:
+            return None
+        c.execute('''
+            SELECT track_id, position FROM playlist_tracks
+            WHERE playlist_id = ?
+            ORDER BY position
+            LIMIT 1 OFFSET ?
+        ''', (playlist_id, index))
+        return c.fetchone()
+    
     def add_playlist(self, playlist: Playlist) -> int:
         """Add a playlist to the database"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
             now = datetime.now()
             
             # Insert playlist
             c.execute('''
-                INSERT INTO playlists (name, type, description, created_at, modified_at)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (playlist.name, playlist.type, playlist.description, 
+                INSERT INTO playlists (guild_id, name, type, description, created_at, modified_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (playlist.guild_id, playlist.name, playlist.type, playlist.description, 
                   playlist.created_at or now, playlist.modified_at or now))
             
             playlist_id = c.lastrowid
             
             # Add tracks
-            for i, track in enumerate(playlist.tracks):
-                # First add/update track
-                c.execute('''
-                    INSERT INTO tracks (url, title, artist, duration, type, added_at, thumbnail_url)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(url, type) DO UPDATE SET
-                        title=excluded.title,
-                        artist=excluded.artist,
-                        duration=excluded.duration,
-                        thumbnail_url=excluded.thumbnail_url
-                    RETURNING id
-                ''', (track.url, track.title, track.artist, track.duration,
-                      track.type, track.added_at or now, track.thumbnail_url))
-                track_id = c.fetchone()[0]
-                
-                # Then add to playlist_tracks
-                c.execute('''
-                    INSERT INTO playlist_tracks (playlist_id, track_id, position, added_at)
-                    VALUES (?, ?, ?, ?)
-                ''', (playlist_id, track_id, i, now))
-            
-            conn.commit()
+            self._insert_playlist_tracks(c, playlist_id, playlist.tracks, now)
             return playlist_id
     
+    def add_smart_playlist(self, name: str, rule: SmartRule, description: str = "", guild_id: int = 0) -> int:
+        """Add a smart playlist, whose tracks are whatever rule selects when it is read"""
+        with self._connection() as conn:
+            now = datetime.now()
+            c = conn.execute('''
+                INSERT INTO playlists (guild_id, name, type, description, rule, created_at, modified_at)
+                VALUES (?, ?, 'smart', ?, ?, ?, ?)
+            ''', (guild_id, name, description, rule.to_json(), now, now))
+            return c.lastrowid
+    
     def update_playlist(self, playlist: Playlist) -> bool:
         """Update an existing playlist"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection(write=True) as conn:
             c = conn.cursor()
             
             # Get playlist ID
-            c.execute('SELECT id FROM playlists WHERE name = ?', (playlist.name,))
-            row = c.fetchone()
-            if not row:
+            playlist_id = self._get_playlist_id(c, playlist.name, playlist.guild_id)
+            if playlist_id is None:
                 return False
                 
-            playlist_id = row[0]
             now = datetime.now()
             
             # Update playlist metadata
@@ -171,112 +937,899 @@ class Database:
             c.execute('DELETE FROM playlist_tracks WHERE playlist_id = ?', (playlist_id,))
             
             # Add new tracks
-            for i, track in enumerate(playlist.tracks):
+            self._insert_playlist_tracks(c, playlist_id, playlist.tracks, now)
+            return True
+    
+    def bulk_import_playlists(self, playlists: Iterable[Playlist]) -> dict:
+        """Import many playlists in one transaction, replacing any with the same guild and name
+        
+        A smart playlist of the same name becomes a regular one.
+        
+        Tracks are staged in a temp table with executemany, then upserted
+        into tracks and linked into playlist_tracks with set-based SQL, so
+        the cost per track is a single staged row rather than round trips.
+        A track spelt several ways (same canonical URL) is stored once, with
+        the first spelling's metadata, and updates the track row every
+        playlist shares. Returns import statistics including rows/sec.
+        """
+        start = time.perf_counter()
+        now = datetime.now()
+        num_playlists = 0
+        staged = []
+        seen = set()  # canonical keys staged so far
+        
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            c.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS import_tracks (
+                    playlist_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    canonical_key TEXT NOT NULL,
+                    first_spelling INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    artist TEXT,
+                    duration INTEGER,
+                    type TEXT NOT NULL,
+                    added_at TIMESTAMP,
+                    thumbnail_url TEXT
+                )
+            ''')
+            c.execute('DELETE FROM import_tracks')
+            
+            for playlist in playlists:
                 c.execute('''
-                    INSERT INTO tracks (url, title, artist, duration, type, added_at, thumbnail_url)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(url, type) DO UPDATE SET
-                        title=excluded.title,
-                        artist=excluded.artist,
-                        duration=excluded.duration,
-                        thumbnail_url=excluded.thumbnail_url
+                    INSERT INTO playlists (guild_id, name, type, description, created_at, modified_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(guild_id, name) DO UPDATE SET
+                        type=excluded.type,
+                        description=excluded.description,
+                        rule=NULL,
+                        modified_at=excluded.modified_at
                     RETURNING id
-                ''', (track.url, track.title, track.artist, track.duration,
-                      track.type, track.added_at or now, track.thumbnail_url))
-                track_id = c.fetchone()[0]
+                ''', (playlist.guild_id, playlist.name, playlist.type, playlist.description,
+                      playlist.created_at or now, now))
+                playlist_id = c.fetchone()[0]
+                c.execute('DELETE FROM playlist_tracks WHERE playlist_id = ?', (playlist_id,))
+                num_playlists += 1
                 
-                c.execute('''
-                    INSERT INTO playlist_tracks (playlist_id, track_id, position, added_at)
-                    VALUES (?, ?, ?, ?)
-                ''', (playlist_id, track_id, i, now))
+                for i, track in enumerate(playlist.tracks):
+                    key = canonical_key(track.url, track.type)
+                    staged.append((playlist_id, i * POSITION_GAP, key, key not in seen, track.url,
+                                   track.title, track.artist, track.duration, track.type,
+                                   track.added_at or now, track.thumbnail_url))
+                    seen.add(key)
+            
+            c.executemany('''
+                INSERT INTO import_tracks
+                    (playlist_id, position, canonical_key, first_spelling, url, title, artist,
+                     duration, type, added_at, thumbnail_url)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', staged)
             
-            conn.commit()
+            # The first spelling of each track in the import supplies its
+            # metadata, as it does its place in the playlist
+            c.execute('''
+                INSERT INTO tracks (canonical_key, url, title, artist, duration, type, added_at, thumbnail_url)
+                SELECT canonical_key, url, title, artist, duration, type, added_at, thumbnail_url
+                FROM import_tracks WHERE first_spelling
+                ORDER BY rowid
+                ON CONFLICT(canonical_key) DO UPDATE SET
+                    title=excluded.title,
+                    artist=excluded.artist,
+                    duration=excluded.duration,
+                    thumbnail_url=excluded.thumbnail_url
+            ''')
+            
+            # Duplicate entries within one playlist keep their first position
+            c.execute('''
+                INSERT OR IGNORE INTO playlist_tracks (playlist_id, track_id, position, added_at)
+                SELECT s.playlist_id, t.id, s.position, ?
+                FROM import_tracks s
+                JOIN tracks t ON t.canonical_key = s.canonical_key
+                ORDER BY s.rowid
+            ''', (now,))
+            
+            c.execute('DELETE FROM import_tracks')
+            
+        elapsed = time.perf_counter() - start
+        stats = {
+            'playlists': num_playlists,
+            'tracks': len(staged),
+            'seconds': elapsed,
+            'rows_per_sec': len(staged) / elapsed if elapsed > 0 else 0.0
+        }
+        logger.info(f"Bulk imported {stats['tracks']} tracks into {num_playlists} playlists "
+                    f"in {elapsed:.2f}s ({stats['rows_per_sec']:,.0f} rows/sec)")
+        return stats
+    
+    def append_track(self, name: str, track: Track, guild_id: int = 0) -> bool:
+        """Append a track to the end of a playlist"""
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            playlist_id = self._get_playlist_id(c, name, guild_id)
+            if playlist_id is None:
+                return False
+                
+            now = datetime.now()
+            track_id = self._upsert_track(c, track, now)
+            c.execute('''
+                INSERT OR IGNORE INTO playlist_tracks (playlist_id, track_id, position, added_at)
+                SELECT ?, ?, COALESCE(MAX(position) + ?, 0), ?
+                FROM playlist_tracks WHERE playlist_id = ?
+            ''', (playlist_id, track_id, POSITION_GAP, now, playlist_id))
+            if c.rowcount == 0:
+                logger.warning(f"Track {track.url} is already in playlist {name}")
+                return False
+                
+            self._touch_playlist(c, playlist_id, now)
             return True
     
-    def delete_playlist(self, name: str) -> bool:
+    def insert_track(self, name: str, index: int, track: Track, guild_id: int = 0) -> bool:
+        """Insert a track before the given index (appends if index is past the end)"""
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            playlist_id = self._get_playlist_id(c, name, guild_id)
+            if playlist_id is None:
+                return False
+                
+            index = max(index, 0)
+            if self._track_at(c, playlist_id, index) is None:
+                return self.append_track(name, track, guild_id)
+                
+            now = datetime.now()
+            track_id = self._upsert_track(c, track, now)
+            c.execute('''
+                SELECT 1 FROM playlist_tracks WHERE playlist_id = ? AND track_id = ?
+            ''', (playlist_id, track_id))
+            if c.fetchone():
+                logger.warning(f"Track {track.url} is already in playlist {name}")
+                return False
+                
+            position = self._position_for_index(c, playlist_id, index)
+            c.execute('''
+                INSERT INTO playlist_tracks (playlist_id, track_id, position, added_at)
+                VALUES (?, ?, ?, ?)
+            ''', (playlist_id, track_id, position, now))
+            self._touch_playlist(c, playlist_id, now)
+            return True
+    
+    def remove_track_at(self, name: str, index: int, guild_id: int = 0) -> bool:
+        """Remove the track at the given index from a playlist"""
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            playlist_id = self._get_playlist_id(c, name, guild_id)
+            if playlist_id is None:
+                return False
+                
+            at = self._track_at(c, playlist_id, index)
+            if at is None:
+                return False
+                
+            # Sparse positions need no renumbering after a delete
+            c.execute('''
+                DELETE FROM playlist_tracks WHERE playlist_id = ? AND track_id = ?
+            ''', (playlist_id, at[0]))
+            self._touch_playlist(c, playlist_id, datetime.now())
+            return True
+    
+    def move_track(self, name: str, old_index: int, new_index: int, guild_id: int = 0) -> bool:
+        """Move a track within a playlist by rewriting only its own position"""
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            playlist_id = self._get_playlist_id(c, name, guild_id)
+            if playlist_id is None:
+                return False
+                
+            source = self._track_at(c, playlist_id, old_index)
+            if source is None or self._track_at(c, playlist_id, new_index) is None:
+                return False
+            if old_index == new_index:
+                return True
+                
+            track_id = source[0]
+            position = self._position_for_index(c, playlist_id, new_index, exclude_track_id=track_id)
+            c.execute('''
+                UPDATE playlist_tracks SET position = ?
+                WHERE playlist_id = ? AND track_id = ?
+            ''', (position, playlist_id, track_id))
+            self._touch_playlist(c, playlist_id, datetime.now())
+            return True
+    
+    def reorder_tracks(self, name: str, order: List[int], guild_id: int = 0) -> bool:
+        """Reorder a playlist so that new index i holds the track previously at order[i]
+        
+        Only rows whose position actually changes are written.
+        """
+        with self._connection(write=True) as conn:
+            c = conn.cursor()
+            playlist_id = self._get_playlist_id(c, name, guild_id)
+            if playlist_id is None:
+                return False
+                
+            c.execute('''
+                SELECT track_id, position FROM playlist_tracks
+                WHERE playlist_id = ? ORDER BY position
+            ''', (playlist_id,))
+            current = c.fetchall()
+            if sorted(order) != list(range(len(current))):
+                return False
+                
+            updates = [
+                (current[new_index][1], playlist_id, current[old_index][0])
+                for new_index, old_index in enumerate(order)
+                if new_index != old_index
+            ]
+            c.executemany('''
+                UPDATE playlist_tracks SET position = ?
+                WHERE playlist_id = ? AND track_id = ?
+            ''', updates)
+            if updates:
+                self._touch_playlist(c, playlist_id, datetime.now())
+            return True
+    
+    def delete_playlist(self, name: str, guild_id: int = 0) -> bool:
         """Delete a playlist"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
-            c.execute('DELETE FROM playlists WHERE name = ?', (name,))
+            c.execute('DELETE FROM playlists WHERE guild_id = ? AND name = ?', (guild_id, name))
             deleted = c.rowcount > 0
-            conn.commit()
             return deleted
     
-    def get_playlist(self, name: str) -> Optional[Playlist]:
+    def get_playlist(self, name: str, guild_id: int = 0) -> Optional[Playlist]:
         """Get a playlist by name"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
             
             # Get playlist info
             c.execute('''
-                SELECT id, type, description, created_at, modified_at
-                FROM playlists WHERE name = ?
-            ''', (name,))
+                SELECT id, type, description, created_at, modified_at, rule
+                FROM playlists WHERE guild_id = ? AND name = ?
+            ''', (guild_id, name))
             row = c.fetchone()
             if not row:
                 return None
                 
-            playlist_id, ptype, desc, created, modified = row
+            playlist_id, ptype, desc, created, modified, rule = row
             
             # Get tracks
-            c.execute('''
-                SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url
-                FROM tracks t
-                JOIN playlist_tracks pt ON pt.track_id = t.id
-                WHERE pt.playlist_id = ?
-                ORDER BY pt.position
-            ''', (playlist_id,))
-            
-            tracks = []
-            for row in c.fetchall():
-                url, title, artist, duration, ttype, added, thumb = row
-                tracks.append(Track(
-                    url=url,
-                    title=title,
-                    artist=artist,
-                    duration=duration,
-                    type=ttype,
-                    added_at=datetime.fromisoformat(added) if added else None,
-                    thumbnail_url=thumb
-                ))
+            if rule is not None:
+                rule = SmartRule.from_json(rule)
+                tracks = self.get_smart_tracks(rule, 0, self.get_smart_totals(rule, guild_id)[0], guild_id)
+            else:
+                c.execute('''
+                    SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url
+                    FROM tracks t
+                    JOIN playlist_tracks pt ON pt.track_id = t.id
+                    WHERE pt.playlist_id = ?
+                    ORDER BY pt.position
+                ''', (playlist_id,))
+                tracks = [_row_to_track(row) for row in c.fetchall()]
             
             return Playlist(
                 name=name,
                 tracks=tracks,
                 type=ptype,
                 description=desc,
-                created_at=datetime.fromisoformat(created) if created else None,
-                modified_at=datetime.fromisoformat(modified) if modified else None
+                created_at=_parse_timestamp(created),
+                modified_at=_parse_timestamp(modified),
+                guild_id=guild_id
             )
     
-    def get_all_playlists(self) -> List[Playlist]:
-        """Get all playlists"""
+    def get_track_count(self, name: str, guild_id: int = 0) -> Optional[int]:
+        """Number of tracks in a playlist, or None if it does not exist"""
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT (SELECT COUNT(*) FROM playlist_tracks WHERE playlist_id = p.id), p.rule
+                FROM playlists p WHERE p.guild_id = ? AND p.name = ?
+            ''', (guild_id, name))
+            row = c.fetchone()
+            if not row:
+                return None
+        track_count, rule = row
+        if rule is not None:
+            return self.get_smart_totals(SmartRule.from_json(rule), guild_id)[0]
+        return track_count
+    
+    def get_tracks(self, name: str, offset: int = 0, limit: int = 100, guild_id: int = 0) -> List[Track]:
+        """Get one page of a playlist's tracks in order"""
+        if offset < 0 or limit <= 0:
+            return []
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, rule FROM playlists WHERE guild_id = ? AND name = ?', (guild_id, name))
+            row = c.fetchone()
+            if not row:
+                return []
+            playlist_id, rule = row
+            if rule is None:
+                c.execute('''
+                    SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url
+                    FROM playlist_tracks pt
+                    JOIN tracks t ON t.id = pt.track_id
+                    WHERE pt.playlist_id = ?
+                    ORDER BY pt.position
+                    LIMIT ? OFFSET ?
+                ''', (playlist_id, limit, offset))
+                return [_row_to_track(row) for row in c.fetchall()]
+        return self.get_smart_tracks(SmartRule.from_json(rule), offset, limit, guild_id)
+    
+    def get_track_at(self, name: str, index: int, guild_id: int = 0) -> Optional[Track]:
+        """Get the track at an index in a playlist, or None if out of range"""
+        tracks = self.get_tracks(name, index, 1, guild_id)
+        return tracks[0] if tracks else None
+    
+    def get_lazy_playlist(self, name: str, page_size: int = 100, guild_id: int = 0) -> Optional[LazyPlaylist]:
+        """Get a playlist whose tracks are fetched a page at a time when accessed"""
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT p.type, p.description, p.created_at, p.modified_at,
+                       (SELECT COUNT(*) FROM playlist_tracks WHERE playlist_id = p.id), p.rule
+                FROM playlists p WHERE p.guild_id = ? AND p.name = ?
+            ''', (guild_id, name))
+            row = c.fetchone()
+            if not row:
+                return None
+                
+        ptype, desc, created, modified, track_count, rule = row
+        if rule is not None:
+            # Paged straight from the rule's query, as of when the playlist was loaded
+            rule = SmartRule.from_json(rule)
+            track_count = self.get_smart_totals(rule, guild_id)[0]
+            fetch_page = lambda offset, limit: self.get_smart_tracks(rule, offset, limit, guild_id)
+        else:
+            fetch_page = lambda offset, limit: self.get_tracks(name, offset, limit, guild_id)
+        return LazyPlaylist(
+            name=name,
+            tracks=LazyTrackList(track_count, fetch_page, page_size),
+            type=ptype,
+            description=desc,
+            created_at=_parse_timestamp(created),
+            modified_at=_parse_timestamp(modified),
+            guild_id=guild_id
+        )
+    
+    def get_playlist_columns(self, name: str, guild_id: int = 0) -> Optional[PlaylistColumns]:
+        """Get a playlist's tracks as columns (no Track objects), or None if it does not exist"""
+        # Titles and URLs come back as UTF-8 bytes, straight into the string table
+        columns = 'CAST(t.title AS BLOB), CAST(t.url AS BLOB), t.duration, t.type, t.play_count'
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, rule FROM playlists WHERE guild_id = ? AND name = ?', (guild_id, name))
+            row = c.fetchone()
+            if not row:
+                return None
+            playlist_id, rule = row
+            if rule is None:
+                c.execute(f'''
+                    SELECT {columns}
+                    FROM playlist_tracks pt
+                    JOIN tracks t ON t.id = pt.track_id
+                    WHERE pt.playlist_id = ?
+                    ORDER BY pt.position
+                ''', (playlist_id,))
+            else:
+                rule = SmartRule.from_json(rule)
+                query, params = self._smart_query(rule, guild_id, datetime.now())
+                c.execute(f'SELECT {columns} {query} LIMIT ?',
+                          params + [rule.limit if rule.limit is not None else -1])
+            return PlaylistColumns.from_rows(c)
+    
+    def get_all_playlists(self, guild_id: Optional[int] = 0) -> List[Playlist]:
+        """Get a guild's playlists (every guild's if guild_id is None) with their tracks in one ordered scan"""
+        guild_filter = 'WHERE p.guild_id = ?' if guild_id is not None else ''
+        params = (guild_id,) if guild_id is not None else ()
         playlists = []
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
-            c.execute('SELECT name FROM playlists ORDER BY name')
-            for (name,) in c.fetchall():
-                playlist = self.get_playlist(name)
-                if playlist:
-                    playlists.append(playlist)
+            c.execute(f'''
+                SELECT p.id, p.guild_id, p.name, p.type, p.description, p.created_at, p.modified_at,
+                       p.rule, t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url
+                FROM playlists p
+                LEFT JOIN playlist_tracks pt ON pt.playlist_id = p.id
+                LEFT JOIN tracks t ON t.id = pt.track_id
+                {guild_filter}
+                ORDER BY p.guild_id, p.name, p.id, pt.position
+            ''', params)
+            
+            current_id = None
+            smart = []
+            for row in c:
+                playlist_id = row[0]
+                if playlist_id != current_id:
+                    current_id = playlist_id
+                    _, pguild, name, ptype, desc, created, modified, rule = row[:8]
+                    if rule is not None:
+                        smart.append((len(playlists), SmartRule.from_json(rule), pguild))
+                    playlists.append(Playlist(
+                        name=name,
+                        tracks=[],
+                        type=ptype,
+                        description=desc,
+                        created_at=_parse_timestamp(created),
+                        modified_at=_parse_timestamp(modified),
+                        guild_id=pguild
+                    ))
+                # LEFT JOIN yields a row of NULL track columns for empty playlists
+                if row[8] is not None:
+                    playlists[-1].tracks.append(_row_to_track(row[8:]))
+        for i, rule, pguild in smart:
+            playlists[i].tracks = self.get_smart_tracks(rule, 0, self.get_smart_totals(rule, pguild)[0], pguild)
         return playlists
     
+    def get_playlist_summaries(self, guild_id: Optional[int] = 0) -> List[PlaylistSummary]:
+        """Get name/type/description/track count/duration of a guild's playlists (every guild's if None) in one query"""
+        guild_filter = 'WHERE p.guild_id = ?' if guild_id is not None else ''
+        params = (guild_id,) if guild_id is not None else ()
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute(f'''
+                SELECT p.name, p.type, p.description, p.created_at, p.modified_at,
+                       COUNT(pt.track_id), COALESCE(SUM(t.duration), 0), p.guild_id, p.rule
+                FROM playlists p
+                LEFT JOIN playlist_tracks pt ON pt.playlist_id = p.id
+                LEFT JOIN tracks t ON t.id = pt.track_id
+                {guild_filter}
+                GROUP BY p.id
+                ORDER BY p.guild_id, p.name
+            ''', params)
+            summaries = []
+            for name, ptype, desc, created, modified, track_count, total_duration, pguild, rule in c.fetchall():
+                if rule is not None:
+                    track_count, total_duration = self.get_smart_totals(SmartRule.from_json(rule), pguild)
+                summaries.append(PlaylistSummary(
+                    name=name,
+                    type=ptype,
+                    description=desc or "",
+                    track_count=track_count,
+                    total_duration=total_duration,
+                    created_at=_parse_timestamp(created),
+                    modified_at=_parse_timestamp(modified),
+                    guild_id=pguild
+                ))
+            return summaries
+    
+    def _smart_query(self, rule: SmartRule, guild_id: int, now: datetime) -> Tuple[str, list]:
+        """FROM ... ORDER BY clauses selecting a rule's tracks, and their parameters
+        
+        A guild's smart playlist draws on the tracks of its own playlists
+        and the shared (guild 0) ones in this database. A sharded guild's
+        database holds no shared playlists, so there it sees only its own.
+        """
+        where, params = rule.where(now)
+        return f'''
+            FROM tracks t
+            WHERE EXISTS (SELECT 1 FROM playlist_tracks pt JOIN playlists p ON p.id = pt.playlist_id
+                          WHERE pt.track_id = t.id AND p.guild_id IN (0, ?))
+              AND {where}
+            ORDER BY {rule.order_by()}
+        ''', [guild_id] + params
+    
+    def _smart_key(self, rule: SmartRule, guild_id: int) -> tuple:
+        """Cache key prefix of a rule's results, and the time its relative filters are measured from"""
+        # Truncated to the minute so relative rules still share cached pages
+        now = datetime.now().replace(second=0, microsecond=0)
+        return (rule.to_json(), guild_id, now if rule.relative else None), now
+    
+    def get_smart_tracks(self, rule: SmartRule, offset: int = 0, limit: int = 100,
+                         guild_id: int = 0) -> List[Track]:
+        """Get one page of the tracks a smart playlist rule selects (cached until the next commit)"""
+        if rule.limit is not None:
+            limit = min(limit, rule.limit - offset)
+        if offset < 0 or limit <= 0:
+            return []
+        key, now = self._smart_key(rule, guild_id)
+        
+        def load():
+            query, params = self._smart_query(rule, guild_id, now)
+            with self._connection() as conn:
+                rows = conn.execute(f'''
+                    SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url
+                    {query}
+                    LIMIT ? OFFSET ?
+                ''', params + [limit, offset]).fetchall()
+            return [_row_to_track(row) for row in rows]
+        return self._smart_cache.get(key + ('page', offset, limit), load)
+    
+    def get_smart_totals(self, rule: SmartRule, guild_id: int = 0) -> Tuple[int, int]:
+        """(track count, total duration) of what a smart playlist rule selects (cached until the next commit)"""
+        key, now = self._smart_key(rule, guild_id)
+        
+        def load():
+            query, params = self._smart_query(rule, guild_id, now)
+            with self._connection() as conn:
+                return conn.execute(f'''
+                    SELECT COUNT(*), COALESCE(SUM(duration), 0)
+                    FROM (SELECT t.duration {query} LIMIT ?)
+                ''', params + [rule.limit if rule.limit is not None else -1]).fetchone()
+        return self._smart_cache.get(key + ('totals',), load)
+    
+    def get_guild_playback(self, guild_id: int) -> Optional[dict]:
+        """Saved playback state of a guild, or None if it has never played"""
+        with self._play_lock:
+            pending = self._playback_buffer.get(guild_id)
+        if pending is not None:
+            # Not flushed yet; the playlist name is already at hand
+            row = pending[1:]
+        else:
+            with self._connection() as conn:
+                row = conn.execute('''
+                    SELECT p.guild_id, p.name, g.track_index, g.volume, g.repeat_mode,
+                           g.shuffle_mode, g.shuffle_seed, g.shuffle_cursor, g.updated_at
+                    FROM guild_playback g
+                    LEFT JOIN playlists p ON p.id = g.playlist_id
+                    WHERE g.guild_id = ?
+                ''', (guild_id,)).fetchone()
+        if row is None:
+            return None
+        playlist_guild_id, playlist, track_index, volume, repeat_mode, shuffle_mode, seed, cursor, updated = row
+        return {
+            'playlist': playlist,
+            'playlist_guild_id': playlist_guild_id,
+            'track_index': track_index,
+            'volume': volume,
+            'repeat_mode': repeat_mode,
+            'shuffle_mode': shuffle_mode,
+            'shuffle_seed': seed,
+            'shuffle_cursor': cursor,
+            'updated_at': _parse_timestamp(updated) if isinstance(updated, str) else updated
+        }
+    
+    def _write_guild_playback(self, conn: sqlite3.Connection, rows: List[tuple]):
+        """Upsert rows built by _playback_row()"""
+        conn.executemany('''
+            INSERT INTO guild_playback (guild_id, playlist_id, track_index, volume, repeat_mode,
+                                        shuffle_mode, shuffle_seed, shuffle_cursor, updated_at)
+            VALUES (?1, (SELECT id FROM playlists WHERE guild_id = ?2 AND name = ?3), ?4, ?5, ?6, ?7, ?8, ?9, ?10)
+            ON CONFLICT (guild_id) DO UPDATE SET
+                playlist_id = excluded.playlist_id,
+                track_index = excluded.track_index,
+                volume = excluded.volume,
+                repeat_mode = excluded.repeat_mode,
+                shuffle_mode = excluded.shuffle_mode,
+                shuffle_seed = excluded.shuffle_seed,
+                shuffle_cursor = excluded.shuffle_cursor,
+                updated_at = excluded.updated_at
+        ''', rows)
+    
+    @staticmethod
+    def _playback_row(guild_id: int, playlist: Optional[str], track_index: int, volume: int,
+                      repeat_mode: str, playlist_guild_id: Optional[int], shuffle_mode: str,
+                      shuffle_seed: int, shuffle_cursor: int) -> tuple:
+        owner = guild_id if playlist_guild_id is None else playlist_guild_id
+        return (guild_id, owner, playlist, track_index, volume, repeat_mode,
+                shuffle_mode, shuffle_seed, shuffle_cursor, datetime.now())
+    
+    def save_guild_playback(self, guild_id: int, playlist: Optional[str], track_index: int = 0,
+                            volume: int = 100, repeat_mode: str = 'none', playlist_guild_id: Optional[int] = None,
+                            shuffle_mode: str = 'off', shuffle_seed: int = 0, shuffle_cursor: int = -1):
+        """Persist a guild's current playlist, position, volume, repeat and shuffle state now
+        
+        playlist_guild_id is the playlist's owner if it is not the guild
+        itself (0 for a shared playlist). A shared playlist must live in the
+        same database as the state, so sharded guilds playing shared
+        playlists keep their position in memory only.
+        """
+        row = self._playback_row(guild_id, playlist, track_index, volume, repeat_mode, playlist_guild_id,
+                                 shuffle_mode, shuffle_seed, shuffle_cursor)
+        with self._play_lock:
+            self._playback_buffer.pop(guild_id, None)
+        with self._connection() as conn:
+            self._write_guild_playback(conn, [row])
+    
+    def record_guild_playback(self, guild_id: int, playlist: Optional[str], track_index: int = 0,
+                              volume: int = 100, repeat_mode: str = 'none', playlist_guild_id: Optional[int] = None,
+                              shuffle_mode: str = 'off', shuffle_seed: int = 0, shuffle_cursor: int = -1):
+        """Buffer a guild's playback state; only the latest per guild is written on the next flush_plays()
+        
+        Stepping through tracks then costs no commit of its own, which would
+        otherwise move data_version and empty the playlist cache every step.
+        """
+        row = self._playback_row(guild_id, playlist, track_index, volume, repeat_mode, playlist_guild_id,
+                                 shuffle_mode, shuffle_seed, shuffle_cursor)
+        with self._play_lock:
+            self._playback_buffer[guild_id] = row
+            self._wake_play_flusher()
+    
+    def get_play_queue(self, guild_id: int) -> List[Track]:
+        """A guild's queue as of its last checkpoint"""
+        with self._connection() as conn:
+            rows = conn.execute('''
+                SELECT url, title, artist, duration, type, added_at, thumbnail_url
+                FROM play_queue WHERE guild_id = ? ORDER BY position
+            ''', (guild_id,)).fetchall()
+        return [_row_to_track(row) for row in rows]
+    
+    def save_play_queues(self, queues: Dict[int, List[Track]]):
+        """Replace the checkpointed queues of the given guilds in one transaction"""
+        if not queues:
+            return
+        with self._connection(write=True) as conn:
+            conn.executemany('DELETE FROM play_queue WHERE guild_id = ?', [(guild_id,) for guild_id in queues])
+            conn.executemany('''
+                INSERT INTO play_queue
+                    (guild_id, position, url, title, artist, duration, type, added_at, thumbnail_url)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(guild_id, position, t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url)
+                  for guild_id, tracks in queues.items() for position, t in enumerate(tracks)])
+    
+    def get_play_stats(self, track_url: str, track_type: str) -> Tuple[int, Optional[datetime]]:
+        """A track's (play_count, last_played_at), counting only flushed plays"""
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT play_count, last_played_at FROM tracks WHERE canonical_key = ?',
+                (canonical_key(track_url, track_type),)).fetchone()
+        if row is None:
+            return 0, None
+        return row[0] or 0, _parse_timestamp(row[1])
+    
     def update_track_play(self, track_url: str, track_type: str):
         """Update track play count and last played time"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
             c.execute('''
                 UPDATE tracks 
                 SET play_count = play_count + 1,
                     last_played_at = ?
-                WHERE url = ? AND type = ?
-            ''', (datetime.now(), track_url, track_type))
-            conn.commit()
+                WHERE canonical_key = ?
+            ''', (datetime.now(), canonical_key(track_url, track_type)))
+    
+    def search_tracks(self, query: str, limit: int = 20, guild_id: Optional[int] = None) -> List[SearchResult]:
+        """Ranked prefix search over track titles and artists
+        
+        Every word in the query must match the start of a word in the title
+        or artist. Each result lists the playlists containing the track -
+        if guild_id is given, only that guild's and the shared (guild 0)
+        ones. Very broad queries are ranked over their first
+        SEARCH_RANK_CANDIDATES matches only, which keeps one- or two-letter
+        prefixes fast.
+        """
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        # Quote each term so FTS5 operators in user input are taken literally
+        match = ' '.join(f'"{term}"*' for term in terms)
+        
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url,
+                       hits.rank,
+                       (SELECT group_concat(p.name, char(31))
+                        FROM playlist_tracks pt JOIN playlists p ON p.id = pt.playlist_id
+                        WHERE pt.track_id = t.id AND (? IS NULL OR p.guild_id IN (0, ?)))
+                FROM (
+                    SELECT rowid, rank FROM (
+                        SELECT rowid, rank FROM tracks_fts
+                        WHERE tracks_fts MATCH ?
+                        LIMIT ?
+                    )
+                    ORDER BY rank
+                    LIMIT ?
+                ) AS hits
+                JOIN tracks t ON t.id = hits.rowid
+                ORDER BY hits.rank
+            ''', (guild_id, guild_id, match, SEARCH_RANK_CANDIDATES, limit))
+            return [
+                SearchResult(
+                    track=_row_to_track(row[:7]),
+                    playlists=sorted(row[8].split('\x1f')) if row[8] else [],
+                    rank=row[7]
+                )
+                for row in c.fetchall()
+            ]
+    
+    def record_play(self, track_url: str, track_type: str):
+        """Buffer a play; it reaches the database on the next flush_plays()"""
+        with self._play_lock:
+            entry = self._play_buffer.get((track_url, track_type))
+            if entry is None:
+                self._play_buffer[(track_url, track_type)] = [1, datetime.now()]
+            else:
+                entry[0] += 1
+                entry[1] = datetime.now()
+            self._play_buffer_size += 1
+            self._wake_play_flusher()
+    
+    def record_play_event(self, track_url: str, track_type: str, guild_id: int = 0,
+                          requester_id: Optional[int] = None, started_at: Optional[datetime] = None,
+                          duration_played: int = 0, skipped: bool = False,
+                          title: Optional[str] = None, artist: Optional[str] = None):
+        """Buffer a finished or skipped play for the history log and rollups.
+        
+        title and artist fill in the track row if the track is in no playlist.
+        """
+        with self._play_lock:
+            self._event_buffer.append((track_url, track_type, guild_id, requester_id,
+                                       started_at or datetime.now(), int(duration_played), int(skipped),
+                                       title, artist))
+            self._wake_play_flusher()
+    
+    def _wake_play_flusher(self):
+        """Start the flush thread if needed and wake it early when the buffers are full.
+        
+        Caller must hold _play_lock.
+        """
+        if self._play_flush_thread is None:
+            self._play_flush_stop.clear()
+            self._play_flush_thread = threading.Thread(
+                target=self._play_flush_loop, name='play-flush', daemon=True)
+            self._play_flush_thread.start()
+        if self._play_buffer_size + len(self._event_buffer) >= PLAY_FLUSH_THRESHOLD:
+            self._play_flush_wakeup.set()
+    
+    def _play_flush_loop(self):
+        """Background writer for buffered plays"""
+        while not self._play_flush_stop.is_set():
+            self._play_flush_wakeup.wait(PLAY_FLUSH_INTERVAL)
+            self._play_flush_wakeup.clear()
+            try:
+                self.flush_plays()
+            except Exception as e:
+                logger.error(f"Error flushing play counts: {e}")
+    
+    def flush_plays(self) -> int:
+        """Write all buffered plays, play events and playback state in one transaction.
+        
+        Returns how many plays and events were written. Each event is
+        appended to play_events and added into its hourly and daily
+        rollup buckets, so stats never have to scan the log.
+        """
+        with self._play_lock:
+            if not self._play_buffer and not self._event_buffer and not self._playback_buffer:
+                return 0
+            buffer, self._play_buffer = self._play_buffer, {}
+            size, self._play_buffer_size = self._play_buffer_size, 0
+            events, self._event_buffer = self._event_buffer, []
+            playback, self._playback_buffer = self._playback_buffer, {}
+            
+        # Pre-aggregate the batch so each bucket row is upserted once
+        rollups = {table: {} for table, _ in ROLLUP_BUCKETS}
+        for url, ttype, guild_id, _, started_at, played, skipped, _, _ in events:
+            timestamp = int(started_at.timestamp())
+            for table, width in ROLLUP_BUCKETS:
+                key = (guild_id, timestamp - timestamp % width, url, ttype)
+                totals = rollups[table].setdefault(key, [0, 0, 0])
+                totals[0] += 1
+                totals[1] += skipped
+                totals[2] += played
+            
+        # Plays of tracks in no playlist (a one-off URL, a deleted track)
+        # still need a tracks row to be counted against
+        now = datetime.now()
+        track_rows = {canonical_key(url, ttype): (url, url, None, ttype) for url, ttype in buffer}
+        for url, ttype, _, _, _, _, _, title, artist in events:
+            track_rows[canonical_key(url, ttype)] = (url, title or url, artist, ttype)
+            
+        try:
+            with self._connection(write=True) as conn:
+                conn.executemany('''
+                    INSERT INTO tracks (canonical_key, url, title, artist, type, added_at)
+                    VALUES (?, ?, ?, COALESCE(?, 'Unknown'), ?, ?)
+                    ON CONFLICT DO NOTHING
+                ''', [(key, url, title, artist, ttype, now)
+                      for key, (url, title, artist, ttype) in track_rows.items()])
+                conn.executemany('''
+                    UPDATE tracks 
+                    SET play_count = play_count + ?,
+                        last_played_at = ?
+                    WHERE canonical_key = ?
+                ''', [(plays, last_played, canonical_key(url, ttype))
+                      for (url, ttype), (plays, last_played) in buffer.items()])
+                if events:
+                    c = conn.executemany('''
+                        INSERT INTO play_events
+                            (track_id, guild_id, requester_id, started_at, duration_played, skipped)
+                        SELECT id, ?, ?, ?, ?, ? FROM tracks WHERE canonical_key = ?
+                    ''', [(guild_id, requester_id, started_at, played, skipped, canonical_key(url, ttype))
+                          for url, ttype, guild_id, requester_id, started_at, played, skipped, _, _ in events])
+                    if c.rowcount < len(events):
+                        logger.warning(f"Dropped {len(events) - c.rowcount} play events with no matching track")
+                    for table, totals in rollups.items():
+                        conn.executemany(f'''
+                            INSERT INTO {table} (guild_id, bucket, track_id, plays, skips, seconds_played)
+                            SELECT ?, ?, id, ?, ?, ? FROM tracks WHERE canonical_key = ?
+                            ON CONFLICT (guild_id, bucket, track_id) DO UPDATE SET
+                                plays = plays + excluded.plays,
+                                skips = skips + excluded.skips,
+                                seconds_played = seconds_played + excluded.seconds_played
+                        ''', [(guild_id, bucket, plays, skips, played, canonical_key(url, ttype))
+                              for (guild_id, bucket, url, ttype), (plays, skips, played) in totals.items()])
+                if playback:
+                    self._write_guild_playback(conn, list(playback.values()))
+        except Exception:
+            # Put everything back so the next flush retries it
+            with self._play_lock:
+                for key, (plays, last_played) in buffer.items():
+                    entry = self._play_buffer.setdefault(key, [0, last_played])
+                    entry[0] += plays
+                    entry[1] = max(entry[1], last_played)
+                self._play_buffer_size += size
+                self._event_buffer[:0] = events
+                for guild_id, row in playback.items():
+                    self._playback_buffer.setdefault(guild_id, row)
+            raise
+            
+        logger.debug(f"Flushed {size} buffered plays for {len(buffer)} tracks and {len(events)} play events")
+        return size + len(events)
+    
+    def _stats_source(self, since: Optional[datetime]):
+        """Pick the rollup table for a range starting at since, and its first bucket"""
+        table, width = ROLLUP_BUCKETS[1]
+        if since is not None and (datetime.now() - since).total_seconds() <= STATS_HOURLY_RANGE:
+            table, width = ROLLUP_BUCKETS[0]
+        if since is None:
+            return table, width, 0
+        timestamp = int(since.timestamp())
+        return table, width, timestamp - timestamp % width
+    
+    def get_top_tracks(self, guild_id: Optional[int] = None, since: Optional[datetime] = None,
+                       limit: int = 10) -> List[TrackStats]:
+        """Most played tracks since a time (rounded down to its bucket), for one guild or all"""
+        table, _, first_bucket = self._stats_source(since)
+        guild_filter = 'r.guild_id = ? AND' if guild_id is not None else ''
+        params = ([guild_id] if guild_id is not None else []) + [first_bucket, limit]
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute(f'''
+                SELECT t.url, t.title, t.artist, t.duration, t.type, t.added_at, t.thumbnail_url,
+                       top.plays, top.skips, top.seconds_played
+                FROM (
+                    SELECT r.track_id, SUM(r.plays) AS plays, SUM(r.skips) AS skips,
+                           SUM(r.seconds_played) AS seconds_played
+                    FROM {table} r
+                    WHERE {guild_filter} r.bucket >= ?
+                    GROUP BY +r.track_id  -- filter on bucket rather than walk every track
+                    ORDER BY plays DESC, seconds_played DESC
+                    LIMIT ?
+                ) AS top
+                JOIN tracks t ON t.id = top.track_id
+                ORDER BY top.plays DESC, top.seconds_played DESC
+            ''', params)
+            return [
+                TrackStats(track=_row_to_track(row[:7]), plays=row[7], skips=row[8], seconds_played=row[9])
+                for row in c.fetchall()
+            ]
+    
+    def get_play_totals(self, guild_id: Optional[int] = None, since: Optional[datetime] = None) -> dict:
+        """Total plays, skips, listening time and distinct tracks since a time"""
+        table, _, first_bucket = self._stats_source(since)
+        guild_filter = 'guild_id = ? AND' if guild_id is not None else ''
+        params = ([guild_id] if guild_id is not None else []) + [first_bucket]
+        with self._connection() as conn:
+            plays, skips, seconds, tracks = conn.execute(f'''
+                SELECT COALESCE(SUM(plays), 0), COALESCE(SUM(skips), 0),
+                       COALESCE(SUM(seconds_played), 0), COUNT(DISTINCT track_id)
+                FROM {table}
+                WHERE {guild_filter} bucket >= ?
+            ''', params).fetchone()
+        return {'plays': plays, 'skips': skips, 'seconds_played': seconds, 'tracks': tracks}
+    
+    def get_play_timeline(self, guild_id: Optional[int] = None, since: Optional[datetime] = None) -> List[dict]:
+        """Plays per bucket (hourly for short ranges, daily otherwise) since a time"""
+        table, width, first_bucket = self._stats_source(since)
+        guild_filter = 'guild_id = ? AND' if guild_id is not None else ''
+        params = ([guild_id] if guild_id is not None else []) + [first_bucket]
+        with self._connection() as conn:
+            rows = conn.execute(f'''
+                SELECT bucket, SUM(plays), SUM(skips), SUM(seconds_played)
+                FROM {table}
+                WHERE {guild_filter} bucket >= ?
+                GROUP BY bucket
+                ORDER BY bucket
+            ''', params).fetchall()
+        return [
+            {'start': datetime.fromtimestamp(bucket).isoformat(), 'seconds': width,
+             'plays': plays, 'skips': skips, 'seconds_played': seconds}
+            for bucket, plays, skips, seconds in rows
+        ]
     
     def migrate_from_files(self, playlist_dir: str):
         """Migrate playlists from flat files to database"""
         # Check if already migrated
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
             c.execute('SELECT migrated_at FROM migrations WHERE source_dir = ?', (playlist_dir,))
             if c.fetchone():
@@ -292,8 +1845,7 @@ class Database:
             '.brp': 'radio'     # Beathoven Radio Playlist
         }
         
-        total_playlists = 0
-        total_tracks = 0
+        playlists = []
         
         for filename in os.listdir(playlist_dir):
             file_path = os.path.join(playlist_dir, filename)
@@ -302,7 +1854,7 @@ class Database:
                 name = os.path.splitext(filename)[0]
                 if ext in ext_to_type:
                     try:
-                        logger.info(f"Migrating playlist: {filename}")
+                        logger.info(f"Reading playlist: {filename}")
                         tracks = []
                         with open(file_path, 'r') as f:
                             for line in f:
@@ -315,25 +1867,25 @@ class Database:
                                     ))
                         
                         if tracks:  # Only create playlist if it has tracks
-                            playlist = Playlist(
+                            playlists.append(Playlist(
                                 name=name,
                                 tracks=tracks,
                                 type=ext_to_type[ext]
-                            )
-                            self.add_playlist(playlist)
-                            total_playlists += 1
-                            total_tracks += len(tracks)
-                            logger.info(f"Successfully migrated playlist: {name} with {len(tracks)} tracks")
+                            ))
                     except Exception as e:
-                        logger.error(f"Error migrating playlist {filename}: {e}")
+                        logger.error(f"Error reading playlist {filename}: {e}")
+        
+        # Import everything in one transaction
+        stats = self.bulk_import_playlists(playlists)
+        total_playlists = stats['playlists']
+        total_tracks = stats['tracks']
         
         # Record successful migration with stats
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             c = conn.cursor()
             c.execute(
                 'INSERT INTO migrations (source_dir, migrated_at, num_playlists, num_tracks) VALUES (?, ?, ?, ?)',
                 (playlist_dir, datetime.now(), total_playlists, total_tracks)
             )
-            conn.commit()
             
         logger.info(f"Migration complete. Imported {total_playlists} playlists with {total_tracks} tracks total")
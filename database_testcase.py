@@ -0,0 +1,42 @@
+"""
+DatabaseTestCase - Shared set-up for tests that need a database
+"""
+import os
+import tempfile
+import unittest
+from database import Database
+from playlist_manager import PlaylistManager
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs each test against a new database file in a temporary directory
+
+    Database and PlaylistManager are singletons, so both are reset before
+    and after every test, and every open database (shards too) is closed.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'test.db')
+        os.environ['BEATHOVEN_DB'] = self.db_path
+        os.environ.pop('PLAYLIST_DIR', None)
+        Database._instance = None
+        PlaylistManager._instance = None
+
+    def tearDown(self):
+        for db in Database.all_instances():
+            db.close()
+        Database._instance = None
+        Database._shards.clear()
+        PlaylistManager._instance = None
+        self.tmp_dir.cleanup()
+
+    def _open(self) -> Database:
+        """Open the database again, as a restarted bot would"""
+        Database._instance = None
+        return Database()
+
+    def _open_manager(self) -> PlaylistManager:
+        """Start a new PlaylistManager (over the same database) as self.manager"""
+        PlaylistManager._instance = None
+        self.manager = PlaylistManager()
+        return self.manager
@@ -2,14 +2,23 @@
 Discord bot for music playback and playlist management
 """
 import os
+import time
 import logging
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from typing import List, Optional
 import discord
 from discord.ext import commands
 import dotenv
-from playlist_manager import PlaylistManager
+from database import Database
+from playlist_manager import PlaylistManager, QUEUE_CHECKPOINT_INTERVAL
+from async_playlist_manager import AsyncPlaylistManager
+from backup import BackupScheduler, backup_all
 from web_ui import WebUI
 from models import Track
+from normalizer import guess_track_type
+from smart_playlist import SMART_PRESETS, SmartRule
 import asyncio
 import concurrent.futures
 import threading
@@ -24,6 +33,27 @@ TOKEN = os.getenv('DISCORD_TOKEN')
 COMMAND_PREFIX = os.getenv('COMMAND_PREFIX', '!')
 PORT = int(os.getenv('PORT', 5000))
 BASE_URL = os.getenv('BEATHOVEN_BASE_URL', 'http://localhost:5000')
+QUEUE_PAGE_SIZE = 10
+# Start the next track's FFmpeg process while the current one plays; 0 turns
+# it off, e.g. to compare the logged gaps between tracks
+PREFETCH_NEXT = os.getenv('BEATHOVEN_PREFETCH_NEXT', '1') != '0'
+
+@dataclass
+class _PlaySession:
+    """A track playing in one guild, timed for the play history"""
+    track: Track
+    requester_id: Optional[int]
+    started_at: datetime
+    started: float  # time.monotonic() at start
+    paused_at: Optional[float] = None
+    paused_for: float = 0.0
+    
+    def seconds_played(self, now: Optional[float] = None) -> int:
+        if now is None:
+            now = time.monotonic()
+        paused = self.paused_for + (now - self.paused_at if self.paused_at is not None else 0.0)
+        played = int(now - self.started - paused)
+        return min(played, self.track.duration) if self.track.duration else played
 
 class MusicBot(commands.Bot):
     def __init__(self, playlist_manager: PlaylistManager):
@@ -33,10 +63,13 @@ class MusicBot(commands.Bot):
         super().__init__(command_prefix=COMMAND_PREFIX, intents=intents)
         
         self.playlist_manager = playlist_manager
+        # Awaitable wrappers that keep SQLite off the event loop
+        self.async_playlist_manager = AsyncPlaylistManager(playlist_manager)
         self.web_ui = None  # Will be set by main.py
         self.active_voice_clients = {}  # Renamed from voice_clients
         self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
         self.bg_task = None
+        self.backup_scheduler = BackupScheduler(playlist_manager.db.db_path)
         
     async def setup_hook(self):
         """Set up the bot"""
@@ -49,47 +82,66 @@ class MusicBot(commands.Bot):
         # Start state monitoring
         self.bg_task = self.loop.create_task(self.monitor_playback_state())
         
+        # Periodic online database backups
+        self.backup_scheduler.start()
+        
     async def monitor_playback_state(self):
-        """Monitor playlist manager state for changes"""
+        """Follow player state changes made elsewhere (e.g. from the web UI)
+        
+        Sleeps on PlaylistManager events rather than polling, waking
+        otherwise only for queue checkpoints and idle-guild eviction.
+        """
         await self.wait_until_ready()
-        last_track_url = None
-        last_playing_state = False
+        events, unsubscribe = self.playlist_manager.events.subscribe_async(self.loop)
+        maintenance_interval = min(QUEUE_CHECKPOINT_INTERVAL, 60)
+        last_evict = last_checkpoint = time.monotonic()
         
-        while not self.is_closed():
-            try:
-                current_playing = self.playlist_manager.is_playing and not self.playlist_manager.is_paused
-                current_track = self.playlist_manager.get_current_track()
-                
-                # Check if playback state or track changed
-                if current_playing != last_playing_state or (current_track and current_track.url != last_track_url):
-                    logger.info(f"State change - playing: {current_playing}, track: {current_track.title if current_track else 'None'}")
+        try:
+            while not self.is_closed():
+                try:
+                    try:
+                        event = await asyncio.wait_for(events.get(), timeout=maintenance_interval)
+                    except asyncio.TimeoutError:
+                        event = None
                     
-                    # Handle track change only if we're supposed to be playing
-                    if current_playing and current_track:
-                        for voice_client in self.active_voice_clients.values():
-                            music_commands = self.get_cog('MusicCommands')
-                            if music_commands:
-                                await music_commands._play_track(None, voice_client, current_track)
-                                break
+                    # A burst of changes (e.g. new playlist, then play) needs one sync per guild
+                    changed = set()
+                    while event is not None:
+                        changed.add(event.guild_id)
+                        event = events.get_nowait() if not events.empty() else None
                     
-                    # Handle stop/pause
-                    if not current_playing:
-                        for voice_client in self.active_voice_clients.values():
-                            if voice_client.is_playing():
-                                voice_client.stop()
+                    music_commands = self.get_cog('MusicCommands')
+                    for guild_id in changed & set(self.active_voice_clients):
+                        if music_commands:
+                            await music_commands.sync_playback(guild_id)
                     
-                    # Update state tracking
-                    last_playing_state = current_playing
-                    last_track_url = current_track.url if current_track else None
-                
-            except Exception as e:
-                logger.error(f"Error in monitor_playback_state: {e}", exc_info=True)
-            await asyncio.sleep(0.1)  
+                    if time.monotonic() - last_checkpoint >= QUEUE_CHECKPOINT_INTERVAL:
+                        last_checkpoint = time.monotonic()
+                        await self.async_playlist_manager.run(self.playlist_manager.checkpoint_queues)
+                    
+                    # Forget the player state of guilds that stopped long ago
+                    if time.monotonic() - last_evict >= 60:
+                        last_evict = time.monotonic()
+                        await self.async_playlist_manager.run(self.playlist_manager.evict_idle)
+                    
+                except Exception as e:
+                    logger.error(f"Error in monitor_playback_state: {e}", exc_info=True)
+        finally:
+            unsubscribe()
         
     async def on_ready(self):
         """Called when bot is ready"""
         logger.info(f'{self.user} has connected to Discord!')
         
+    async def close(self):
+        """Shut down the bot and its DB thread"""
+        await super().close()
+        await self.loop.run_in_executor(None, self.backup_scheduler.stop)
+        await self.async_playlist_manager.run(self.playlist_manager.checkpoint_queues)
+        for db in Database.all_instances():
+            await self.async_playlist_manager.run(db.flush_plays)
+        self.async_playlist_manager.shutdown(wait=False)
+        
     def run(self, token: str):
         """Start the bot"""
         super().run(token)
@@ -97,6 +149,130 @@ class MusicBot(commands.Bot):
 class MusicCommands(commands.Cog):
     def __init__(self, bot: MusicBot):
         self.bot = bot
+        self._sessions = {}  # guild id -> _PlaySession
+        self._prepared = {}  # guild id -> (track url, audio source) of the predicted next track
+        self._gaps = {'prefetched': deque(maxlen=100), 'cold': deque(maxlen=100)}  # seconds
+        # Held while a command or track change moves a guild on and starts the
+        # new track, so sync_playback() doesn't start it a second time
+        self._transitions = {}  # guild id -> asyncio.Lock
+        
+    def _finish_session(self, guild_id: int, skipped: bool, finished_at: Optional[float] = None) -> None:
+        """Log the guild's current track to the play history, if one is playing"""
+        session = self._sessions.pop(guild_id, None)
+        if session is None:
+            return
+        self.bot.playlist_manager.record_play_event(
+            session.track, guild_id, session.requester_id, session.started_at,
+            session.seconds_played(finished_at), skipped)
+        
+    def _transition(self, guild_id: int) -> asyncio.Lock:
+        """Lock serialising track changes in a guild"""
+        return self._transitions.setdefault(guild_id, asyncio.Lock())
+        
+    def _pause_session(self, guild_id: int) -> None:
+        """Stop the clock on the guild's play session"""
+        session = self._sessions.get(guild_id)
+        if session and session.paused_at is None:
+            session.paused_at = time.monotonic()
+            
+    def _resume_session(self, guild_id: int) -> None:
+        """Restart the clock on the guild's play session"""
+        session = self._sessions.get(guild_id)
+        if session and session.paused_at is not None:
+            session.paused_for += time.monotonic() - session.paused_at
+            session.paused_at = None
+        
+    async def sync_playback(self, guild_id: int) -> None:
+        """Make the guild's voice client match its player state after a change"""
+        voice_client = self.bot.active_voice_clients.get(guild_id)
+        if voice_client is None:
+            return
+        async with self._transition(guild_id):
+            state = await self.bot.async_playlist_manager.snapshot(guild_id)
+            track = state.current_track
+            session = self._sessions.get(guild_id)
+            same_track = track is not None and session is not None and session.track.url == track.url
+            
+            if state.is_playing and track:
+                if same_track and voice_client.is_paused():
+                    voice_client.resume()
+                    self._resume_session(guild_id)
+                elif not self.is_playing(guild_id, track):
+                    logger.info(f"Track change in guild {guild_id}: {track.title}")
+                    await self._play_track(None, voice_client, track)
+                    return
+            elif state.is_paused:
+                if voice_client.is_playing():
+                    voice_client.pause()
+                    self._pause_session(guild_id)
+            elif voice_client.is_playing() or voice_client.is_paused():
+                self._finish_session(guild_id, skipped=True)
+                self._discard_prepared(guild_id)
+                voice_client.stop()
+                return
+                
+            if voice_client.source:
+                voice_client.source.volume = state.volume / 100
+            if PREFETCH_NEXT and voice_client.is_playing():
+                # The queue, repeat or shuffle mode may have changed what plays next
+                await self._prepare_next(voice_client)
+        
+    def is_playing(self, guild_id: int, track: Track) -> bool:
+        """Whether the guild's voice client is already playing track"""
+        session = self._sessions.get(guild_id)
+        voice_client = self.bot.active_voice_clients.get(guild_id)
+        return (session is not None and session.track.url == track.url
+                and voice_client is not None and voice_client.is_playing())
+        
+    def _discard_prepared(self, guild_id: int) -> None:
+        """Drop a guild's prepared audio source, stopping its FFmpeg process"""
+        prepared = self._prepared.pop(guild_id, None)
+        if prepared is not None:
+            self.bot.thread_pool.submit(prepared[1].cleanup)
+            
+    def _take_prepared(self, guild_id: int, track: Track):
+        """The guild's prepared audio source if it is for track, else None"""
+        prepared = self._prepared.get(guild_id)
+        if prepared is None or prepared[0] != track.url:
+            self._discard_prepared(guild_id)
+            return None
+        del self._prepared[guild_id]
+        return prepared[1]
+        
+    async def _prepare_next(self, voice_client: discord.VoiceClient):
+        """Create the audio source of the guild's next track while the current one plays"""
+        guild_id = voice_client.guild.id
+        try:
+            upcoming = await self.bot.async_playlist_manager.peek_next(1, guild_id)
+            track = upcoming[0] if upcoming else None
+            prepared = self._prepared.get(guild_id)
+            if track is not None and prepared is not None and prepared[0] == track.url:
+                return
+            self._discard_prepared(guild_id)
+            if track is None or track.type == 'radio':
+                # Nothing next, or a live stream that would go stale while waiting
+                return
+                
+            future = self.bot.thread_pool.submit(self.create_audio_source, track.url)
+            audio_source = await asyncio.wrap_future(future)
+            if audio_source is None:
+                return
+            if guild_id not in self.bot.active_voice_clients or guild_id in self._prepared:
+                # Left the channel, or another prepare finished first
+                self.bot.thread_pool.submit(audio_source.cleanup)
+                return
+            self._prepared[guild_id] = (track.url, audio_source)
+            logger.debug(f"Prepared next track in guild {guild_id}: {track.title}")
+        except Exception as e:
+            logger.error(f"Error preparing next track: {e}", exc_info=True)
+            
+    def _record_gap(self, track: Track, gap: float, prefetched: bool) -> None:
+        """Log the silence between a track ending and the next one starting"""
+        kind = 'prefetched' if prefetched else 'cold'
+        gaps = self._gaps[kind]
+        gaps.append(gap)
+        logger.info(f"Gap before {track.title}: {gap * 1000:.0f} ms ({kind}; "
+                    f"average {sum(gaps) / len(gaps) * 1000:.0f} ms over the last {len(gaps)} {kind})")
         
     @commands.command(name='join', help='Join your voice channel')
     async def join(self, ctx):
@@ -138,7 +314,7 @@ class MusicCommands(commands.Cog):
     async def list_playlists(self, ctx, playlist_type: Optional[str] = None):
         """List available playlists"""
         try:
-            playlists = self.bot.playlist_manager.get_all_playlists()
+            playlists = await self.bot.async_playlist_manager.get_playlist_summaries(ctx.guild.id)
             if not playlists:
                 await ctx.send("No playlists found.")
                 return
@@ -146,8 +322,8 @@ class MusicCommands(commands.Cog):
             # Filter by type if specified
             if playlist_type:
                 playlist_type = playlist_type.lower()
-                if playlist_type not in ['local', 'youtube', 'radio']:
-                    await ctx.send("Invalid playlist type. Must be 'local', 'youtube', or 'radio'.")
+                if playlist_type not in ['local', 'youtube', 'radio', 'smart']:
+                    await ctx.send("Invalid playlist type. Must be 'local', 'youtube', 'radio' or 'smart'.")
                     return
                 playlists = [p for p in playlists if p.type == playlist_type]
             
@@ -158,12 +334,12 @@ class MusicCommands(commands.Cog):
             )
             
             # Group playlists by type
-            for ptype in ['local', 'youtube', 'radio']:
+            for ptype in ['local', 'youtube', 'radio', 'smart']:
                 type_playlists = [p for p in playlists if p.type == ptype]
                 if type_playlists:
                     playlist_info = []
                     for p in type_playlists:
-                        tracks_info = f"{len(p.tracks)} track{'s' if len(p.tracks) != 1 else ''}"
+                        tracks_info = f"{p.track_count} track{'s' if p.track_count != 1 else ''}"
                         playlist_info.append(f"• {p.name} ({tracks_info})")
                     
                     embed.add_field(
@@ -178,12 +354,111 @@ class MusicCommands(commands.Cog):
             logger.error(f"Error listing playlists: {e}", exc_info=True)
             await ctx.send("Failed to list playlists. Please try again.")
             
+    @commands.command(name='smart', help='Create a smart playlist from a preset: ' + ', '.join(SMART_PRESETS))
+    async def smart(self, ctx, preset: str, *, name: Optional[str] = None):
+        """Create one of the preset smart playlists for this server"""
+        try:
+            preset = preset.lower()
+            if preset not in SMART_PRESETS:
+                await ctx.send(f"Unknown preset. Choose one of: {', '.join(SMART_PRESETS)}")
+                return
+                
+            name = name or preset
+            playlist = await self.bot.async_playlist_manager.create_smart_playlist(
+                name, SmartRule.from_dict(SMART_PRESETS[preset]), guild_id=ctx.guild.id)
+            if playlist is None:
+                await ctx.send(f"A playlist named '{name}' already exists.")
+                return
+            await ctx.send(f"Created smart playlist '{name}' ({len(playlist.tracks)} tracks right now).")
+            
+        except Exception as e:
+            logger.error(f"Error creating smart playlist: {e}", exc_info=True)
+            await ctx.send("Failed to create smart playlist. Please try again.")
+            
+    @commands.command(name='search', help='Search tracks by title or artist')
+    async def search(self, ctx, *, query: str):
+        """Search the track library"""
+        try:
+            results = await self.bot.async_playlist_manager.search_tracks(query, limit=10, guild_id=ctx.guild.id)
+            if not results:
+                await ctx.send(f"No tracks found for '{query}'.")
+                return
+                
+            embed = discord.Embed(
+                title=f"Search results for '{query}'",
+                color=discord.Color.blue()
+            )
+            for result in results:
+                track = result.track
+                name = f"{track.title} - {track.artist}" if track.artist else track.title
+                playlists = ", ".join(result.playlists) if result.playlists else "No playlists"
+                embed.add_field(name=name[:256], value=f"In: {playlists}"[:1024], inline=False)
+            
+            await ctx.send(embed=embed)
+            
+        except Exception as e:
+            logger.error(f"Error searching tracks: {e}", exc_info=True)
+            await ctx.send("Failed to search tracks. Please try again.")
+            
+    @commands.command(name='stats', help='Most played tracks in this server')
+    async def stats(self, ctx, days: int = 7):
+        """Show this guild's play totals and top tracks"""
+        try:
+            since = datetime.now() - timedelta(days=max(1, days))
+            db = Database.for_guild(ctx.guild.id)
+            totals = await self.bot.async_playlist_manager.run(db.get_play_totals, ctx.guild.id, since)
+            top = await self.bot.async_playlist_manager.run(db.get_top_tracks, ctx.guild.id, since, 10)
+            if not totals['plays']:
+                await ctx.send(f"Nothing played in the last {days} day{'s' if days != 1 else ''}.")
+                return
+                
+            embed = discord.Embed(
+                title=f"Top tracks, last {days} day{'s' if days != 1 else ''}",
+                description=f"{totals['plays']} plays, {totals['skips']} skipped, "
+                            f"{totals['seconds_played'] // 3600}h {totals['seconds_played'] // 60 % 60}m listened",
+                color=discord.Color.blue()
+            )
+            for i, stat in enumerate(top, 1):
+                embed.add_field(name=f"{i}. {stat.track.title}"[:256],
+                                value=f"{stat.plays} plays, {stat.skips} skipped", inline=False)
+            await ctx.send(embed=embed)
+            
+        except Exception as e:
+            logger.error(f"Error getting stats: {e}", exc_info=True)
+            await ctx.send("Failed to get stats.")
+            
+    @commands.command(name='backup', help='Back up the database (admin only)')
+    @commands.has_permissions(administrator=True)
+    async def backup(self, ctx):
+        """Write a compressed database snapshot"""
+        try:
+            await ctx.send("Backing up database...")
+            # Runs off the DB thread so playback keeps reading while it copies
+            future = self.bot.thread_pool.submit(backup_all, self.bot.playlist_manager.db.db_path)
+            results = await asyncio.wrap_future(future)
+            stats = results[0]
+            shards = f" and {len(results) - 1} shard(s)" if len(results) > 1 else ""
+            await ctx.send(f"Backup saved: {os.path.basename(stats['path'])}{shards} "
+                           f"({sum(r['compressed_bytes'] for r in results) / 1e6:.1f} MB, "
+                           f"{sum(r['seconds'] for r in results):.1f}s)")
+        except Exception as e:
+            logger.error(f"Error backing up database: {e}", exc_info=True)
+            await ctx.send("Failed to back up database.")
+            
+    @backup.error
+    async def backup_error(self, ctx, error):
+        if isinstance(error, commands.MissingPermissions):
+            await ctx.send("Only server administrators can run backups.")
+        else:
+            logger.error(f"Error in backup command: {error}")
+            
     @commands.command(name='leave', help='Leave voice channel')
     async def leave(self, ctx):
         """Leave the voice channel"""
         if ctx.guild.id in self.bot.active_voice_clients:
             await self.bot.active_voice_clients[ctx.guild.id].disconnect()
             del self.bot.active_voice_clients[ctx.guild.id]
+            self._discard_prepared(ctx.guild.id)
             
     @commands.command(name='play', help='Play a track or playlist')
     async def play(self, ctx, *, query: str):
@@ -201,17 +476,18 @@ class MusicCommands(commands.Cog):
             logger.info(f"Playing query: {query}")
             
             # Check if it's a playlist name
-            playlist = self.bot.playlist_manager.get_playlist(query)
-            if playlist:
-                logger.info(f"Found playlist: {playlist.name} with {len(playlist.tracks)} tracks")
-                self.bot.playlist_manager.set_current_playlist(playlist.name)
-                self.bot.playlist_manager.set_playing(True)
-                current_track = self.bot.playlist_manager.get_current_track()
-                
-                if current_track:
-                    logger.info(f"Playing track: {current_track.title} from {current_track.url}")
-                    await self._play_track(ctx, voice_client, current_track)
-                else:
+            track_count = await self.bot.async_playlist_manager.get_track_count(query, ctx.guild.id)
+            if track_count is not None:
+                logger.info(f"Found playlist: {query} with {track_count} tracks")
+                async with self._transition(ctx.guild.id):
+                    await self.bot.async_playlist_manager.set_current_playlist(query, ctx.guild.id)
+                    await self.bot.async_playlist_manager.set_playing(True, ctx.guild.id)
+                    current_track = await self.bot.async_playlist_manager.get_current_track(ctx.guild.id)
+                    
+                    if current_track:
+                        logger.info(f"Playing track: {current_track.title} from {current_track.url}")
+                        await self._play_track(ctx, voice_client, current_track)
+                if not current_track:
                     logger.error("No tracks in playlist")
                     await ctx.send("No tracks in playlist")
             else:
@@ -229,7 +505,8 @@ class MusicCommands(commands.Cog):
             voice_client = self.bot.active_voice_clients[ctx.guild.id]
             if voice_client.is_playing():
                 voice_client.pause()
-                self.bot.playlist_manager.set_paused(True)
+                self._pause_session(ctx.guild.id)
+                await self.bot.async_playlist_manager.set_paused(True, ctx.guild.id)
                 
     @commands.command(name='resume', help='Resume paused track')
     async def resume(self, ctx):
@@ -238,8 +515,8 @@ class MusicCommands(commands.Cog):
             voice_client = self.bot.active_voice_clients[ctx.guild.id]
             if voice_client.is_paused():
                 voice_client.resume()
-                self.bot.playlist_manager.set_paused(False)
-                self.bot.playlist_manager.set_playing(True)
+                self._resume_session(ctx.guild.id)
+                await self.bot.async_playlist_manager.set_playing(True, ctx.guild.id)
                 
     @commands.command(name='next', help='Play next track')
     async def next(self, ctx):
@@ -250,11 +527,12 @@ class MusicCommands(commands.Cog):
                 return
                 
             # Get next track first
-            next_track = self.bot.playlist_manager.next_track()
-            if next_track:
-                voice_client = self.bot.active_voice_clients[ctx.guild.id]
-                await self._play_track(ctx, voice_client, next_track)
-            else:
+            async with self._transition(ctx.guild.id):
+                next_track = await self.bot.async_playlist_manager.next_track(ctx.guild.id)
+                if next_track:
+                    voice_client = self.bot.active_voice_clients[ctx.guild.id]
+                    await self._play_track(ctx, voice_client, next_track)
+            if not next_track:
                 await ctx.send("No more tracks in playlist.")
         except Exception as e:
             logger.error(f"Error playing next track: {e}", exc_info=True)
@@ -269,11 +547,12 @@ class MusicCommands(commands.Cog):
                 return
                 
             # Get previous track first
-            prev_track = self.bot.playlist_manager.previous_track()
-            if prev_track:
-                voice_client = self.bot.active_voice_clients[ctx.guild.id]
-                await self._play_track(ctx, voice_client, prev_track)
-            else:
+            async with self._transition(ctx.guild.id):
+                prev_track = await self.bot.async_playlist_manager.previous_track(ctx.guild.id)
+                if prev_track:
+                    voice_client = self.bot.active_voice_clients[ctx.guild.id]
+                    await self._play_track(ctx, voice_client, prev_track)
+            if not prev_track:
                 await ctx.send("No previous tracks in playlist.")
         except Exception as e:
             logger.error(f"Error playing previous track: {e}", exc_info=True)
@@ -286,20 +565,112 @@ class MusicCommands(commands.Cog):
             await ctx.send("Volume must be between 0 and 100")
             return
             
-        self.bot.playlist_manager.set_volume(volume)
+        await self.bot.async_playlist_manager.set_volume(volume, ctx.guild.id)
         if ctx.guild.id in self.bot.active_voice_clients:
             voice_client = self.bot.active_voice_clients[ctx.guild.id]
             if voice_client.source:
                 voice_client.source.volume = volume / 100
                 
+    @commands.command(name='shuffle', help='Shuffle playback: on, weighted or off')
+    async def shuffle(self, ctx, mode: str = 'on'):
+        """Set shuffle mode"""
+        mode = mode.lower()
+        if not await self.bot.async_playlist_manager.set_shuffle(mode, ctx.guild.id):
+            await ctx.send("Shuffle mode must be on, weighted or off")
+            return
+        await ctx.send(f"Shuffle {mode}")
+                
+    async def _resolve_track(self, query: str, guild_id: int) -> Optional[Track]:
+        """A link or path as a one-off track, or else the best library match"""
+        if '://' in query or query.startswith(('/', '~')):
+            return Track(title=query, url=query, type=guess_track_type(query))
+        results = await self.bot.async_playlist_manager.search_tracks(query, limit=1, guild_id=guild_id)
+        return results[0].track if results else None
+        
+    async def _queue_track(self, ctx, query: str, front: bool):
+        """Queue a track and start playing if the guild's voice client is idle"""
+        track = await self._resolve_track(query, ctx.guild.id)
+        if track is None:
+            await ctx.send(f"No track found for '{query}'.")
+            return
+        position = await self.bot.async_playlist_manager.enqueue(track, ctx.guild.id, front)
+        if position is None:
+            await ctx.send("The queue is full.")
+            return
+        
+        voice_client = self.bot.active_voice_clients.get(ctx.guild.id)
+        if voice_client and not voice_client.is_playing() and not voice_client.is_paused():
+            async with self._transition(ctx.guild.id):
+                next_track = await self.bot.async_playlist_manager.next_track(ctx.guild.id)
+                if next_track:
+                    await self._play_track(ctx, voice_client, next_track)
+            if next_track:
+                return
+        await ctx.send(f"Queued at #{position + 1}: {track.title}")
+        
+    @commands.command(name='queue', help='Queue a link or track, or show the queue (optionally a page)')
+    async def queue(self, ctx, *, query: Optional[str] = None):
+        """Add to or show the queue"""
+        try:
+            if query and not query.isdigit():
+                await self._queue_track(ctx, query, front=False)
+                return
+                
+            page = max(int(query or 1), 1)
+            length = await self.bot.async_playlist_manager.queue_length(ctx.guild.id)
+            if not length:
+                await ctx.send("The queue is empty.")
+                return
+            pages = (length + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+            page = min(page, pages)
+            offset = (page - 1) * QUEUE_PAGE_SIZE
+            tracks = await self.bot.async_playlist_manager.get_queue(ctx.guild.id, offset, QUEUE_PAGE_SIZE)
+            lines = [f"{offset + i + 1}. {track.title}" for i, track in enumerate(tracks)]
+            embed = discord.Embed(
+                title=f"Queue ({length} track{'s' if length != 1 else ''})",
+                description="\n".join(lines)[:4096],
+                color=discord.Color.blue()
+            )
+            embed.set_footer(text=f"Page {page}/{pages}")
+            await ctx.send(embed=embed)
+        except Exception as e:
+            logger.error(f"Error in queue command: {e}", exc_info=True)
+            await ctx.send("Failed to update the queue.")
+            
+    @commands.command(name='playnext', help='Queue a link or track to play next')
+    async def playnext(self, ctx, *, query: str):
+        """Queue a track at the front"""
+        try:
+            await self._queue_track(ctx, query, front=True)
+        except Exception as e:
+            logger.error(f"Error in playnext command: {e}", exc_info=True)
+            await ctx.send("Failed to update the queue.")
+            
+    @commands.command(name='remove', help='Remove track n from the queue')
+    async def remove(self, ctx, n: int):
+        """Remove a queued track"""
+        track = await self.bot.async_playlist_manager.remove_from_queue(n - 1, ctx.guild.id)
+        if track is None:
+            await ctx.send(f"There is no track #{n} in the queue.")
+        else:
+            await ctx.send(f"Removed #{n}: {track.title}")
+            
+    @commands.command(name='clearqueue', help='Empty the queue')
+    async def clearqueue(self, ctx):
+        """Empty the queue"""
+        removed = await self.bot.async_playlist_manager.clear_queue(ctx.guild.id)
+        await ctx.send(f"Cleared {removed} queued track{'s' if removed != 1 else ''}.")
+                
     @commands.command(name='stop', help='Stop playback')
     async def stop(self, ctx):
         """Stop playback"""
         if ctx.guild.id in self.bot.active_voice_clients:
             voice_client = self.bot.active_voice_clients[ctx.guild.id]
+            self._finish_session(ctx.guild.id, skipped=True)
+            self._discard_prepared(ctx.guild.id)
             voice_client.stop()
-            self.bot.playlist_manager.set_playing(False)
-            self.bot.playlist_manager.set_paused(False)
+            await self.bot.async_playlist_manager.set_playing(False, ctx.guild.id)
+            await self.bot.async_playlist_manager.set_paused(False, ctx.guild.id)
             
     def create_audio_source(self, url):
         try:
@@ -317,19 +688,30 @@ class MusicCommands(commands.Cog):
     async def _play_track(self, ctx, voice_client: discord.VoiceClient, track: Track):
         """Play a track in the voice channel"""
         try:
-            # Create audio source in new thread
-            logger.info(f"Creating audio source for track: {track.title} from {track.url}")
-            future = self.bot.thread_pool.submit(
-                self.create_audio_source,
-                track.url
-            )
-            audio_source = await asyncio.wrap_future(future)
+            # Use the source prepared while the last track played, or create
+            # one in a new thread
+            guild_id = voice_client.guild.id
+            audio_source = self._take_prepared(guild_id, track)
+            if audio_source is None:
+                logger.info(f"Creating audio source for track: {track.title} from {track.url}")
+                future = self.bot.thread_pool.submit(
+                    self.create_audio_source,
+                    track.url
+                )
+                audio_source = await asyncio.wrap_future(future)
             
             if not audio_source:
                 if ctx:
                     await ctx.send(f"Failed to create audio source for: {track.title}")
                 return
                 
+            # Whatever was playing is being cut short; restarting the same
+            # track (as the monitor loop does after a track change) continues it
+            session = self._sessions.get(guild_id)
+            if session and session.track.url != track.url:
+                self._finish_session(guild_id, skipped=True)
+                session = None
+            
             # Start playback or patch stream
             logger.info(f"Starting playback of {track.url}")
             if voice_client.is_playing():
@@ -342,10 +724,19 @@ class MusicCommands(commands.Cog):
                     after=lambda e: self._on_playback_finished(e, voice_client)
                 )
             
+            if session is None:
+                self._sessions[guild_id] = _PlaySession(
+                    track=track,
+                    requester_id=ctx.author.id if ctx else None,
+                    started_at=datetime.now(),
+                    started=time.monotonic()
+                )
+            
             # Update state
-            self.bot.playlist_manager.set_playing(True)
-            self.bot.playlist_manager.set_paused(False)
+            await self.bot.async_playlist_manager.set_playing(True, guild_id)
             logger.info(f"Now playing: {track.title}")
+            if PREFETCH_NEXT:
+                self.bot.loop.create_task(self._prepare_next(voice_client))
             if ctx:
                 await ctx.send(f"Now playing: {track.title}")
                 
@@ -355,25 +746,40 @@ class MusicCommands(commands.Cog):
                 await ctx.send("Failed to play track.")
 
     def _on_playback_finished(self, error, voice_client):
-        """Handle playback finish"""
+        """Handle playback finish (runs on the voice client's audio thread)"""
+        finished_at = time.monotonic()
         if error:
             logger.error(f"Player error: {error}")
         
-        # Schedule next track in bot's event loop
-        self.bot.loop.call_soon_threadsafe(
-            lambda: self.bot.loop.create_task(self._play_next(voice_client))
-        )
+        # Sessions are only touched on the event loop
+        self.bot.loop.call_soon_threadsafe(self._track_finished, voice_client, finished_at)
+        
+    def _track_finished(self, voice_client, finished_at: float):
+        """Log a track that played to the end and schedule the next one"""
+        # Stop/skip already logged their session
+        self._finish_session(voice_client.guild.id, skipped=False, finished_at=finished_at)
+        self.bot.loop.create_task(self._play_next(voice_client, finished_at))
             
-    async def _play_next(self, voice_client):
+    async def _play_next(self, voice_client, finished_at: float):
         """Play next track after current one finishes"""
         try:
-            # Get next track
-            next_track = self.bot.playlist_manager.next_track()
-            if next_track:
-                await self._play_track(None, voice_client, next_track)
-            else:
-                logger.info("No more tracks to play")
-                self.bot.playlist_manager.set_playing(False)
+            guild_id = voice_client.guild.id
+            async with self._transition(guild_id):
+                state = await self.bot.async_playlist_manager.snapshot(guild_id)
+                if not state.is_playing:
+                    # Stopped, not played to the end
+                    return
+                    
+                # Get next track
+                next_track = await self.bot.async_playlist_manager.next_track(guild_id)
+                if next_track:
+                    prepared = self._prepared.get(guild_id)
+                    prefetched = prepared is not None and prepared[0] == next_track.url
+                    await self._play_track(None, voice_client, next_track)
+                    self._record_gap(next_track, time.monotonic() - finished_at, prefetched)
+                else:
+                    logger.info(f"No more tracks to play in guild {guild_id}")
+                    await self.bot.async_playlist_manager.set_playing(False, guild_id)
         except Exception as e:
             logger.error(f"Error playing next track: {e}", exc_info=True)
 
@@ -0,0 +1,115 @@
+"""
+Events - Player state change notifications published by PlaylistManager
+"""
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, ClassVar, List, Optional, Tuple
+from models import Track
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class PlaybackEvent:
+    """Something about one guild's player changed"""
+    type: ClassVar[str] = "playback"
+    guild_id: int
+
+    def to_dict(self) -> dict:
+        """Convert event to dictionary for JSON serialization"""
+        return {"type": self.type, "guild_id": self.guild_id}
+
+@dataclass(frozen=True)
+class TrackChanged(PlaybackEvent):
+    """The guild moved to another track; track is None when it has none left"""
+    type: ClassVar[str] = "track"
+    track: Optional[Track]
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "track": self.track.to_dict() if self.track else None}
+
+@dataclass(frozen=True)
+class PlayStateChanged(PlaybackEvent):
+    """Playback started, paused or stopped"""
+    type: ClassVar[str] = "play_state"
+    is_playing: bool
+    is_paused: bool
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "is_playing": self.is_playing, "is_paused": self.is_paused}
+
+@dataclass(frozen=True)
+class VolumeChanged(PlaybackEvent):
+    type: ClassVar[str] = "volume"
+    volume: int
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "volume": self.volume}
+
+@dataclass(frozen=True)
+class RepeatChanged(PlaybackEvent):
+    type: ClassVar[str] = "repeat"
+    repeat_mode: str
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "repeat_mode": self.repeat_mode}
+
+@dataclass(frozen=True)
+class ShuffleChanged(PlaybackEvent):
+    type: ClassVar[str] = "shuffle"
+    shuffle_mode: str
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "shuffle_mode": self.shuffle_mode}
+
+@dataclass(frozen=True)
+class QueueChanged(PlaybackEvent):
+    type: ClassVar[str] = "queue"
+    length: int
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "length": self.length}
+
+Handler = Callable[[PlaybackEvent], None]
+
+class EventBus:
+    """Synchronous publish/subscribe for PlaybackEvents
+
+    Handlers run on the thread that made the change, while it still holds
+    the guild's state lock, so they must be quick and must not block: hand
+    the event on (e.g. with subscribe_async()) rather than act on it there.
+    """
+
+    def __init__(self):
+        self._handlers: List[Handler] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, handler: Handler) -> Callable[[], None]:
+        """Call handler with every event from now on; returns a function that unsubscribes"""
+        with self._lock:
+            self._handlers = self._handlers + [handler]
+
+        def unsubscribe() -> None:
+            with self._lock:
+                self._handlers = [h for h in self._handlers if h is not handler]
+        return unsubscribe
+
+    def subscribe_async(self, loop: asyncio.AbstractEventLoop) -> Tuple[asyncio.Queue, Callable[[], None]]:
+        """An asyncio.Queue on loop that receives every event, and its unsubscribe function"""
+        queue = asyncio.Queue()
+
+        def handler(event: PlaybackEvent) -> None:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                pass  # loop already closed
+        return queue, self.subscribe(handler)
+
+    def publish(self, event: PlaybackEvent) -> None:
+        """Hand event to every handler; a failing handler doesn't stop the others"""
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Error in {event.type} event handler")
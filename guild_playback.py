@@ -0,0 +1,157 @@
+"""
+GuildPlayback - Player state of one Discord server
+"""
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, List, Optional
+from models import Track
+from shuffle import Shuffle
+
+@dataclass(frozen=True)
+class PlaybackState:
+    """Immutable, versioned snapshot of one guild's player
+    
+    PlaylistManager replaces a guild's snapshot with a new one (a single
+    reference assignment) after every change, so a reader in any thread
+    sees one consistent state - the track always belongs to the playlist
+    and index next to it - without taking a lock. A later snapshot always
+    has a higher version, even across eviction and restore.
+    """
+    guild_id: int
+    version: int = 0
+    playlist: Optional[str] = None
+    playlist_guild_id: int = 0
+    track_index: int = 0
+    current_track: Optional[Track] = None
+    is_playing: bool = False
+    is_paused: bool = False
+    volume: int = 100
+    repeat_mode: str = "none"
+    shuffle_mode: str = "off"
+    queue_length: int = 0
+    
+    def to_dict(self) -> dict:
+        """Convert state to dictionary for JSON serialization"""
+        return {
+            "guild_id": self.guild_id,
+            "version": self.version,
+            "playlist": self.playlist,
+            "playlist_guild_id": self.playlist_guild_id,
+            "track_index": self.track_index,
+            "current_track": self.current_track.to_dict() if self.current_track else None,
+            "is_playing": self.is_playing,
+            "is_paused": self.is_paused,
+            "volume": self.volume,
+            "repeat_mode": self.repeat_mode,
+            "shuffle_mode": self.shuffle_mode,
+            "queue_length": self.queue_length
+        }
+
+@dataclass
+class GuildPlayback:
+    """Current playlist, position, volume, repeat and shuffle mode of one guild
+
+    PlaylistManager keeps one per guild, created on first use and dropped
+    again once the guild has been idle for a while. The playlist is owned
+    by playlist_guild_id: the guild itself, or 0 for a shared playlist.
+    Queued tracks play before the playlist moves on; queued_track is the
+    one taken off the queue and playing now. Hold lock while reading or
+    changing more than one field; readers that don't want to lock use
+    snapshot, the PlaybackState published after the last change.
+    """
+    guild_id: int
+    playlist: Optional[str] = None
+    playlist_guild_id: int = 0
+    track_index: int = 0
+    is_playing: bool = False
+    is_paused: bool = False
+    volume: int = 100
+    repeat_mode: str = "none"  # none, one, all
+    shuffle: Optional[Shuffle] = None  # None when not shuffling
+    queue: Deque[Track] = field(default_factory=deque)
+    queued_track: Optional[Track] = None
+    queue_dirty: bool = False  # changed since the last checkpoint
+    last_active: float = field(default_factory=time.monotonic)
+    snapshot: Optional[PlaybackState] = field(default=None, repr=False, compare=False)
+    pending_events: list = field(default_factory=list, repr=False, compare=False)  # sent with the next snapshot
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    @classmethod
+    def restore(cls, guild_id: int, saved: Optional[dict], queue: List[Track] = ()) -> 'GuildPlayback':
+        """State from Database.get_guild_playback() and get_play_queue(), stopped"""
+        if saved is None:
+            return cls(guild_id, queue=deque(queue))
+        playlist = saved['playlist']
+        return cls(
+            guild_id,
+            playlist=playlist,
+            playlist_guild_id=saved['playlist_guild_id'] if playlist is not None else 0,
+            track_index=saved['track_index'] if playlist is not None else 0,
+            volume=saved['volume'],
+            repeat_mode=saved['repeat_mode'],
+            shuffle=Shuffle(saved['shuffle_mode'], saved['shuffle_seed'], saved['shuffle_cursor'])
+            if saved['shuffle_mode'] != 'off' else None,
+            queue=deque(queue)
+        )
+
+    def touch(self) -> None:
+        """Mark the guild as in use now"""
+        self.last_active = time.monotonic()
+
+    def is_idle(self, timeout: float, now: Optional[float] = None) -> bool:
+        """Whether nothing is playing and the state has not been used for timeout seconds"""
+        now = time.monotonic() if now is None else now
+        return (not self.is_playing and not self.is_paused and not self.queue_dirty
+                and now - self.last_active >= timeout)
+
+    def is_current(self, playlist_name: str, playlist_guild_id: int) -> bool:
+        """Whether this guild is on the given playlist"""
+        return self.playlist == playlist_name and self.playlist_guild_id == playlist_guild_id
+
+    @property
+    def shuffle_mode(self) -> str:
+        """off, on or weighted"""
+        return self.shuffle.mode if self.shuffle is not None else "off"
+
+    def queue_snapshot(self) -> List[Track]:
+        """What to checkpoint: the playing queued track (so a restart replays it) and the queue"""
+        return ([self.queued_track] if self.queued_track is not None else []) + list(self.queue)
+
+    def freeze(self, version: int, current_track: Optional[Track]) -> PlaybackState:
+        """A PlaybackState of the fields as they are now"""
+        return PlaybackState(
+            guild_id=self.guild_id,
+            version=version,
+            playlist=self.playlist,
+            playlist_guild_id=self.playlist_guild_id,
+            track_index=self.track_index,
+            current_track=current_track,
+            is_playing=self.is_playing,
+            is_paused=self.is_paused,
+            volume=self.volume,
+            repeat_mode=self.repeat_mode,
+            shuffle_mode=self.shuffle_mode,
+            queue_length=len(self.queue)
+        )
+    
+    def stop(self) -> None:
+        """Clear the playing and paused flags"""
+        self.is_playing = False
+        self.is_paused = False
+
+    def to_dict(self) -> dict:
+        """Convert state to dictionary for JSON serialization"""
+        return {
+            "guild_id": self.guild_id,
+            "playlist": self.playlist,
+            "playlist_guild_id": self.playlist_guild_id,
+            "track_index": self.track_index,
+            "is_playing": self.is_playing,
+            "is_paused": self.is_paused,
+            "volume": self.volume,
+            "repeat_mode": self.repeat_mode,
+            "shuffle_mode": self.shuffle_mode,
+            "queue_length": len(self.queue)
+        }
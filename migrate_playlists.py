@@ -7,7 +7,6 @@ import json
 import dotenv
 from database import Database
 from models import Track, Playlist
-import sqlite3
 import yt_dlp
 from mutagen import File
 from mutagen.easyid3 import EasyID3
@@ -273,43 +272,34 @@ def migrate_playlists():
         db = Database()
         
         # Track migration stats
-        total_playlists = 0
-        total_tracks = 0
         total_failed = 0
+        playlists = []
         
-        # Migrate each playlist
+        # Read and resolve metadata for each playlist
         for playlist_file in sorted(playlist_files):
             logger.info(f"\nProcessing playlist: {playlist_file.name}")
             
             playlist, failed_tracks = process_playlist(playlist_file)
+            total_failed += failed_tracks
             if playlist is None:
                 continue
                 
-            # Try to add the playlist
-            try:
-                logger.info(f"Adding playlist {playlist.name} with {len(playlist.tracks)} tracks to database")
-                db.add_playlist(playlist)
-                total_playlists += 1
-                total_tracks += len(playlist.tracks)
-                total_failed += failed_tracks
-                logger.info(f"Successfully migrated playlist {playlist.name}")
-                logger.info(f"- Total tracks: {len(playlist.tracks)}")
-                logger.info(f"- Failed tracks: {failed_tracks}")
-                
-            except sqlite3.IntegrityError:
-                logger.warning(f"Playlist {playlist.name} already exists, updating instead")
-                db.update_playlist(playlist)
-                total_playlists += 1
-                total_tracks += len(playlist.tracks)
-                total_failed += failed_tracks
-                logger.info(f"Successfully updated playlist {playlist.name}")
-                logger.info(f"- Total tracks: {len(playlist.tracks)}")
-                logger.info(f"- Failed tracks: {failed_tracks}")
+            logger.info(f"Prepared playlist {playlist.name}")
+            logger.info(f"- Total tracks: {len(playlist.tracks)}")
+            logger.info(f"- Failed tracks: {failed_tracks}")
+            playlists.append(playlist)
+        
+        # Write everything in one transaction; existing playlists are replaced
+        logger.info(f"Importing {len(playlists)} playlists into database")
+        stats = db.bulk_import_playlists(playlists)
+        total_playlists = stats['playlists']
+        total_tracks = stats['tracks']
         
         logger.info("\nMigration Summary:")
         logger.info(f"- Total playlists processed: {total_playlists}")
         logger.info(f"- Total tracks migrated: {total_tracks}")
         logger.info(f"- Total failed tracks: {total_failed}")
+        logger.info(f"- Import time: {stats['seconds']:.2f}s ({stats['rows_per_sec']:,.0f} rows/sec)")
         
     except Exception as e:
         logger.error(f"Migration failed: {e}")
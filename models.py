@@ -1,20 +1,92 @@
 """
 Models for Beathoven music bot
 """
+import sys
+from array import array
+from collections import Counter
+from collections.abc import Sequence
 from dataclasses import dataclass, field
-from typing import List, Optional
-from datetime import datetime
+from itertools import chain, compress
+from typing import Callable, Dict, Iterable, List, Optional
+from datetime import datetime, timedelta
+
+# Naive timestamps are kept as integer microseconds since this instant:
+# exact, and a fraction of the size of a datetime object
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_NOW = object()  # Track(added_at=...) default: the time of creation
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    """Shared copy of a string that many tracks repeat"""
+    return sys.intern(value) if type(value) is str else value
 
-@dataclass
 class Track:
-    """Model representing a music track"""
-    title: str
-    url: str
-    duration: Optional[int] = None  # Duration in seconds
-    type: str = "youtube"  # youtube, spotify, local, etc.
-    added_at: datetime = field(default_factory=datetime.now)
-    artist: Optional[str] = None
-    thumbnail_url: Optional[str] = None
+    """Model representing a music track
+    
+    Libraries load hundreds of thousands of these, so a Track has
+    __slots__ instead of a __dict__, shares one copy of each type and
+    artist string, and holds added_at as an integer that only becomes a
+    datetime when read. Its ISO text is made once, on first use, and kept
+    until added_at changes, so encoding the same track again is free. It
+    otherwise behaves like the dataclass it replaced: same constructor,
+    fields, equality and repr.
+    """
+    __slots__ = ('title', 'url', 'duration', 'type', '_added_at', '_added_at_iso', 'artist', 'thumbnail_url')
+    _fields = ('title', 'url', 'duration', 'type', 'added_at', 'artist', 'thumbnail_url')
+    
+    def __init__(self, title: str, url: str, duration: Optional[int] = None, type: str = "youtube",
+                 added_at: Optional[datetime] = _NOW, artist: Optional[str] = None,
+                 thumbnail_url: Optional[str] = None):
+        self.title = title
+        self.url = url
+        self.duration = duration  # Duration in seconds
+        self.type = _intern(type)  # youtube, spotify, local, etc.
+        self.added_at = datetime.now() if added_at is _NOW else added_at
+        self.artist = _intern(artist)
+        self.thumbnail_url = thumbnail_url
+    
+    @property
+    def added_at(self) -> Optional[datetime]:
+        value = self._added_at
+        if type(value) is int:
+            return _EPOCH + value * _MICROSECOND
+        return value  # None, or a timezone-aware datetime kept as is
+    
+    @added_at.setter
+    def added_at(self, value: Optional[datetime]) -> None:
+        if isinstance(value, datetime) and value.tzinfo is None:
+            value = (value - _EPOCH) // _MICROSECOND
+        self._added_at = value
+        self._added_at_iso = None
+    
+    @property
+    def added_at_iso(self) -> Optional[str]:
+        """added_at as ISO 8601 text (cached)"""
+        text = self._added_at_iso
+        if text is None and self._added_at is not None:
+            text = self._added_at_iso = self.added_at.isoformat()
+        return text
+    
+    def set_added_at_iso(self, text: str) -> None:
+        """Set added_at from ISO text, keeping the text if it is what added_at_iso would give"""
+        value = datetime.fromisoformat(text)
+        self.added_at = value
+        if value.tzinfo is None and len(text) == (26 if value.microsecond else 19) and text[10] == 'T':
+            self._added_at_iso = text
+    
+    def _key(self) -> tuple:
+        return (self.title, self.url, self.duration, self.type, self._added_at, self.artist, self.thumbnail_url)
+    
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() == other._key()
+    
+    __hash__ = None  # mutable, like a non-frozen dataclass
+    
+    def __repr__(self) -> str:
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self._fields)
+        return f"{self.__class__.__name__}({fields})"
     
     def to_dict(self) -> dict:
         """Convert track to dictionary for JSON serialization"""
@@ -23,7 +95,7 @@ class Track:
             "url": self.url,
             "duration": self.duration,
             "type": self.type,
-            "added_at": self.added_at.isoformat(),
+            "added_at": self.added_at_iso,
             "artist": self.artist,
             "thumbnail_url": self.thumbnail_url
         }
@@ -31,9 +103,14 @@ class Track:
     @classmethod
     def from_dict(cls, data: dict) -> 'Track':
         """Create track from dictionary"""
-        if "added_at" in data and isinstance(data["added_at"], str):
-            data["added_at"] = datetime.fromisoformat(data["added_at"])
-        return cls(**data)
+        added_at = data.get("added_at")
+        if not isinstance(added_at, str):
+            return cls(**data)
+        data = dict(data)  # leave the caller's dict alone
+        del data["added_at"]
+        track = cls(**data)
+        track.set_added_at_iso(added_at)
+        return track
 
 @dataclass
 class Playlist:
@@ -44,6 +121,7 @@ class Playlist:
     description: str = ""
     created_at: datetime = field(default_factory=datetime.now)
     modified_at: datetime = field(default_factory=datetime.now)
+    guild_id: int = 0  # Discord server owning the playlist; 0 for shared
     
     def add_track(self, track: Track) -> None:
         """Add track to playlist"""
@@ -80,12 +158,14 @@ class Playlist:
             "type": self.type,
             "description": self.description,
             "created_at": self.created_at.isoformat(),
-            "modified_at": self.modified_at.isoformat()
+            "modified_at": self.modified_at.isoformat(),
+            "guild_id": self.guild_id
         }
     
     @classmethod
     def from_dict(cls, data: dict) -> 'Playlist':
         """Create playlist from dictionary"""
+        data = dict(data)  # leave the caller's dict alone
         tracks_data = data.pop("tracks", [])
         if "created_at" in data and isinstance(data["created_at"], str):
             data["created_at"] = datetime.fromisoformat(data["created_at"])
@@ -95,3 +175,233 @@ class Playlist:
         playlist = cls(**data)
         playlist.tracks = [Track.from_dict(track) for track in tracks_data]
         return playlist
+
+class LazyTrackList(Sequence):
+    """Read-only track sequence that fetches fixed-size pages on demand
+    
+    fetch_page(offset, limit) must return the tracks in that window.
+    Fetched pages are kept, so repeated access to nearby indexes is free.
+    """
+    
+    def __init__(self, length: int, fetch_page: Callable[[int, int], List[Track]], page_size: int = 100):
+        self._length = length
+        self._fetch_page = fetch_page
+        self._page_size = page_size
+        self._pages: Dict[int, List[Track]] = {}
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def _page(self, page_no: int) -> List[Track]:
+        page = self._pages.get(page_no)
+        if page is None:
+            page = self._fetch_page(page_no * self._page_size, self._page_size)
+            self._pages[page_no] = page
+        return page
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("track index out of range")
+        page = self._page(index // self._page_size)
+        offset = index % self._page_size
+        if offset >= len(page):
+            # The playlist shrank underneath us
+            raise IndexError("track index out of range")
+        return page[offset]
+    
+    def __iter__(self):
+        for page_no in range((self._length + self._page_size - 1) // self._page_size):
+            yield from self._page(page_no)
+
+@dataclass
+class LazyPlaylist(Playlist):
+    """Playlist whose tracks are a LazyTrackList loaded page by page
+    
+    The track sequence is read-only; edit through PlaylistManager instead.
+    """
+    tracks: LazyTrackList = field(default_factory=lambda: LazyTrackList(0, lambda offset, limit: []))
+
+class PlaylistColumns:
+    """Read-only columnar view of a playlist's tracks, for listing and totals
+
+    Instead of Track objects it keeps parallel arrays - durations, play
+    counts and type codes (indexes into type_names) - and one UTF-8 string
+    table holding every title and URL, located by offsets. Totals, filters
+    and slices work on the arrays and share the string table; strings are
+    decoded only for the rows actually rendered.
+    """
+
+    def __init__(self, durations: array, play_counts: array, type_codes: array,
+                 type_names: List[str], offsets: array, strings: bytes):
+        self.durations = durations      # seconds, 0 if unknown
+        self.play_counts = play_counts
+        self.type_codes = type_codes    # index into type_names
+        self.type_names = type_names
+        # Per track: start of title, start of URL, end of URL in strings
+        self._offsets = offsets
+        self._strings = strings
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> 'PlaylistColumns':
+        """Build from (title, url, duration, type, play_count) rows, such as a sqlite3 cursor
+
+        Titles and URLs may be str or UTF-8 bytes (SELECT CAST(title AS BLOB)
+        skips creating str objects altogether).
+        """
+        durations, play_counts = array('l'), array('l')
+        type_codes, offsets = array('H'), array('q')
+        codes: Dict[str, int] = {}
+        chunks = []
+        position = 0
+        for title, url, duration, ttype, plays in rows:
+            if type(title) is str:
+                title = title.encode()
+            if type(url) is str:
+                url = url.encode()
+            offsets.append(position)
+            position += len(title)
+            offsets.append(position)
+            position += len(url)
+            offsets.append(position)
+            chunks.append(title)
+            chunks.append(url)
+            durations.append(duration or 0)
+            play_counts.append(plays or 0)
+            code = codes.get(ttype)
+            if code is None:
+                code = codes[ttype] = len(codes)
+            type_codes.append(code)
+        return cls(durations, play_counts, type_codes, list(codes), offsets, b''.join(chunks))
+
+    def __len__(self) -> int:
+        return len(self.durations)
+
+    def title(self, index: int) -> str:
+        start, end = self._offsets[3 * index], self._offsets[3 * index + 1]
+        return self._strings[start:end].decode()
+
+    def url(self, index: int) -> str:
+        start, end = self._offsets[3 * index + 1], self._offsets[3 * index + 2]
+        return self._strings[start:end].decode()
+
+    def type(self, index: int) -> str:
+        return self.type_names[self.type_codes[index]]
+
+    def total_duration(self) -> int:
+        """Sum of track durations in seconds"""
+        return sum(self.durations)
+
+    def type_counts(self) -> Dict[str, int]:
+        """Number of tracks of each type"""
+        counts = Counter(self.type_codes)
+        return {name: counts[code] for code, name in enumerate(self.type_names) if counts[code]}
+
+    def take(self, indexes: Iterable[int]) -> 'PlaylistColumns':
+        """The tracks at indexes, in that order, sharing this view's string table"""
+        indexes = list(indexes)
+        offsets = self._offsets
+        return PlaylistColumns(
+            array('l', [self.durations[i] for i in indexes]),
+            array('l', [self.play_counts[i] for i in indexes]),
+            array('H', [self.type_codes[i] for i in indexes]),
+            self.type_names,
+            array('q', chain.from_iterable(offsets[3 * i:3 * i + 3] for i in indexes)),
+            self._strings
+        )
+
+    def filter(self, type: Optional[str] = None, min_duration: Optional[int] = None,
+               max_duration: Optional[int] = None, min_plays: Optional[int] = None) -> 'PlaylistColumns':
+        """The tracks matching every given condition, in order"""
+        keep = [True] * len(self)
+        if type is not None:
+            if type not in self.type_names:
+                return self.take([])
+            code = self.type_names.index(type)
+            keep = [k and c == code for k, c in zip(keep, self.type_codes)]
+        if min_duration is not None:
+            keep = [k and d >= min_duration for k, d in zip(keep, self.durations)]
+        if max_duration is not None:
+            keep = [k and d <= max_duration for k, d in zip(keep, self.durations)]
+        if min_plays is not None:
+            keep = [k and p >= min_plays for k, p in zip(keep, self.play_counts)]
+        return self.take(compress(range(len(self)), keep))
+
+    def __getitem__(self, index: slice) -> 'PlaylistColumns':
+        """A contiguous range of tracks (slices only), sharing this view's string table"""
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            return self.take(range(start, stop, step))
+        return PlaylistColumns(self.durations[start:stop], self.play_counts[start:stop],
+                               self.type_codes[start:stop], self.type_names,
+                               self._offsets[3 * start:3 * stop], self._strings)
+
+    def to_dicts(self) -> List[dict]:
+        """Rows for JSON serialization (title, url, duration, type, play_count)"""
+        return [{
+            "title": self.title(i),
+            "url": self.url(i),
+            "duration": self.durations[i],
+            "type": self.type_names[self.type_codes[i]],
+            "play_count": self.play_counts[i]
+        } for i in range(len(self))]
+
+@dataclass
+class PlaylistSummary:
+    """Lightweight playlist listing entry (no tracks loaded)"""
+    name: str
+    type: str = "local"
+    description: str = ""
+    track_count: int = 0
+    total_duration: int = 0  # Sum of track durations in seconds
+    created_at: Optional[datetime] = None
+    modified_at: Optional[datetime] = None
+    guild_id: int = 0
+    
+    def to_dict(self) -> dict:
+        """Convert summary to dictionary for JSON serialization"""
+        return {
+            "name": self.name,
+            "type": self.type,
+            "description": self.description,
+            "track_count": self.track_count,
+            "total_duration": self.total_duration,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "modified_at": self.modified_at.isoformat() if self.modified_at else None,
+            "guild_id": self.guild_id
+        }
+
+@dataclass
+class SearchResult:
+    """Track matched by a library search, with the playlists containing it"""
+    track: Track
+    playlists: List[str] = field(default_factory=list)
+    rank: float = 0.0  # bm25 score, lower is a better match
+    
+    def to_dict(self) -> dict:
+        """Convert search result to dictionary for JSON serialization"""
+        return {
+            "track": self.track.to_dict(),
+            "playlists": self.playlists,
+            "rank": self.rank
+        }
+
+@dataclass
+class TrackStats:
+    """Play totals for one track over a time range, read from the rollups"""
+    track: Track
+    plays: int = 0
+    skips: int = 0
+    seconds_played: int = 0
+    
+    def to_dict(self) -> dict:
+        """Convert track stats to dictionary for JSON serialization"""
+        return {
+            "track": self.track.to_dict(),
+            "plays": self.plays,
+            "skips": self.skips,
+            "seconds_played": self.seconds_played
+        }
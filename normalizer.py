@@ -0,0 +1,79 @@
+"""
+Canonical keys for track URLs, so one song is one row however it was linked
+"""
+import os
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qs, unquote
+
+YOUTUBE_HOSTS = {
+    'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com',
+    'youtube-nocookie.com', 'www.youtube-nocookie.com'
+}
+YOUTUBE_SHORT_HOSTS = {'youtu.be', 'www.youtu.be'}
+YOUTUBE_ID = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def youtube_id(url: str) -> str:
+    """The 11 character video id of a YouTube link, or '' if it is not one"""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return ''
+    host = (parts.hostname or '').lower()
+    path = parts.path.split('/')
+
+    candidate = ''
+    if host in YOUTUBE_SHORT_HOSTS:
+        candidate = path[1] if len(path) > 1 else ''
+    elif host in YOUTUBE_HOSTS:
+        if parts.path == '/watch':
+            candidate = parse_qs(parts.query).get('v', [''])[0]
+        elif len(path) > 2 and path[1] in ('embed', 'shorts', 'v', 'live'):
+            candidate = path[2]
+    return candidate if YOUTUBE_ID.match(candidate) else ''
+
+def normalize_path(path: str) -> str:
+    """Collapse redundant separators and ./.. in a local path or file:// URL"""
+    if path.startswith('file://'):
+        path = unquote(urlsplit(path).path)
+    return os.path.normpath(os.path.expanduser(path))
+
+def normalize_url(url: str) -> str:
+    """Lower-case scheme and host, drop default ports and fragments"""
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    if parts.username:
+        host = f'{parts.username}@{host}'
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+def canonical_key(url: str, track_type: str) -> str:
+    """Key shared by every spelling of the same track
+
+    YouTube links reduce to their video id, local files to a normalised
+    path, and other URLs (radio streams and the like) to a normalised URL
+    qualified by track type.
+    """
+    video = youtube_id(url) if 'youtu' in url else ''
+    if video:
+        return f'youtube:{video}'
+    if url.startswith('file://') or '://' not in url and (track_type == 'local' or url.startswith(('/', '~'))):
+        return f'local:{normalize_path(url)}'
+    if '://' in url:
+        return f'{track_type}:{normalize_url(url)}'
+    return f'{track_type}:{url.strip()}'
+
+def guess_track_type(url: str) -> str:
+    """Track type for a bare link or path: youtube, local or radio"""
+    if 'youtu' in url and youtube_id(url):
+        return 'youtube'
+    if url.startswith('file://') or '://' not in url:
+        return 'local'
+    return 'radio'
@@ -0,0 +1,80 @@
+"""
+PlaylistCache - Bounded LRU cache of decoded playlists
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+class PlaylistCache:
+    """Read-through LRU cache of Playlist objects keyed by (guild id, name)
+
+    Entries are dropped by explicit invalidate() calls for our own writes,
+    and wholesale whenever version() reports a change - PlaylistManager
+    passes Database.data_version, which moves on any commit from another
+    connection or process. Database caches smart playlist results the same
+    way, so values need not be playlists; only None is never cached.
+    """
+
+    def __init__(self, max_size: int, version: Callable[[], int]):
+        self.max_size = max_size
+        self._version = version
+        self._seen_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value, calling loader() on a miss"""
+        version = self._version()
+        with self._lock:
+            if version != self._seen_version:
+                if self._entries:
+                    logger.debug("Database changed, clearing playlist cache")
+                self._entries.clear()
+                self._seen_version = version
+            playlist = self._entries.get(key)
+            if playlist is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return playlist
+            self.misses += 1
+
+        playlist = loader()
+        if playlist is None:
+            return None
+
+        with self._lock:
+            # Don't cache a load that raced with a change to the database
+            if self._seen_version == version:
+                self._entries[key] = playlist
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return playlist
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one playlist, or everything if key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
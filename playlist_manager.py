@@ -2,15 +2,41 @@
 PlaylistManager - Handles playlist operations and state management
 """
 import os
+import time
 import logging
-from typing import Dict, List, Optional
+import threading
+from contextlib import contextmanager
+from itertools import count, islice
+from typing import Callable, Dict, Iterator, List, Optional
 import dotenv
-from models import Playlist, Track
+from models import Playlist, PlaylistColumns, PlaylistSummary, SearchResult, Track
 from datetime import datetime
 from database import Database
+from normalizer import canonical_key
+from playlist_cache import PlaylistCache
+from guild_playback import GuildPlayback, PlaybackState
+from events import (EventBus, PlaybackEvent, PlayStateChanged, QueueChanged, RepeatChanged,
+                    ShuffleChanged, TrackChanged, VolumeChanged)
+from shuffle import SHUFFLE_MODES, Shuffle, play_weight
+from smart_playlist import SmartRule
 
 logger = logging.getLogger(__name__)
 
+# Number of decoded playlists kept in memory between requests
+PLAYLIST_CACHE_SIZE = int(os.getenv('BEATHOVEN_PLAYLIST_CACHE_SIZE', 32))
+
+# Seconds a stopped guild's player state stays in memory after last use
+GUILD_IDLE_TIMEOUT = float(os.getenv('BEATHOVEN_GUILD_IDLE_TIMEOUT', 3600))
+
+# Hours after being played during which weighted shuffle holds a track back
+SHUFFLE_COOLDOWN_HOURS = float(os.getenv('BEATHOVEN_SHUFFLE_COOLDOWN_HOURS', 24))
+
+# Most tracks a guild can have queued
+QUEUE_MAX_LENGTH = int(os.getenv('BEATHOVEN_QUEUE_MAX_LENGTH', 500))
+
+# Seconds between checkpoints of changed queues to the database
+QUEUE_CHECKPOINT_INTERVAL = float(os.getenv('BEATHOVEN_QUEUE_CHECKPOINT_SECONDS', 30))
+
 class PlaylistManager:
     _instance = None
     
@@ -29,33 +55,270 @@ class PlaylistManager:
         # Load environment variables
         dotenv.load_dotenv()
         
-        # Initialize database
+        # Initialize database; sharded guilds get their own file via _db()
         self.db = Database()
+        self._caches: Dict[str, PlaylistCache] = {}
+        
+        # Player state per guild, created on first use (see playback())
+        self._guilds: Dict[int, GuildPlayback] = {}
+        self._guilds_lock = threading.Lock()
         
-        # State
-        self.current_playlist: Optional[str] = None
-        self.current_track_index: int = 0
-        self.is_playing: bool = False
-        self.is_paused: bool = False
-        self.volume: int = 100
-        self.repeat_mode: str = "none"  # none, one, all
+        # Player state changes, for the bot and web UI to follow
+        self.events = EventBus()
+        self._versions = count(1)  # PlaybackState versions, shared by all guilds
         
         # Check for playlists to migrate
         playlist_dir = os.getenv('PLAYLIST_DIR')
         if playlist_dir and os.path.exists(playlist_dir):
             self.db.migrate_from_files(playlist_dir)
     
-    def get_all_playlists(self) -> List[Playlist]:
-        """Get all playlists"""
-        return self.db.get_all_playlists()
+    def _db(self, guild_id: int) -> Database:
+        """Database holding a guild's playlists (its shard, if it has one)"""
+        return self.db if guild_id == 0 else Database.for_guild(guild_id)
+    
+    def _cache(self, guild_id: int) -> PlaylistCache:
+        """Playlist cache of the database holding a guild's playlists"""
+        db = self._db(guild_id)
+        cache = self._caches.get(db.db_path)
+        if cache is None:
+            cache = self._caches.setdefault(db.db_path, PlaylistCache(PLAYLIST_CACHE_SIZE, db.data_version))
+        return cache
+    
+    def playback(self, guild_id: int = 0) -> GuildPlayback:
+        """A guild's player state, restored from its last saved state on first use"""
+        state = self._guilds.get(guild_id)
+        if state is None:
+            db = self._db(guild_id)
+            loaded = GuildPlayback.restore(guild_id, db.get_guild_playback(guild_id), db.get_play_queue(guild_id))
+            loaded.snapshot = loaded.freeze(next(self._versions), self._current_track(loaded))
+            with self._guilds_lock:
+                state = self._guilds.setdefault(guild_id, loaded)
+        state.touch()
+        return state
+    
+    def snapshot(self, guild_id: int = 0) -> PlaybackState:
+        """A guild's latest PlaybackState, consistent and safe to read from any thread"""
+        return self.playback(guild_id).snapshot
+    
+    @contextmanager
+    def _changing(self, state: GuildPlayback) -> Iterator[GuildPlayback]:
+        """Hold a guild's state lock while changing it, then publish the result
+        
+        Every change to player state goes through here, so writers from the
+        web UI's threads and the bot's DB thread are serialised per guild.
+        """
+        with state.lock:
+            try:
+                yield state
+            finally:
+                self._publish(state)
+    
+    def _publish(self, state: GuildPlayback) -> None:
+        """Swap in a new snapshot if the state changed, then send the events of the change"""
+        current_track = self._current_track(state)
+        old = state.snapshot
+        if old is None or state.freeze(old.version, current_track) != old:
+            # One reference assignment: readers see the old snapshot or the new one
+            state.snapshot = state.freeze(next(self._versions), current_track)
+        events, state.pending_events = state.pending_events, []
+        for event in events:
+            self.events.publish(event)
+    
+    def _notify(self, state: GuildPlayback, event: PlaybackEvent) -> None:
+        """Send event once the change being made to state is published"""
+        state.pending_events.append(event)
     
-    def get_playlist(self, name: str) -> Optional[Playlist]:
-        """Get a playlist by name"""
-        return self.db.get_playlist(name)
+    def playbacks(self) -> List[GuildPlayback]:
+        """Player states of all guilds currently in memory"""
+        with self._guilds_lock:
+            return list(self._guilds.values())
+    
+    def evict_idle(self, timeout: float = GUILD_IDLE_TIMEOUT) -> int:
+        """Drop player states of guilds stopped and unused for timeout seconds
+        
+        Their state is already saved, so the next playback() call restores it.
+        """
+        now = time.monotonic()
+        with self._guilds_lock:
+            idle = [guild_id for guild_id, state in self._guilds.items() if state.is_idle(timeout, now)]
+            for guild_id in idle:
+                del self._guilds[guild_id]
+        if idle:
+            logger.debug(f"Evicted player state of {len(idle)} idle guild(s)")
+        return len(idle)
+    
+    def enqueue(self, track: Track, guild_id: int = 0, front: bool = False) -> Optional[int]:
+        """Queue a track to play before the playlist moves on
+        
+        front puts it next in line. Returns its 0-based queue position, or
+        None if the queue is full.
+        """
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if len(state.queue) >= QUEUE_MAX_LENGTH:
+                return None
+            if front:
+                state.queue.appendleft(track)
+            else:
+                state.queue.append(track)
+            state.queue_dirty = True
+            self._notify(state, QueueChanged(guild_id, len(state.queue)))
+            return 0 if front else len(state.queue) - 1
+    
+    def get_queue(self, guild_id: int = 0, offset: int = 0, limit: int = 10) -> List[Track]:
+        """One page of a guild's queue"""
+        state = self.playback(guild_id)
+        with state.lock:
+            return list(islice(state.queue, max(offset, 0), max(offset, 0) + max(limit, 0)))
+    
+    def queue_length(self, guild_id: int = 0) -> int:
+        """Number of tracks in a guild's queue"""
+        return len(self.playback(guild_id).queue)
+    
+    def remove_from_queue(self, index: int, guild_id: int = 0) -> Optional[Track]:
+        """Take the track at a 0-based queue position out of the queue"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if not 0 <= index < len(state.queue):
+                return None
+            track = state.queue[index]
+            del state.queue[index]
+            state.queue_dirty = True
+            self._notify(state, QueueChanged(guild_id, len(state.queue)))
+            return track
+    
+    def clear_queue(self, guild_id: int = 0) -> int:
+        """Empty a guild's queue, returning how many tracks were removed"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            removed = len(state.queue)
+            state.queue.clear()
+            state.queue_dirty = True
+            if removed:
+                self._notify(state, QueueChanged(guild_id, 0))
+            return removed
+    
+    def checkpoint_queues(self) -> int:
+        """Save every queue changed since the last checkpoint, returning how many were saved"""
+        pending = {}  # db path -> (database, {guild id: tracks})
+        dirty = []
+        for state in self.playbacks():
+            with state.lock:
+                if not state.queue_dirty:
+                    continue
+                state.queue_dirty = False
+                snapshot = state.queue_snapshot()
+            dirty.append(state)
+            db = self._db(state.guild_id)
+            pending.setdefault(db.db_path, (db, {}))[1][state.guild_id] = snapshot
+        try:
+            for db, queues in pending.values():
+                db.save_play_queues(queues)
+        except Exception:
+            # Try again next time
+            for state in dirty:
+                state.queue_dirty = True
+            raise
+        return len(dirty)
+    
+    def _playing(self, playlist_name: str, owner_id: int) -> List[GuildPlayback]:
+        """Player states of guilds on a playlist"""
+        return [state for state in self.playbacks() if state.is_current(playlist_name, owner_id)]
+    
+    def _owner(self, name: str, guild_id: int) -> int:
+        """Guild owning the playlist a guild sees under name (0 if shared or missing)
+        
+        For reads only: writes go to the calling guild's own playlists.
+        """
+        playlist = self.get_playlist(name, guild_id)
+        return playlist.guild_id if playlist is not None else guild_id
     
-    def create_playlist(self, name: str, tracks: List[Track] = None, playlist_type: str = "local", description: str = "") -> Optional[Playlist]:
-        """Create a new playlist"""
-        if self.get_playlist(name):
+    def get_all_playlists(self, guild_id: int = 0) -> List[Playlist]:
+        """Get all of a guild's own playlists"""
+        return self._db(guild_id).get_all_playlists(guild_id)
+    
+    def get_playlist_summaries(self, guild_id: int = 0) -> List[PlaylistSummary]:
+        """Get track counts and durations of the playlists a guild sees, without loading tracks
+        
+        That is the guild's own playlists plus the shared (guild 0) ones
+        whose names it does not shadow.
+        """
+        own = self._db(guild_id).get_playlist_summaries(guild_id)
+        if guild_id == 0:
+            return own
+        names = {p.name for p in own}
+        shared = [p for p in self.db.get_playlist_summaries(0) if p.name not in names]
+        return sorted(own + shared, key=lambda p: p.name)
+    
+    def _guild_playlist(self, name: str, guild_id: int) -> Optional[Playlist]:
+        """A playlist owned by exactly this guild, through its database's cache"""
+        db = self._db(guild_id)
+        return self._cache(guild_id).get((guild_id, name), lambda: db.get_lazy_playlist(name, guild_id=guild_id))
+    
+    def get_playlist(self, name: str, guild_id: int = 0) -> Optional[Playlist]:
+        """Get a playlist by name (cached; tracks are loaded a page at a time)
+        
+        A guild's own playlist wins over a shared one of the same name; the
+        result's guild_id says which was found.
+        """
+        playlist = self._guild_playlist(name, guild_id)
+        if playlist is None and guild_id != 0:
+            playlist = self._guild_playlist(name, 0)
+        return playlist
+    
+    def get_playlist_columns(self, name: str, guild_id: int = 0) -> Optional[PlaylistColumns]:
+        """Get a playlist's tracks as columns, for listings and totals (cached like playlists)"""
+        owner_id = self._owner(name, guild_id)
+        db = self._db(owner_id)
+        # Not invalidated by name: every edit commits, which clears the whole cache
+        return self._cache(owner_id).get((owner_id, name, 'columns'),
+                                         lambda: db.get_playlist_columns(name, owner_id))
+    
+    def cache_stats(self) -> Dict:
+        """Hit/miss counters of the playlist caches, summed over databases"""
+        totals = {'size': 0, 'max_size': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        for cache in list(self._caches.values()):
+            for key, value in cache.stats().items():
+                if key in totals:
+                    totals[key] += value
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+        return totals
+    
+    def _track_at(self, name: str, index: int, owner_id: int = 0) -> Optional[Track]:
+        """Track at index in a cached playlist, or None if out of range"""
+        playlist = self._guild_playlist(name, owner_id)
+        if playlist is None or not 0 <= index < len(playlist.tracks):
+            return None
+        return playlist.tracks[index]
+    
+    def search_tracks(self, query: str, limit: int = 20, guild_id: Optional[int] = None) -> List[SearchResult]:
+        """Search the track library by title/artist prefix
+        
+        A sharded guild searches its shard and the shared library together,
+        merged by rank.
+        """
+        results = self.db.search_tracks(query, limit, guild_id)
+        shard = self._db(guild_id or 0)
+        if shard is self.db:
+            return results
+            
+        merged = {}
+        for result in shard.search_tracks(query, limit, guild_id) + results:
+            key = canonical_key(result.track.url, result.track.type)
+            found = merged.get(key)
+            if found is None:
+                merged[key] = result
+            else:
+                # In both: the shard's copy, listed under every playlist holding it
+                found.playlists = sorted(set(found.playlists) | set(result.playlists))
+                found.rank = min(found.rank, result.rank)
+        return sorted(merged.values(), key=lambda r: r.rank)[:limit]
+    
+    def create_playlist(self, name: str, tracks: List[Track] = None, playlist_type: str = "local",
+                        description: str = "", guild_id: int = 0) -> Optional[Playlist]:
+        """Create a new playlist (shadowing any shared one of the same name)"""
+        if self._guild_playlist(name, guild_id) is not None:
             return None
             
         playlist = Playlist(
@@ -64,180 +327,444 @@ class PlaylistManager:
             type=playlist_type,
             description=description,
             created_at=datetime.now(),
-            modified_at=datetime.now()
+            modified_at=datetime.now(),
+            guild_id=guild_id
         )
         
-        self.db.add_playlist(playlist)
+        self._db(guild_id).add_playlist(playlist)
+        self._cache(guild_id).invalidate((guild_id, name))
         return playlist
     
-    def delete_playlist(self, name: str) -> bool:
-        """Delete a playlist"""
-        if self.current_playlist == name:
-            self.current_playlist = None
-            self.current_track_index = 0
-            self.is_playing = False
-            self.is_paused = False
+    def create_smart_playlist(self, name: str, rule: SmartRule, description: str = "",
+                              guild_id: int = 0) -> Optional[Playlist]:
+        """Create a smart playlist: tracks are selected by rule each time it is loaded, not stored
+        
+        It draws on the tracks in the guild's own and the shared playlists
+        (only its own for a sharded guild), and can't be edited track by track.
+        """
+        if self._guild_playlist(name, guild_id) is not None:
+            return None
+            
+        self._db(guild_id).add_smart_playlist(name, rule, description, guild_id)
+        self._cache(guild_id).invalidate((guild_id, name))
+        return self._guild_playlist(name, guild_id)
+    
+    def delete_playlist(self, name: str, guild_id: int = 0) -> bool:
+        """Delete one of a guild's own playlists
+        
+        Like the track edits below, this never reaches a shared playlist
+        from another guild; the shared library is changed as guild 0.
+        """
+        for state in self._playing(name, guild_id):
+            with self._changing(state):
+                state.playlist = None
+                state.track_index = 0
+                self._set_play_state(state, False, False)
+                if state.queued_track is None:
+                    self._notify(state, TrackChanged(state.guild_id, None))
             
-        return self.db.delete_playlist(name)
+        deleted = self._db(guild_id).delete_playlist(name, guild_id)
+        self._cache(guild_id).invalidate((guild_id, name))
+        return deleted
     
-    def add_track(self, playlist_name: str, track: Track) -> bool:
+    def add_track(self, playlist_name: str, track: Track, guild_id: int = 0) -> bool:
         """Add track to playlist"""
-        playlist = self.get_playlist(playlist_name)
-        if not playlist:
+        added = self._db(guild_id).append_track(playlist_name, track, guild_id)
+        self._cache(guild_id).invalidate((guild_id, playlist_name))
+        return added
+    
+    def insert_track(self, playlist_name: str, index: int, track: Track, guild_id: int = 0) -> bool:
+        """Insert track into playlist before index"""
+        changed = self._db(guild_id).insert_track(playlist_name, index, track, guild_id)
+        self._cache(guild_id).invalidate((guild_id, playlist_name))
+        if not changed:
             return False
             
-        playlist.tracks.append(track)
-        return self.db.update_playlist(playlist)
+        for state in self._playing(playlist_name, guild_id):
+            with self._changing(state):
+                if index <= state.track_index:
+                    state.track_index += 1
+        return True
     
-    def remove_track(self, playlist_name: str, index: int) -> bool:
+    def remove_track(self, playlist_name: str, index: int, guild_id: int = 0) -> bool:
         """Remove track from playlist"""
-        playlist = self.get_playlist(playlist_name)
-        if not playlist or index >= len(playlist.tracks):
+        changed = self._db(guild_id).remove_track_at(playlist_name, index, guild_id)
+        self._cache(guild_id).invalidate((guild_id, playlist_name))
+        if not changed:
             return False
             
-        if self.current_playlist == playlist_name and index == self.current_track_index:
-            self.is_playing = False
-            self.is_paused = False
+        for state in self._playing(playlist_name, guild_id):
+            with self._changing(state):
+                if index == state.track_index:
+                    self._set_play_state(state, False, False)
+                elif index < state.track_index:
+                    state.track_index -= 1
+                    self._seek_shuffle(state)
             
-        playlist.tracks.pop(index)
-        return self.db.update_playlist(playlist)
+        return True
     
-    def move_track(self, playlist_name: str, old_index: int, new_index: int) -> bool:
+    def move_track(self, playlist_name: str, old_index: int, new_index: int, guild_id: int = 0) -> bool:
         """Move track within playlist"""
-        playlist = self.get_playlist(playlist_name)
-        if not playlist or old_index >= len(playlist.tracks) or new_index >= len(playlist.tracks):
+        changed = self._db(guild_id).move_track(playlist_name, old_index, new_index, guild_id)
+        self._cache(guild_id).invalidate((guild_id, playlist_name))
+        if not changed:
             return False
-            
-        track = playlist.tracks.pop(old_index)
-        playlist.tracks.insert(new_index, track)
-        
-        if self.current_playlist == playlist_name:
-            if old_index == self.current_track_index:
-                self.current_track_index = new_index
-            elif old_index < self.current_track_index <= new_index:
-                self.current_track_index -= 1
-            elif old_index > self.current_track_index >= new_index:
-                self.current_track_index += 1
+        
+        for state in self._playing(playlist_name, guild_id):
+            with self._changing(state):
+                if old_index == state.track_index:
+                    state.track_index = new_index
+                elif old_index < state.track_index <= new_index:
+                    state.track_index -= 1
+                elif old_index > state.track_index >= new_index:
+                    state.track_index += 1
+                else:
+                    continue
+                self._seek_shuffle(state)
                 
-        return self.db.update_playlist(playlist)
+        return True
     
-    def get_current_track(self) -> Optional[Track]:
-        """Get current track"""
-        if not self.current_playlist:
-            return None
+    def reorder_tracks(self, playlist_name: str, order: List[int], guild_id: int = 0) -> bool:
+        """Reorder playlist so new index i holds the track previously at order[i]"""
+        changed = self._db(guild_id).reorder_tracks(playlist_name, order, guild_id)
+        self._cache(guild_id).invalidate((guild_id, playlist_name))
+        if not changed:
+            return False
             
-        playlist = self.get_playlist(self.current_playlist)
-        if not playlist or not playlist.tracks:
+        for state in self._playing(playlist_name, guild_id):
+            with self._changing(state):
+                if state.track_index < len(order):
+                    state.track_index = order.index(state.track_index)
+        return True
+    
+    def _current_track(self, state: GuildPlayback) -> Optional[Track]:
+        """A guild's current track, looked up from its state (hold state.lock)"""
+        if state.queued_track is not None:
+            return state.queued_track
+        if not state.playlist:
             return None
             
-        if self.current_track_index >= len(playlist.tracks):
-            self.current_track_index = 0
-            
-        track = playlist.tracks[self.current_track_index]
-        self.db.update_track_play(track.url, track.type)
+        track = self._track_at(state.playlist, state.track_index, state.playlist_guild_id)
+        if track is None and state.track_index != 0:
+            # Index ran past the end (e.g. tracks were removed); start over
+            state.track_index = 0
+            track = self._track_at(state.playlist, 0, state.playlist_guild_id)
         return track
     
-    def set_current_playlist(self, name: str) -> bool:
-        """Set current playlist"""
-        if not self.get_playlist(name):
+    def get_current_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Get a guild's current track (from its snapshot, so without locking)"""
+        return self.snapshot(guild_id).current_track
+    
+    def record_play_event(self, track: Track, guild_id: int = 0, requester_id: Optional[int] = None,
+                          started_at: Optional[datetime] = None, duration_played: int = 0,
+                          skipped: bool = False) -> None:
+        """Log a finished or skipped play to the play history (buffered)"""
+        # History lives with the track rows: in the database of the playlist being played
+        state = self._guilds.get(guild_id)
+        owner_id = state.playlist_guild_id if state is not None and state.playlist else guild_id
+        self._db(owner_id).record_play_event(track.url, track.type, guild_id, requester_id,
+                                             started_at, duration_played, skipped,
+                                             track.title, track.artist)
+    
+    def get_tracks(self, name: str, offset: int = 0, limit: int = 100, guild_id: int = 0) -> List[Track]:
+        """Get one page of a playlist's tracks"""
+        guild_id = self._owner(name, guild_id)
+        return self._db(guild_id).get_tracks(name, offset, limit, guild_id)
+    
+    def get_track_count(self, name: str, guild_id: int = 0) -> Optional[int]:
+        """Number of tracks in a playlist, or None if it does not exist"""
+        playlist = self.get_playlist(name, guild_id)
+        return len(playlist.tracks) if playlist is not None else None
+    
+    def set_current_playlist(self, name: str, guild_id: int = 0) -> bool:
+        """Set a guild's current playlist"""
+        playlist = self.get_playlist(name, guild_id)
+        if playlist is None:
             return False
             
-        self.current_playlist = name
-        self.current_track_index = 0
-        self.is_playing = False
-        self.is_paused = False
+        state = self.playback(guild_id)
+        with self._changing(state):
+            state.playlist = name
+            state.playlist_guild_id = playlist.guild_id
+            state.track_index = 0
+            self._set_play_state(state, False, False)
+            if state.queued_track is not None:
+                state.queued_track = None
+                state.queue_dirty = True
+            if state.shuffle is not None:
+                # A new playlist gets a new order, starting anywhere in it
+                state.shuffle = Shuffle(state.shuffle.mode)
+                weight = self._shuffle_weight(state) if state.shuffle.weighted else None
+                state.track_index = state.shuffle.next(len(playlist.tracks), weight=weight) or 0
+            self._save_playback(state)
+            track = self._track_at(name, state.track_index, playlist.guild_id)
+            if track is not None:
+                self._db(playlist.guild_id).record_play(track.url, track.type)
+            self._notify(state, TrackChanged(guild_id, track))
         return True
     
-    def set_track_index(self, index: int) -> Optional[Track]:
-        """Set current track index"""
-        if not self.current_playlist:
-            return None
-            
-        playlist = self.get_playlist(self.current_playlist)
-        if not playlist or not playlist.tracks:
-            return None
-            
-        if 0 <= index < len(playlist.tracks):
-            self.current_track_index = index
-            return playlist.tracks[index]
-            
-        return None
+    def _save_playback(self, state: GuildPlayback) -> None:
+        """Persist a guild's playlist, position, volume, repeat and shuffle state (buffered)"""
+        shuffle = state.shuffle
+        self._db(state.guild_id).record_guild_playback(
+            state.guild_id, state.playlist, state.track_index,
+            state.volume, state.repeat_mode, state.playlist_guild_id,
+            state.shuffle_mode, shuffle.seed if shuffle else 0, shuffle.cursor if shuffle else -1)
+    
+    def set_track_index(self, index: int, guild_id: int = 0) -> Optional[Track]:
+        """Set a guild's current track index"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if not state.playlist or index < 0:
+                return None
+                
+            track = self._track_at(state.playlist, index, state.playlist_guild_id)
+            if track is not None:
+                state.track_index = index
+                self._seek_shuffle(state)
+                if state.queued_track is not None:
+                    state.queued_track = None
+                    state.queue_dirty = True
+                self._db(state.playlist_guild_id).record_play(track.url, track.type)
+                self._save_playback(state)
+                self._notify(state, TrackChanged(guild_id, track))
+            return track
+    
+    def _set_play_state(self, state: GuildPlayback, playing: bool, paused: bool) -> None:
+        """Set a guild's playing and paused flags, announcing any change"""
+        if (state.is_playing, state.is_paused) != (playing, paused):
+            state.is_playing, state.is_paused = playing, paused
+            self._notify(state, PlayStateChanged(state.guild_id, playing, paused))
     
-    def set_playing(self, playing: bool) -> None:
-        """Set playing state"""
-        self.is_playing = playing
-        if playing:
-            self.is_paused = False  # Can't be playing and paused
+    def set_playing(self, playing: bool, guild_id: int = 0) -> None:
+        """Set a guild's playing state"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            # Can't be playing and paused
+            self._set_play_state(state, playing, False if playing else state.is_paused)
             
-    def set_paused(self, paused: bool) -> None:
-        """Set paused state"""
-        self.is_paused = paused
-        if paused:
-            self.is_playing = False  # Can't be playing and paused
+    def set_paused(self, paused: bool, guild_id: int = 0) -> None:
+        """Set a guild's paused state"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            # Can't be playing and paused
+            self._set_play_state(state, False if paused else state.is_playing, paused)
             
-    def set_volume(self, volume: int) -> None:
-        """Set volume (0-100)"""
-        self.volume = max(0, min(100, volume))
+    def set_volume(self, volume: int, guild_id: int = 0) -> None:
+        """Set a guild's volume (0-100)"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            volume = max(0, min(100, volume))
+            if volume != state.volume:
+                state.volume = volume
+                self._save_playback(state)
+                self._notify(state, VolumeChanged(guild_id, volume))
         
-    def set_repeat_mode(self, mode: str) -> None:
-        """Set repeat mode (none, one, all)"""
+    def set_repeat_mode(self, mode: str, guild_id: int = 0) -> None:
+        """Set a guild's repeat mode (none, one, all)"""
         if mode in ["none", "one", "all"]:
-            self.repeat_mode = mode
+            state = self.playback(guild_id)
+            with self._changing(state):
+                if mode != state.repeat_mode:
+                    state.repeat_mode = mode
+                    self._save_playback(state)
+                    self._notify(state, RepeatChanged(guild_id, mode))
             
-    def _update_playback_state(self, track: Optional[Track] = None) -> Optional[Track]:
-        """Update playback state after track change"""
+    def set_shuffle(self, mode: str, guild_id: int = 0) -> bool:
+        """Set a guild's shuffle mode (off, on, weighted)
+        
+        Turning shuffle on draws a new order, which carries on from the
+        current track.
+        """
+        if mode not in SHUFFLE_MODES:
+            return False
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if mode == state.shuffle_mode:
+                return True
+            state.shuffle = Shuffle(mode) if mode != "off" else None
+            if state.shuffle is not None and state.playlist:
+                state.shuffle.seek(state.track_index,
+                                   self.get_track_count(state.playlist, state.playlist_guild_id) or 0)
+            self._save_playback(state)
+            self._notify(state, ShuffleChanged(guild_id, mode))
+        return True
+    
+    def _seek_shuffle(self, state: GuildPlayback) -> None:
+        """Put a shuffling guild's play order back on its current track index"""
+        if state.shuffle is not None:
+            state.shuffle.seek(state.track_index, self.get_track_count(state.playlist, state.playlist_guild_id) or 0)
+    
+    def _shuffle_weight(self, state: GuildPlayback) -> Callable[[int], float]:
+        """Weighted shuffle's chance of taking each index of a guild's playlist"""
+        db = self._db(state.playlist_guild_id)
+        now = datetime.now()
+        
+        def weight(index: int) -> float:
+            track = self._track_at(state.playlist, index, state.playlist_guild_id)
+            if track is None:
+                return 1.0
+            play_count, last_played = db.get_play_stats(track.url, track.type)
+            hours = (now - last_played).total_seconds() / 3600 if last_played else None
+            return play_weight(play_count, hours, SHUFFLE_COOLDOWN_HOURS)
+        return weight
+    
+    def _shuffle_step(self, state: GuildPlayback, forward: bool) -> Optional[Track]:
+        """Move a shuffling guild one step along its play order"""
+        shuffle = state.shuffle
+        length = self.get_track_count(state.playlist, state.playlist_guild_id) or 0
+        if shuffle.current(length) != state.track_index:
+            # Jumped, edited or outgrew the order; carry on from the current track
+            shuffle.seek(state.track_index, length)
+        wrap = state.repeat_mode == "all"
+        if forward:
+            index = shuffle.next(length, wrap, self._shuffle_weight(state) if shuffle.weighted else None)
+        else:
+            index = shuffle.previous(length, wrap)
+        track = self._track_at(state.playlist, index, state.playlist_guild_id) if index is not None else None
         if track is None:
-            self.is_playing = False
-            self.is_paused = False
+            return self._update_playback_state(state, None)
+        return self._step_to(state, index, track)
+    
+    def _update_playback_state(self, state: GuildPlayback, track: Optional[Track] = None,
+                               changed: bool = True) -> Optional[Track]:
+        """Update playback state after a track change (changed=False: same track again)"""
+        if track is None:
+            self._set_play_state(state, False, False)
             return None
         
-        # Keep playing if we were playing
-        if self.is_playing and not self.is_paused:
-            self.is_playing = True
-            self.is_paused = False
-            
+        # Playing and paused flags carry over to the new track
+        if changed:
+            self._notify(state, TrackChanged(state.guild_id, track))
         return track
     
-    def next_track(self) -> Optional[Track]:
-        """Get next track"""
-        if not self.current_playlist:
-            return self._update_playback_state(None)
-            
-        playlist = self.get_playlist(self.current_playlist)
-        if not playlist or not playlist.tracks:
-            return self._update_playback_state(None)
-            
-        if self.repeat_mode == "one":
-            return self._update_playback_state(self.get_current_track())
-            
-        self.current_track_index += 1
-        if self.current_track_index >= len(playlist.tracks):
-            if self.repeat_mode == "all":
-                self.current_track_index = 0
-            else:
-                self.current_track_index = len(playlist.tracks) - 1
-                return self._update_playback_state(None)
+    def _step_to(self, state: GuildPlayback, index: int, track: Track) -> Optional[Track]:
+        """Make track (found at index) the guild's current track"""
+        state.track_index = index
+        self._db(state.playlist_guild_id).record_play(track.url, track.type)
+        self._save_playback(state)
+        return self._update_playback_state(state, track)
+    
+    def next_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Advance a guild to and return its next track"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if state.repeat_mode == "one" and (state.playlist or state.queued_track is not None):
+                track = self._current_track(state)
+                if track is not None:
+                    self._db(state.playlist_guild_id if state.queued_track is None else guild_id).record_play(
+                        track.url, track.type)
+                return self._update_playback_state(state, track, changed=False)
+                
+            # The queue plays first; the playlist carries on where it was after it
+            if state.queue:
+                track = state.queued_track = state.queue.popleft()
+                state.queue_dirty = True
+                self._db(guild_id).record_play(track.url, track.type)
+                self._notify(state, QueueChanged(guild_id, len(state.queue)))
+                return self._update_playback_state(state, track)
+            if state.queued_track is not None:
+                state.queued_track = None
+                state.queue_dirty = True
+                
+            if not state.playlist:
+                return self._update_playback_state(state, None)
                 
-        return self._update_playback_state(self.get_current_track())
+            if state.shuffle is not None:
+                return self._shuffle_step(state, forward=True)
+                
+            index = state.track_index + 1
+            track = self._track_at(state.playlist, index, state.playlist_guild_id)
+            if track is None:
+                if state.repeat_mode != "all":
+                    # Stay on the last track
+                    return self._update_playback_state(state, None)
+                index = 0
+                track = self._track_at(state.playlist, index, state.playlist_guild_id)
+                if track is None:
+                    return self._update_playback_state(state, None)
+                    
+            return self._step_to(state, index, track)
     
-    def previous_track(self) -> Optional[Track]:
-        """Get previous track"""
-        if not self.current_playlist:
-            return self._update_playback_state(None)
-            
-        playlist = self.get_playlist(self.current_playlist)
-        if not playlist or not playlist.tracks:
-            return self._update_playback_state(None)
-            
-        if self.repeat_mode == "one":
-            return self._update_playback_state(self.get_current_track())
-            
-        self.current_track_index -= 1
-        if self.current_track_index < 0:
-            if self.repeat_mode == "all":
-                self.current_track_index = len(playlist.tracks) - 1
-            else:
-                self.current_track_index = 0
-                return self._update_playback_state(None)
+    def peek_next(self, n: int = 1, guild_id: int = 0) -> List[Track]:
+        """The tracks next_track() would return over its next n calls
+        
+        Follows repeat, shuffle and the queue like next_track() but changes
+        nothing: no position, play count or queue is touched. Weighted
+        shuffle weights change as tracks are played and the queue or
+        playlist may be edited meanwhile, so treat the result as a
+        prediction and compare it with what next_track() actually returns.
+        """
+        state = self.playback(guild_id)
+        with state.lock:
+            if n <= 0:
+                return []
+            if state.repeat_mode == "one" and (state.playlist or state.queued_track is not None):
+                current = state.queued_track or self._track_at(
+                    state.playlist, state.track_index, state.playlist_guild_id)
+                return [current] * n if current is not None else []
+                
+            tracks = list(islice(state.queue, n))
+            if len(tracks) == n or not state.playlist:
+                return tracks
+                
+            name, owner = state.playlist, state.playlist_guild_id
+            length = self.get_track_count(name, owner) or 0
+            wrap = state.repeat_mode == "all"
+            if state.shuffle is not None:
+                shuffle = state.shuffle.copy()
+                if shuffle.current(length) != state.track_index:
+                    shuffle.seek(state.track_index, length)
+                weight = self._shuffle_weight(state) if shuffle.weighted else None
+                while len(tracks) < n:
+                    index = shuffle.next(length, wrap, weight)
+                    track = self._track_at(name, index, owner) if index is not None else None
+                    if track is None:
+                        break
+                    tracks.append(track)
+                return tracks
+                
+            index = state.track_index
+            while len(tracks) < n and length:
+                index += 1
+                if index >= length:
+                    if not wrap:
+                        break
+                    index = 0
+                track = self._track_at(name, index, owner)
+                if track is None:
+                    break
+                tracks.append(track)
+            return tracks
+    
+    def previous_track(self, guild_id: int = 0) -> Optional[Track]:
+        """Send a guild back to and return its previous track"""
+        state = self.playback(guild_id)
+        with self._changing(state):
+            if state.queued_track is not None:
+                # Back from a queued track to the playlist track it interrupted
+                state.queued_track = None
+                state.queue_dirty = True
+                return self._update_playback_state(state, self._current_track(state))
+                
+            if not state.playlist:
+                return self._update_playback_state(state, None)
+                
+            if state.repeat_mode == "one":
+                return self._update_playback_state(state, self._current_track(state), changed=False)
+                
+            if state.shuffle is not None:
+                return self._shuffle_step(state, forward=False)
+                
+            index = state.track_index - 1
+            if index < 0:
+                if state.repeat_mode != "all":
+                    state.track_index = 0
+                    return self._update_playback_state(state, None)
+                index = (self.get_track_count(state.playlist, state.playlist_guild_id) or 0) - 1
+                
+            track = self._track_at(state.playlist, index, state.playlist_guild_id) if index >= 0 else None
+            if track is None:
+                return self._update_playback_state(state, None)
                 
-        return self._update_playback_state(self.get_current_track())
+            return self._step_to(state, index, track)
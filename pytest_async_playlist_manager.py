@@ -0,0 +1,92 @@
+import time
+import asyncio
+import unittest
+from database_testcase import DatabaseTestCase
+from models import Track, Playlist
+from async_playlist_manager import AsyncPlaylistManager
+
+# Longest stall of the event loop tolerated while DB work runs elsewhere
+MAX_LOOP_BLOCK = 0.01
+TRACK_COUNT = 20000
+
+class TestAsyncPlaylistManager(DatabaseTestCase, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        tracks = [Track(title=f"Track {i}", url=f"/music/{i}.mp3", type='local') for i in range(TRACK_COUNT)]
+        self.manager.db.bulk_import_playlists([
+            Playlist(name='big', tracks=tracks),
+            Playlist(name='small', tracks=tracks[:100])
+        ])
+        self.async_manager = AsyncPlaylistManager(self.manager)
+
+    def tearDown(self):
+        self.async_manager.shutdown()
+        super().tearDown()
+
+    async def _max_loop_lag(self, work):
+        """Run work() while a 1ms ticker records how late the loop wakes it"""
+        max_lag = 0.0
+        done = False
+
+        async def ticker():
+            nonlocal max_lag
+            while not done:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                max_lag = max(max_lag, time.perf_counter() - start - 0.001)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        try:
+            result = await work()
+        finally:
+            done = True
+            await task
+        return result, max_lag
+
+    async def test_results_match_sync_manager(self):
+        playlist = await self.async_manager.get_playlist('big')
+        self.assertEqual(len(playlist.tracks), TRACK_COUNT)
+        summaries = await self.async_manager.get_playlist_summaries()
+        self.assertEqual([(s.name, s.track_count) for s in summaries], [('big', TRACK_COUNT), ('small', 100)])
+        self.assertTrue(await self.async_manager.set_current_playlist('big'))
+        self.assertEqual((await self.async_manager.next_track()).title, 'Track 1')
+
+    async def test_player_setters_update_snapshot(self):
+        await self.async_manager.set_current_playlist('small', 5)
+        await self.async_manager.set_playing(True, 5)
+        await self.async_manager.set_paused(True, 5)
+        await self.async_manager.set_volume(30, 5)
+        await self.async_manager.set_repeat_mode('all', 5)
+        state = await self.async_manager.snapshot(5)
+        self.assertEqual((state.is_playing, state.is_paused, state.volume, state.repeat_mode),
+                         (False, True, 30, 'all'))
+
+    async def test_calls_run_on_db_thread(self):
+        import threading
+        name = await self.async_manager.run(lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith('beathoven-db'))
+
+    async def test_event_loop_not_blocked(self):
+        # The bot's command mix: listing, selecting and stepping through tracks
+        async def work():
+            await self.async_manager.set_current_playlist('small')
+            for _ in range(50):
+                await self.async_manager.get_playlist_summaries()
+                await self.async_manager.next_track()
+                await self.async_manager.get_current_track()
+
+        _, max_lag = await self._max_loop_lag(work)
+        self.assertLess(max_lag, MAX_LOOP_BLOCK)
+
+    async def test_sync_call_blocks_event_loop(self):
+        # Control: a playlist load made directly from a coroutine stalls the loop
+        async def work():
+            self.manager.db.get_playlist('big')
+
+        _, max_lag = await self._max_loop_lag(work)
+        self.assertGreater(max_lag, MAX_LOOP_BLOCK)
+
+if __name__ == '__main__':
+    unittest.main()
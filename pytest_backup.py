@@ -0,0 +1,62 @@
+import os
+import gzip
+import unittest
+import database
+from database import Database
+from database_testcase import DatabaseTestCase
+from models import Track, Playlist
+from backup import backup_all, backup_database, restore_database, list_snapshots
+
+class TestBackup(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backup_dir = os.path.join(self.tmp_dir.name, 'backups')
+        self.db = self._open()
+        tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(100)]
+        self.db.add_playlist(Playlist(name='mix', tracks=tracks))
+
+    def test_backup_and_restore(self):
+        stats = backup_database(self.db_path, self.backup_dir, pages=4)
+        self.assertTrue(os.path.exists(stats['path']))
+        self.assertEqual(list_snapshots(self.db_path, self.backup_dir), [stats['path']])
+
+        self.db.delete_playlist('mix')
+        self.db.close()
+        restore_database(stats['path'], self.db_path)
+        self.assertEqual(len(self._open().get_playlist('mix').tracks), 100)
+
+    def test_corrupt_snapshot_is_rejected(self):
+        snapshot = os.path.join(self.backup_dir, 'beathoven-bad.db.gz')
+        os.makedirs(self.backup_dir)
+        with gzip.open(snapshot, 'wb') as f:
+            f.write(b'SQLite format 3\x00' + b'\xff' * 8192)
+        self.db.close()
+        with self.assertRaises(Exception):
+            restore_database(snapshot, self.db_path)
+        self.assertEqual(len(self._open().get_playlist('mix').tracks), 100)
+        self.assertFalse(os.path.exists(self.db_path + '.restore'))
+
+    def test_backup_covers_shards(self):
+        database.SHARDED_GUILDS.add(9)
+        try:
+            shard = Database.for_guild(9)
+            shard.add_playlist(Playlist(name='own', tracks=[Track(title='A', url='/a.mp3', type='local')], guild_id=9))
+            results = backup_all(self.db_path, self.backup_dir)
+            self.assertEqual(len(results), 2)
+            self.assertEqual(os.path.dirname(results[1]['path']), os.path.join(self.backup_dir, 'shards', 'guild-9'))
+
+            shard.delete_playlist('own', 9)
+            shard.close()
+            Database._shards.clear()
+            restore_database(results[1]['path'], Database.shard_path(9, self.db_path))
+            self.assertEqual(len(Database.for_guild(9).get_playlist('own', 9).tracks), 1)
+        finally:
+            database.SHARDED_GUILDS.discard(9)
+
+    def test_retention(self):
+        paths = [backup_database(self.db_path, self.backup_dir, retention=2)['path'] for _ in range(5)]
+        self.assertEqual(len(set(paths)), 5)
+        self.assertEqual(list_snapshots(self.db_path, self.backup_dir), paths[-2:])
+
+if __name__ == '__main__':
+    unittest.main()
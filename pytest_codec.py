@@ -0,0 +1,59 @@
+import json
+import unittest
+from datetime import datetime
+import codec
+from models import LazyPlaylist, LazyTrackList, Playlist, Track
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.playlist = Playlist(name='mix', type='local', description='Ünïcode', guild_id=3, tracks=[
+            Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local', duration=i,
+                  artist='Band' if i % 2 else None, added_at=datetime(2024, 1, 2, 3, 4, 5, i))
+            for i in range(5)])
+
+    def test_round_trip_leaves_input_alone(self):
+        body = codec.encode_playlist(self.playlist)
+        data = json.loads(body)
+        self.assertEqual(data['track_count'], 5)
+        self.assertEqual(data['tracks'][1], self.playlist.tracks[1].to_dict())
+
+        snapshot = json.loads(body)
+        decoded = codec.decode_playlist(data)
+        self.assertEqual(data, snapshot)
+        self.assertEqual(decoded, self.playlist)
+        self.assertEqual(codec.decode_playlist(body), self.playlist)
+
+        as_dict = self.playlist.to_dict()
+        self.assertEqual(Playlist.from_dict(as_dict), self.playlist)
+        self.assertEqual(as_dict, self.playlist.to_dict())
+
+    def test_pages_and_fallback_encoder_agree(self):
+        tracks = self.playlist.tracks
+        lazy = LazyPlaylist(name='mix', tracks=LazyTrackList(len(tracks), lambda o, l: tracks[o:o + l], 2))
+        page = json.loads(codec.encode_playlist(lazy, 1, 2))
+        self.assertEqual((page['track_count'], page['offset']), (5, 1))
+        self.assertEqual([t['title'] for t in page['tracks']], ['Song 1', 'Song 2'])
+
+        fast = codec.orjson
+        codec.orjson = None
+        try:
+            slow = codec.encode_playlist(self.playlist)
+        finally:
+            codec.orjson = fast
+        self.assertEqual(json.loads(slow), json.loads(codec.encode_playlist(self.playlist)))
+
+    def test_iso_text_is_cached_per_track(self):
+        track = self.playlist.tracks[1]
+        self.assertIs(track.to_dict()['added_at'], track.to_dict()['added_at'])
+        text = '2024-01-02T03:04:05.000001'
+        decoded = codec.decode_track({'title': 'A', 'url': '/a.mp3', 'added_at': text})
+        self.assertIs(decoded.added_at_iso, text)
+        self.assertEqual(decoded.added_at, datetime(2024, 1, 2, 3, 4, 5, 1))
+        # Other spellings of the same time are re-encoded in the canonical form
+        other = Track.from_dict({'title': 'A', 'url': '/a.mp3', 'added_at': '2024-01-02 03:04:05.000000'})
+        self.assertEqual(other.added_at_iso, '2024-01-02T03:04:05')
+        other.added_at = datetime(2025, 1, 1)
+        self.assertEqual(other.to_dict()['added_at'], '2025-01-01T00:00:00')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,667 @@
+import os
+import time
+import random
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+import database
+from database import Database, SCHEMA_VERSION
+from database_testcase import DatabaseTestCase
+from models import LazyTrackList, Track, Playlist
+from smart_playlist import SmartRule
+
+def _populate(db: Database):
+    tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local', artist=f"Artist {i % 7}")
+              for i in range(200)]
+    db.add_playlist(Playlist(name='first', tracks=tracks[:120]))
+    db.add_playlist(Playlist(name='second', tracks=tracks[80:]))
+
+class TestDatabaseSchema(DatabaseTestCase):
+    def test_new_database_is_at_schema_version(self):
+        self._open()
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        conn.close()
+
+    def test_migrations_are_idempotent(self):
+        db = self._open()
+        _populate(db)
+        db.close()
+        db = self._open()
+        self.assertEqual([t.title for t in db.get_playlist('first').tracks][:3], ['Song 0', 'Song 1', 'Song 2'])
+
+    def test_outer_transaction_owns_nested_writes(self):
+        db = self._open()
+        with self.assertRaises(RuntimeError):
+            with db._connection(write=True):
+                db.add_playlist(Playlist(name='nested', tracks=[Track(title='A', url='/a.mp3', type='local')]))
+                db.add_smart_playlist('smart', SmartRule(limit=5))
+                db.update_track_play('/a.mp3', 'local')
+                raise RuntimeError("abort")
+        self.assertEqual(db.get_all_playlists(), [])
+        with db._connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0], 0)
+
+    def _create_unversioned(self, data: str):
+        # Schema as created before migrations existed: dense positions, no indexes
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE playlists (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL,
+                type TEXT NOT NULL DEFAULT 'local', description TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                modified_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE tracks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, title TEXT NOT NULL,
+                artist TEXT DEFAULT 'Unknown', duration INTEGER DEFAULT 0,
+                type TEXT NOT NULL DEFAULT 'local',
+                added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, thumbnail_url TEXT,
+                last_played_at TIMESTAMP, play_count INTEGER DEFAULT 0, UNIQUE(url, type));
+            CREATE TABLE playlist_tracks (
+                playlist_id INTEGER, track_id INTEGER, position INTEGER NOT NULL,
+                added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (playlist_id, track_id));
+        ''' + data)
+        conn.commit()
+        conn.close()
+
+    def test_upgrade_from_unversioned_database(self):
+        self._create_unversioned('''
+            INSERT INTO playlists (name) VALUES ('old');
+            INSERT INTO tracks (url, title) VALUES ('/a.mp3', 'Alpha'), ('/b.mp3', 'Beta'), ('/c.mp3', 'Gamma');
+            INSERT INTO playlist_tracks (playlist_id, track_id, position) VALUES (1, 3, 0), (1, 1, 1), (1, 2, 2);
+        ''')
+
+        db = self._open()
+        self.assertEqual([t.title for t in db.get_playlist('old').tracks], ['Gamma', 'Alpha', 'Beta'])
+        self.assertEqual([r.track.title for r in db.search_tracks('gam')], ['Gamma'])
+        self.assertTrue(db.move_track('old', 2, 0))
+        self.assertEqual([t.title for t in db.get_playlist('old').tracks], ['Beta', 'Gamma', 'Alpha'])
+
+    def test_duplicate_tracks_merged_on_upgrade(self):
+        self._create_unversioned('''
+            INSERT INTO playlists (name) VALUES ('a'), ('b');
+            INSERT INTO tracks (url, title, type, play_count) VALUES
+                ('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'Long link', 'youtube', 2),
+                ('https://youtu.be/dQw4w9WgXcQ?t=3', 'Short link', 'youtube', 3),
+                ('https://music.youtube.com/watch?v=dQw4w9WgXcQ&list=x', 'Music link', 'youtube', 0),
+                ('/music//x.mp3', 'X', 'local', 1),
+                ('/music/x.mp3', 'X again', 'local', 1),
+                ('https://youtu.be/aaaaaaaaaaa', 'Other', 'youtube', 0);
+            INSERT INTO playlist_tracks (playlist_id, track_id, position) VALUES
+                (1, 2, 0), (1, 6, 1), (1, 1, 2), (1, 4, 3),
+                (2, 3, 0), (2, 5, 1);
+        ''')
+        db = self._open()
+        self.assertEqual([t.title for t in db.get_playlist('a').tracks], ['Long link', 'Other', 'X'])
+        self.assertEqual([t.title for t in db.get_playlist('b').tracks], ['Long link', 'X'])
+        with db._connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0], 3)
+            self.assertEqual(conn.execute('SELECT play_count FROM tracks WHERE id = 1').fetchone()[0], 5)
+        # New spellings of a known track reuse its row
+        db.append_track('b', Track(title='Again', url='https://m.youtube.com/watch?v=aaaaaaaaaaa', type='youtube'))
+        self.assertEqual(db.get_playlist('b').tracks[-1].url, 'https://youtu.be/aaaaaaaaaaa')
+
+    def test_duplicate_spellings_in_one_playlist(self):
+        db = self._open()
+        tracks = [Track(title='Short', url='https://youtu.be/dQw4w9WgXcQ', type='youtube'),
+                  Track(title='Other', url='/music/o.mp3', type='local'),
+                  Track(title='Long', url='https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=3', type='youtube')]
+        db.add_playlist(Playlist(name='added', tracks=tracks))
+        self.assertTrue(db.update_playlist(Playlist(name='added', tracks=tracks[::-1])))
+        db.bulk_import_playlists([Playlist(name='imported', tracks=tracks[::-1])])
+        # Every path keeps the first spelling, with its position and metadata
+        expected = ['Long', 'Other']
+        self.assertEqual([t.title for t in db.get_playlist('added').tracks], expected)
+        self.assertEqual([t.title for t in db.get_playlist('imported').tracks], expected)
+
+    def test_playlists_are_scoped_by_guild(self):
+        db = self._open()
+        db.add_playlist(Playlist(name='mix', tracks=[Track(title='A', url='/a.mp3', type='local')], guild_id=1))
+        db.add_playlist(Playlist(name='mix', tracks=[Track(title='B', url='/b.mp3', type='local')], guild_id=2))
+        self.assertEqual([t.title for t in db.get_playlist('mix', 1).tracks], ['A'])
+        self.assertEqual([t.title for t in db.get_playlist('mix', 2).tracks], ['B'])
+        self.assertIsNone(db.get_playlist('mix'))
+        self.assertEqual([p.guild_id for p in db.get_playlist_summaries(None)], [1, 2])
+        self.assertTrue(db.delete_playlist('mix', 1))
+        self.assertIsNone(db.get_track_count('mix', 1))
+        self.assertEqual(db.get_track_count('mix', 2), 1)
+
+        db.save_guild_playback(2, 'mix', 0, 80, 'all')
+        db.record_guild_playback(3, 'missing', 4)
+        db.flush_plays()
+        self.assertEqual(db.get_guild_playback(2)['volume'], 80)
+        self.assertEqual(db.get_guild_playback(2)['playlist'], 'mix')
+        self.assertEqual(db.get_guild_playback(3)['track_index'], 4)
+        self.assertIsNone(db.get_guild_playback(3)['playlist'])
+
+    def test_sharded_guild_uses_own_file(self):
+        main = self._open()
+        database.SHARDED_GUILDS.add(42)
+        try:
+            shard = Database.for_guild(42)
+            self.assertIsNot(shard, main)
+            self.assertIs(Database.for_guild(42), shard)
+            self.assertIs(Database.for_guild(7), main)
+            shard.add_playlist(Playlist(name='mix', tracks=[Track(title='A', url='/a.mp3', type='local')], guild_id=42))
+            self.assertEqual(len(shard.get_playlist('mix', 42).tracks), 1)
+            self.assertIsNone(main.get_playlist('mix', 42))
+            self.assertEqual(os.path.dirname(shard.db_path), os.path.join(self.tmp_dir.name, 'shards'))
+        finally:
+            database.SHARDED_GUILDS.discard(42)
+
+    def test_sharding_moves_existing_guild_data(self):
+        main = self._open()
+        tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(5)]
+        main.add_playlist(Playlist(name='mix', tracks=tracks[::-1], guild_id=42))
+        main.add_playlist(Playlist(name='mix', tracks=tracks[:2]))
+        main.record_play_event('/music/3.mp3', 'local', guild_id=42)
+        main.save_guild_playback(42, 'mix', 2, 70, 'all')
+        main.save_play_queues({42: tracks[:1]})
+        main.flush_plays()
+
+        database.SHARDED_GUILDS.add(42)
+        try:
+            shard = Database.for_guild(42)
+            self.assertEqual([t.title for t in shard.get_playlist('mix', 42).tracks],
+                             [t.title for t in tracks[::-1]])
+            self.assertEqual(shard.get_play_totals(42, datetime.now() - timedelta(days=1))['plays'], 1)
+            self.assertEqual((shard.get_guild_playback(42)['playlist'], shard.get_guild_playback(42)['volume']),
+                             ('mix', 70))
+            self.assertEqual([t.title for t in shard.get_play_queue(42)], ['Song 0'])
+            # Gone from main, which keeps the shared playlist
+            self.assertIsNone(main.get_playlist('mix', 42))
+            self.assertIsNone(main.get_guild_playback(42))
+            self.assertEqual(main.get_play_totals(42, datetime.now() - timedelta(days=1))['plays'], 0)
+            self.assertEqual(len(main.get_playlist('mix').tracks), 2)
+
+            # Opening the shard again copies nothing twice
+            Database._shards.clear()
+            shard.close()
+            self.assertEqual(len(Database.for_guild(42).get_playlist('mix', 42).tracks), 5)
+        finally:
+            database.SHARDED_GUILDS.discard(42)
+
+    def test_sharded_guild_searches_the_shared_library(self):
+        main = self._open()
+        main.add_playlist(Playlist(name='shared', tracks=[
+            Track(title='Blue Monday', url='/music/blue.mp3', type='local'),
+            Track(title='Blue Moon', url='/music/moon.mp3', type='local')]))
+        database.SHARDED_GUILDS.add(42)
+        try:
+            manager = self._open_manager()
+            manager.create_playlist('mine', [Track(title='Blue Moon', url='/music/moon.mp3', type='local'),
+                                             Track(title='Blues Run', url='/music/run.mp3', type='local')], guild_id=42)
+            results = manager.search_tracks('blue', guild_id=42)
+            self.assertEqual(sorted((r.track.title, tuple(r.playlists)) for r in results), [
+                ('Blue Monday', ('shared',)), ('Blue Moon', ('mine', 'shared')), ('Blues Run', ('mine',))])
+            self.assertEqual([r.rank for r in results], sorted(r.rank for r in results))
+            self.assertEqual(len(manager.search_tracks('blue', limit=2, guild_id=42)), 2)
+            # Other guilds don't see the shard
+            self.assertEqual([r.track.title for r in manager.search_tracks('run', guild_id=7)], [])
+        finally:
+            database.SHARDED_GUILDS.discard(42)
+
+    def test_play_history_rollups(self):
+        db = self._open()
+        _populate(db)
+        now = datetime.now()
+        for _ in range(3):
+            db.record_play_event('/music/1.mp3', 'local', guild_id=1, started_at=now, duration_played=100)
+        db.record_play_event('/music/2.mp3', 'local', guild_id=1, started_at=now, duration_played=10, skipped=True)
+        db.record_play_event('/music/2.mp3', 'local', guild_id=2, started_at=now - timedelta(days=3))
+        db.flush_plays()
+        # Later batches add into the same buckets
+        db.record_play_event('/music/2.mp3', 'local', guild_id=1, started_at=now, duration_played=50)
+        db.record_play_event('/music/2.mp3', 'local', guild_id=1, started_at=now, duration_played=50)
+        db.record_play_event('/music/2.mp3', 'local', guild_id=1, started_at=now, duration_played=50)
+        db.flush_plays()
+
+        top = db.get_top_tracks(1, now - timedelta(days=7))
+        self.assertEqual([(s.track.title, s.plays, s.skips) for s in top], [('Song 2', 4, 1), ('Song 1', 3, 0)])
+        self.assertEqual(db.get_play_totals(1, now - timedelta(hours=1)),
+                         {'plays': 7, 'skips': 1, 'seconds_played': 460, 'tracks': 2})
+        self.assertEqual(db.get_play_totals(None, now - timedelta(days=7))['plays'], 8)
+        self.assertEqual(db.get_play_totals(2, now - timedelta(days=1))['plays'], 0)
+        self.assertEqual(sum(b['plays'] for b in db.get_play_timeline(None, now - timedelta(days=7))), 8)
+        with db._connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM play_events').fetchone()[0], 8)
+
+    def test_hot_queries_use_indexes(self):
+        db = self._open()
+        _populate(db)
+
+        # Capture the statements each hot path actually runs
+        statements = []
+        with db._connection() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                db.get_playlist('first')
+                db.get_playlist('first', guild_id=3)
+                db.save_guild_playback(3, 'first', 2)
+                db.get_guild_playback(3)
+                db.get_tracks('first', 50, 10)
+                db.get_track_at('second', 3)
+                db.get_track_count('first')
+                db.get_lazy_playlist('second').tracks[7]
+                db.get_all_playlists()
+                db.get_playlist_summaries()
+                db.search_tracks('song 1')
+                db.append_track('first', Track(title='New', url='/new.mp3', type='local'))
+                db.insert_track('first', 10, Track(title='Inserted', url='/ins.mp3', type='local'))
+                db.move_track('first', 5, 50)
+                db.remove_track_at('first', 3)
+                db.record_play('/music/1.mp3', 'local')
+                db.record_play_event('/music/2.mp3', 'local', guild_id=5, duration_played=30, skipped=True)
+                db.flush_plays()
+                week_ago = datetime.now() - timedelta(days=7)
+                for guild_id in (5, None):
+                    db.get_top_tracks(guild_id, week_ago)
+                    db.get_play_totals(guild_id, datetime.now() - timedelta(hours=3))
+                    db.get_play_timeline(guild_id, week_ago)
+            finally:
+                conn.set_trace_callback(None)
+
+            plans = {}
+            for sql in statements:
+                sql = sql.strip()
+                if sql.startswith('--') or sql.split()[0].upper() not in ('SELECT', 'UPDATE', 'DELETE', 'INSERT'):
+                    continue
+                plans[sql] = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+            # The playlists table and FTS/subquery results are the only things
+            # ever scanned; tracks, playlist_tracks and rollups are always
+            # searched by index
+            for sql, plan in plans.items():
+                for step in plan:
+                    if step.startswith('SCAN '):
+                        self.assertRegex(step, r'^SCAN (p|playlists|hits|top|tracks_fts|\(subquery-\d+\))(\s|$)',
+                                         f"Full scan in plan for:\n{sql}\n{plan}")
+
+            # Ordered playlist loads are served by the covering order index
+            # with no sort step
+            ordered = [plan for sql, plan in plans.items() if 'ORDER BY pt.position' in sql or
+                       'ORDER BY position' in sql]
+            self.assertTrue(ordered)
+            for plan in ordered:
+                self.assertTrue(any('idx_playlist_tracks_order' in step for step in plan), plan)
+                self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+            # Play count flushes find tracks through the canonical key
+            flush = [plan for sql, plan in plans.items() if sql.startswith('UPDATE tracks')]
+            self.assertTrue(flush)
+            for plan in flush:
+                self.assertIn('canonical_key=?', ' '.join(plan))
+
+            # Stats read only the rollups, never the play log
+            for sql, plan in plans.items():
+                if sql.startswith('SELECT'):
+                    self.assertNotIn('play_events', sql)
+
+            plan = ' '.join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM tracks WHERE type = 'local'"))
+            self.assertIn('idx_tracks_type', plan)
+
+    def test_compact_tracks_round_trip(self):
+        db = self._open()
+        added = datetime(2024, 3, 1, 12, 30, 15, 123456)
+        track = Track(title='A', url='/a.mp3', type='local', added_at=added, artist='Band', duration=61)
+        self.assertFalse(hasattr(track, '__dict__'))
+        self.assertEqual(Track.from_dict(track.to_dict()), track)
+        self.assertEqual(track.to_dict()['added_at'], '2024-03-01T12:30:15.123456')
+
+        db.add_playlist(Playlist(name='p', tracks=[track, Track(title='B', url='/b.mp3', type='local', artist='Band')]))
+        loaded = db.get_playlist('p').tracks
+        self.assertEqual(loaded[0], track)
+        self.assertEqual(loaded[0].added_at, added)
+        # Repeated strings are shared between tracks
+        self.assertIs(loaded[0].artist, loaded[1].artist)
+        self.assertIs(loaded[0].type, loaded[1].type)
+
+    def test_playlist_columns_match_tracks(self):
+        db = self._open()
+        tracks = [Track(title=f"Sóng {i}", url=f"/music/{i}.mp3", type='radio' if i % 4 == 0 else 'local',
+                        duration=i * 10) for i in range(50)]
+        db.add_playlist(Playlist(name='p', tracks=tracks))
+        db.move_track('p', 0, 49)
+        expected = db.get_playlist('p').tracks
+
+        columns = db.get_playlist_columns('p')
+        self.assertIsNone(db.get_playlist_columns('missing'))
+        self.assertEqual([columns.title(i) for i in range(len(columns))], [t.title for t in expected])
+        self.assertEqual(columns.total_duration(), sum(t.duration for t in expected))
+        self.assertEqual(columns.type_counts(), {'local': 37, 'radio': 13})
+
+        radio = columns.filter(type='radio', min_duration=100)
+        self.assertEqual([radio.url(i) for i in range(len(radio))],
+                         [t.url for t in expected if t.type == 'radio' and t.duration >= 100])
+        page = radio[2:4].to_dicts()
+        self.assertEqual([row['title'] for row in page], ['Sóng 20', 'Sóng 24'])
+        self.assertEqual(page[0]['type'], 'radio')
+        self.assertEqual(len(columns.filter(type='youtube')), 0)
+
+class TestPlaylistPositions(DatabaseTestCase):
+    """Track edits checked against a plain list doing the same edits"""
+
+    def setUp(self):
+        super().setUp()
+        self.db = self._open()
+        self.model = [f"/music/{i}.mp3" for i in range(20)]
+        self.db.add_playlist(Playlist(name='p', tracks=[Track(title=url, url=url, type='local') for url in self.model]))
+        self.new_tracks = 0
+        self.gap = database.POSITION_GAP
+
+    def tearDown(self):
+        # Let background rebalances finish before the database closes
+        deadline = time.monotonic() + 5
+        while self.db._rebalance_pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        database.POSITION_GAP = self.gap
+        super().tearDown()
+
+    def _order(self):
+        return [t.url for t in self.db.get_playlist('p').tracks]
+
+    def _positions(self):
+        with self.db._connection() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT position FROM playlist_tracks pt JOIN playlists p ON p.id = pt.playlist_id '
+                "WHERE p.name = 'p' ORDER BY position")]
+
+    def _new_track(self) -> Track:
+        self.new_tracks += 1
+        url = f"/music/new-{self.new_tracks}.mp3"
+        return Track(title=url, url=url, type='local')
+
+    def _random_edit(self, rng: random.Random):
+        model, db = self.model, self.db
+        op = rng.choice(['append', 'insert', 'insert', 'remove', 'move', 'move', 'reorder'])
+        if op == 'append':
+            track = self._new_track()
+            self.assertTrue(db.append_track('p', track))
+            model.append(track.url)
+        elif op == 'insert':
+            track, index = self._new_track(), rng.randint(0, len(model) + 2)
+            self.assertTrue(db.insert_track('p', index, track))
+            model.insert(index, track.url)
+        elif op == 'remove' and len(model) > 5:
+            index = rng.randrange(len(model))
+            self.assertTrue(db.remove_track_at('p', index))
+            del model[index]
+        elif op == 'move':
+            old, new = rng.randrange(len(model)), rng.randrange(len(model))
+            self.assertTrue(db.move_track('p', old, new))
+            model.insert(new, model.pop(old))
+        elif op == 'reorder':
+            order = list(range(len(model)))
+            rng.shuffle(order)
+            self.assertTrue(db.reorder_tracks('p', order))
+            model[:] = [model[i] for i in order]
+        self.assertEqual(self._order(), model, op)
+
+    def test_random_edits_match_model(self):
+        rng = random.Random(1234)
+        for _ in range(300):
+            self._random_edit(rng)
+        positions = self._positions()
+        self.assertEqual(len(set(positions)), len(positions))
+        self.assertFalse(self.db.remove_track_at('p', len(self.model)))
+        self.assertFalse(self.db.move_track('p', 0, len(self.model)))
+        self.assertFalse(self.db.reorder_tracks('p', [0, 0] + list(range(2, len(self.model)))))
+        self.assertEqual(self._order(), self.model)
+
+    def test_exhausted_gap_rebalances_inline(self):
+        # Renumbering with a tiny gap runs out after a couple of inserts in one spot
+        database.POSITION_GAP = 4
+        self.db.rebalance_positions()
+        rng = random.Random(99)
+        with self.assertLogs('database', 'INFO') as logs:
+            for _ in range(10):
+                track = self._new_track()
+                self.assertTrue(self.db.insert_track('p', 3, track))
+                self.model.insert(3, track.url)
+                self.assertEqual(self._order(), self.model)
+            for _ in range(100):
+                self._random_edit(rng)
+        self.assertTrue(any('gap exhausted' in line for line in logs.output))
+
+    def test_narrow_gap_rebalances_in_background(self):
+        # Halving the gap between the first two tracks narrows it below the threshold
+        scheduled = []
+        schedule = self.db._schedule_rebalance
+        self.db._schedule_rebalance = lambda playlist_id: (scheduled.append(playlist_id), schedule(playlist_id))
+        while not scheduled:
+            self.assertLess(len(self.model), 40)
+            track = self._new_track()
+            self.assertTrue(self.db.insert_track('p', 1, track))
+            self.model.insert(1, track.url)
+        deadline = time.monotonic() + 5
+        while self._positions() != [i * database.POSITION_GAP for i in range(len(self.model))]:
+            self.assertLess(time.monotonic(), deadline, "background rebalance did not run")
+            time.sleep(0.01)
+        self.assertEqual(self._order(), self.model)
+
+class TestPlayBuffer(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = self._open()
+        _populate(self.db)
+
+    def _play_count(self, url: str) -> int:
+        return self.db.get_play_stats(url, 'local')[0]
+
+    def _rollup(self, table: str) -> list:
+        with self.db._connection() as conn:
+            return conn.execute(f'''
+                SELECT r.guild_id, t.url, r.plays, r.skips, r.seconds_played FROM {table} r
+                JOIN tracks t ON t.id = r.track_id ORDER BY t.url
+            ''').fetchall()
+
+    def test_plays_wait_for_flush_and_are_batched(self):
+        now = datetime.now()
+        for _ in range(3):
+            self.db.record_play('/music/1.mp3', 'local')
+        self.db.record_play('/music/2.mp3', 'local')
+        self.db.record_play_event('/music/1.mp3', 'local', guild_id=5, started_at=now, duration_played=30)
+        self.db.record_play_event('/music/1.mp3', 'local', guild_id=5, started_at=now, duration_played=20,
+                                  skipped=True)
+        self.assertEqual(self._play_count('/music/1.mp3'), 0)
+        self.assertEqual(self._rollup('play_rollup_hourly'), [])
+
+        self.assertEqual(self.db.flush_plays(), 6)
+        self.assertEqual(self.db.flush_plays(), 0)
+        self.assertEqual(self._play_count('/music/1.mp3'), 3)
+        self.assertEqual(self._play_count('/music/2.mp3'), 1)
+        self.assertIsNotNone(self.db.get_play_stats('/music/1.mp3', 'local')[1])
+        # Both events share an hour and a day, so each rollup has one row for them
+        for table in ('play_rollup_hourly', 'play_rollup_daily'):
+            self.assertEqual(self._rollup(table), [(5, '/music/1.mp3', 2, 1, 50)])
+
+    def test_plays_of_a_url_in_no_playlist_are_kept(self):
+        now = datetime.now()
+        url = 'https://www.youtube.com/watch?v=oneoff'
+        self.db.record_play(url, 'youtube')
+        self.db.record_play_event(url, 'youtube', guild_id=5, started_at=now, duration_played=40,
+                                  title='One Off', artist='Someone')
+        self.assertEqual(self.db.flush_plays(), 2)
+        self.assertEqual(self.db.get_play_stats(url, 'youtube')[0], 1)
+        self.assertEqual(self._rollup('play_rollup_daily'), [(5, url, 1, 0, 40)])
+        top = self.db.get_top_tracks(guild_id=5)
+        self.assertEqual([(s.track.title, s.track.artist, s.plays) for s in top], [('One Off', 'Someone', 1)])
+        # Existing rows keep their metadata
+        self.db.record_play_event('/music/1.mp3', 'local', guild_id=5, started_at=now, title='Renamed')
+        self.db.flush_plays()
+        with self.db._connection() as conn:
+            title = conn.execute("SELECT title FROM tracks WHERE url = '/music/1.mp3'").fetchone()[0]
+        self.assertEqual(title, 'Song 1')
+
+    def test_threshold_wakes_the_flusher(self):
+        for _ in range(database.PLAY_FLUSH_THRESHOLD):
+            self.db.record_play('/music/3.mp3', 'local')
+        # Well before PLAY_FLUSH_INTERVAL
+        deadline = time.monotonic() + 5
+        while self._play_count('/music/3.mp3') != database.PLAY_FLUSH_THRESHOLD:
+            self.assertLess(time.monotonic(), deadline, "flush was not triggered by the threshold")
+            time.sleep(0.01)
+
+    def test_failed_flush_requeues_everything(self):
+        now = datetime.now()
+        self.db.record_play('/music/1.mp3', 'local')
+        self.db.record_play('/music/1.mp3', 'local')
+        self.db.record_play_event('/music/1.mp3', 'local', guild_id=1, started_at=now, duration_played=10)
+        self.db.record_guild_playback(1, 'first', 7)
+
+        def fail(conn, rows):
+            raise sqlite3.OperationalError("database is locked")
+        self.db._write_guild_playback = fail
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.flush_plays()
+        # The whole batch rolled back
+        self.assertEqual(self._play_count('/music/1.mp3'), 0)
+        self.assertEqual(self._rollup('play_rollup_daily'), [])
+        self.assertEqual(self.db.get_guild_playback(1)['track_index'], 7)
+
+        del self.db._write_guild_playback
+        self.db.record_play('/music/1.mp3', 'local')
+        self.db.record_play_event('/music/1.mp3', 'local', guild_id=1, started_at=now, duration_played=5)
+        self.assertEqual(self.db.flush_plays(), 5)
+        self.assertEqual(self._play_count('/music/1.mp3'), 3)
+        self.assertEqual(self._rollup('play_rollup_daily'), [(1, '/music/1.mp3', 2, 0, 15)])
+        with self.db._connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM play_events').fetchone()[0], 2)
+            self.assertEqual(conn.execute('SELECT track_index FROM guild_playback WHERE guild_id = 1').fetchone()[0], 7)
+
+class TestTrackSearch(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = self._open()
+        self.song = Track(title='Bohemian Rhapsody', url='/music/bohemian.mp3', type='local', artist='Queen')
+        shared = [self.song,
+                  Track(title='Halo', url='/music/halo.mp3', type='local', artist='Beyoncé'),
+                  Track(title='All Or Nothing', url='/music/or.mp3', type='local', artist='Small Faces')]
+        self.db.add_playlist(Playlist(name='rock', tracks=shared))
+        self.db.add_playlist(Playlist(name='mine', tracks=[self.song], guild_id=1))
+        self.db.add_playlist(Playlist(name='theirs', tracks=[self.song], guild_id=2))
+
+    def _titles(self, query: str) -> list:
+        return [r.track.title for r in self.db.search_tracks(query)]
+
+    def _check_index(self):
+        with self.db._connection() as conn:
+            conn.execute("INSERT INTO tracks_fts (tracks_fts, rank) VALUES ('integrity-check', 1)")
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        self.assertEqual(self._titles('boh rhap'), ['Bohemian Rhapsody'])
+        self.assertEqual(self._titles('queen'), ['Bohemian Rhapsody'])
+        self.assertEqual(self._titles('beyonce'), ['Halo'])
+
+        renamed = Track(title='Killer Queen', url=self.song.url, type='local', artist='Queen')
+        self.db.update_playlist(Playlist(name='rock', tracks=[renamed]))
+        self.assertEqual(self._titles('bohemian'), [])
+        self.assertEqual(self._titles('killer'), ['Killer Queen'])
+        self._check_index()
+
+        with self.db._connection() as conn:
+            conn.execute('DELETE FROM tracks WHERE url = ?', (self.song.url,))
+        self.assertEqual(self._titles('queen'), [])
+        self._check_index()
+
+    def test_playlists_are_filtered_by_guild(self):
+        [everywhere] = self.db.search_tracks('bohemian')
+        self.assertEqual(everywhere.playlists, ['mine', 'rock', 'theirs'])
+        self.assertEqual(self.db.search_tracks('bohemian', guild_id=1)[0].playlists, ['mine', 'rock'])
+        self.assertEqual(self.db.search_tracks('bohemian', guild_id=2)[0].playlists, ['rock', 'theirs'])
+        self.assertEqual(self.db.search_tracks('bohemian', guild_id=3)[0].playlists, ['rock'])
+
+    def test_query_syntax_is_taken_literally(self):
+        # FTS5 operators and punctuation in user input never reach the parser as syntax
+        for query in ('or', 'OR nothing', 'NOT', '"all', 'title:halo', 'NEAR(all nothing)', 'halo*', '-halo'):
+            self.db.search_tracks(query)
+        self.assertEqual(self._titles('OR'), ['All Or Nothing'])
+        self.assertEqual(self._titles('title:halo'), [])
+        self.assertEqual(self._titles('"halo'), ['Halo'])
+        self.assertEqual(self._titles('NEAR(all nothing)'), [])
+        self.assertEqual(self._titles('***'), [])
+        self.assertEqual(self._titles(''), [])
+
+class TestBulkImport(DatabaseTestCase):
+    def test_bulk_import_dedups_and_upserts_tracks(self):
+        db = self._open()
+        db.add_playlist(Playlist(name='old', tracks=[Track(title='Old title', url='/music/1.mp3', type='local')]))
+        for _ in range(4):
+            db.record_play('/music/1.mp3', 'local')
+        db.flush_plays()
+
+        one = Track(title='New title', url='/music/1.mp3', type='local', duration=90)
+        two = Track(title='Two', url='/music/2.mp3', type='local')
+        three = Track(title='Three', url='/music/3.mp3', type='local')
+        stats = db.bulk_import_playlists([
+            Playlist(name='a', tracks=[one, two, Track(title='Again', url='/music//1.mp3', type='local'), three]),
+            Playlist(name='b', tracks=[three, two]),
+        ])
+        self.assertEqual((stats['playlists'], stats['tracks']), (2, 6))
+        # The first spelling keeps its place and its metadata; a later one is dropped
+        self.assertEqual([t.title for t in db.get_playlist('a').tracks], ['New title', 'Two', 'Three'])
+        self.assertEqual([t.title for t in db.get_playlist('b').tracks], ['Three', 'Two'])
+        # The track row is shared, so the refresh shows in other playlists too
+        self.assertEqual((db.get_playlist('old').tracks[0].title, db.get_playlist('old').tracks[0].duration),
+                         ('New title', 90))
+        self.assertEqual(db.get_play_stats('/music/1.mp3', 'local')[0], 4)
+        with db._connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0], 3)
+
+        # Importing a playlist again replaces its tracks and leaves the others alone
+        db.bulk_import_playlists([Playlist(name='a', tracks=[three], description='again')])
+        self.assertEqual([t.title for t in db.get_playlist('a').tracks], ['Three'])
+        self.assertEqual(db.get_playlist('a').description, 'again')
+        self.assertEqual(db.get_track_count('b'), 2)
+
+    def test_bulk_import_replaces_a_smart_playlist(self):
+        db = self._open()
+        db.add_smart_playlist('top', SmartRule(limit=5))
+        db.bulk_import_playlists([Playlist(name='top', tracks=[Track(title='One', url='/music/1.mp3', type='local')])])
+        playlist = db.get_playlist('top')
+        self.assertEqual((playlist.type, [t.title for t in playlist.tracks]), ('local', ['One']))
+        # Its tracks can be edited like any regular playlist's
+        self.assertTrue(db.remove_track_at('top', 0))
+        self.assertEqual(db.get_track_count('top'), 0)
+
+class TestPaging(DatabaseTestCase):
+    def test_pages_and_lazy_track_list(self):
+        db = self._open()
+        db.bulk_import_playlists([Playlist(name='p', tracks=[
+            Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(250)])])
+        page = lambda offset, limit: [t.title for t in db.get_tracks('p', offset, limit)]
+        self.assertEqual(len(page(0, 100)), 100)
+        self.assertEqual(page(99, 2), ['Song 99', 'Song 100'])
+        self.assertEqual(page(240, 100), [f"Song {i}" for i in range(240, 250)])
+        for offset, limit in ((250, 10), (-1, 10), (10, 0)):
+            self.assertEqual(page(offset, limit), [])
+        self.assertEqual(db.get_tracks('missing'), [])
+
+        lazy = db.get_lazy_playlist('p', page_size=64).tracks
+        self.assertEqual(len(lazy), 250)
+        self.assertEqual([lazy[i].title for i in (0, 63, 64, 249, -1, -250)],
+                         ['Song 0', 'Song 63', 'Song 64', 'Song 249', 'Song 249', 'Song 0'])
+        self.assertEqual([t.title for t in lazy[62:66]], ['Song 62', 'Song 63', 'Song 64', 'Song 65'])
+        self.assertEqual([t.title for t in lazy], [f"Song {i}" for i in range(250)])
+        for index in (250, -251):
+            with self.assertRaises(IndexError):
+                lazy[index]
+
+        # Pages are fetched once each, on demand
+        fetched = []
+        tracks = [Track(title=str(i), url=f"/{i}.mp3", type='local') for i in range(10)]
+        def fetch(offset, limit):
+            fetched.append((offset, limit))
+            return tracks[offset:offset + limit]
+        lazy = LazyTrackList(10, fetch, 4)
+        self.assertEqual([lazy[i].title for i in (5, 4, 7, 9, 0, 8)], ['5', '4', '7', '9', '0', '8'])
+        self.assertEqual(fetched, [(4, 4), (8, 4), (0, 4)])
+        # A playlist that shrank after its length was read raises rather than misreading
+        del tracks[6:]
+        with self.assertRaises(IndexError):
+            LazyTrackList(10, fetch, 4)[7]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+from database_testcase import DatabaseTestCase
+from events import EventBus, PlayStateChanged, QueueChanged, TrackChanged, VolumeChanged
+from models import Track
+
+class TestPlaybackEvents(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        self.manager.create_playlist('mix', [
+            Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(3)])
+        self.events = []
+        self.manager.events.subscribe(self.events.append)
+
+    def test_only_real_changes_are_published(self):
+        self.manager.set_current_playlist('mix', 1)
+        self.manager.set_playing(True, 1)
+        self.manager.set_playing(True, 1)
+        self.manager.set_volume(100, 1)
+        self.manager.set_volume(40, 1)
+        self.manager.enqueue(Track(title='q', url='/q.mp3', type='local'), 1)
+        self.manager.next_track(1)
+        self.manager.set_paused(True, 1)
+        self.assertEqual([type(e) for e in self.events], [
+            TrackChanged, PlayStateChanged, VolumeChanged, QueueChanged, QueueChanged,
+            TrackChanged, PlayStateChanged])
+        self.assertEqual(self.events[-2].track.title, 'q')
+        self.assertEqual((self.events[-1].is_playing, self.events[-1].is_paused), (False, True))
+        self.assertEqual(self.events[-1].to_dict(), {
+            'type': 'play_state', 'guild_id': 1, 'is_playing': False, 'is_paused': True})
+
+    def test_reading_state_is_silent(self):
+        self.manager.set_current_playlist('mix', 2)
+        self.manager.db.flush_plays()
+        plays = self.manager.db.get_play_stats('/music/0.mp3', 'local')[0]
+        del self.events[:]
+        for _ in range(100):
+            self.manager.get_current_track(2)
+            self.manager.peek_next(2, 2)
+        self.manager.db.flush_plays()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.manager.db.get_play_stats('/music/0.mp3', 'local')[0], plays)
+
+    def test_async_subscribers_get_events_from_other_threads(self):
+        async def run():
+            bus = EventBus()
+            queue, unsubscribe = bus.subscribe_async(asyncio.get_running_loop())
+            await asyncio.get_running_loop().run_in_executor(None, bus.publish, VolumeChanged(3, 10))
+            event = await asyncio.wait_for(queue.get(), timeout=5)
+            unsubscribe()
+            bus.publish(VolumeChanged(3, 20))
+            await asyncio.sleep(0)
+            return event, queue.empty()
+        self.assertEqual(asyncio.run(run()), (VolumeChanged(3, 10), True))
+
+if __name__ == '__main__':
+    unittest.main()
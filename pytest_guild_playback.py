@@ -0,0 +1,132 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from database_testcase import DatabaseTestCase
+from models import Track
+
+GUILDS = 500
+TRACKS = 20
+
+class TestGuildPlayback(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(TRACKS)]
+        self.manager.create_playlist('mix', tracks)
+
+    def test_guilds_play_independently(self):
+        def simulate(guild_id):
+            manager = self.manager
+            self.assertTrue(manager.set_current_playlist('mix', guild_id))
+            manager.set_playing(True, guild_id)
+            manager.set_volume(guild_id % 101, guild_id)
+            for _ in range(guild_id % (TRACKS - 1)):
+                manager.next_track(guild_id)
+            if guild_id % 2:
+                manager.next_track(guild_id)
+                manager.previous_track(guild_id)
+            return manager.get_current_track(guild_id).title
+
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            titles = list(pool.map(simulate, range(1, GUILDS + 1)))
+
+        self.assertEqual(len(self.manager.playbacks()), GUILDS)
+        for guild_id, title in enumerate(titles, 1):
+            state = self.manager.playback(guild_id)
+            self.assertEqual(title, f"Song {guild_id % (TRACKS - 1)}")
+            self.assertEqual(state.track_index, guild_id % (TRACKS - 1))
+            self.assertEqual(state.volume, guild_id % 101)
+            self.assertTrue(state.is_playing)
+        # Guilds never touched start out stopped
+        self.assertIsNone(self.manager.playback(GUILDS + 1).playlist)
+
+    def test_state_survives_eviction_and_restart(self):
+        self.manager.set_current_playlist('mix', 7)
+        self.manager.set_track_index(5, 7)
+        self.manager.set_repeat_mode('all', 7)
+        self.manager.set_playing(True, 8)
+
+        self.assertEqual(self.manager.evict_idle(0), 1)
+        self.assertEqual([s.guild_id for s in self.manager.playbacks()], [8])
+        self.assertEqual(self.manager.get_current_track(7).title, 'Song 5')
+
+        self.manager.db.flush_plays()
+        state = self._open_manager().playback(7)
+        self.assertEqual((state.playlist, state.track_index, state.repeat_mode), ('mix', 5, 'all'))
+        self.assertFalse(state.is_playing)
+
+    def test_playlist_edits_follow_every_guild(self):
+        for guild_id in (1, 2):
+            self.manager.set_current_playlist('mix', guild_id)
+        self.manager.set_track_index(3, 1)
+        self.manager.set_track_index(10, 2)
+        # Guilds can play the shared playlist but only guild 0 can change it
+        self.assertFalse(self.manager.move_track('mix', 0, 15, guild_id=1))
+        self.assertFalse(self.manager.delete_playlist('mix', 1))
+        self.assertTrue(self.manager.move_track('mix', 0, 15))
+        self.assertEqual(self.manager.get_current_track(1).title, 'Song 3')
+        self.assertEqual(self.manager.get_current_track(2).title, 'Song 10')
+        self.assertEqual(self.manager.playback(2).track_index, 9)
+
+    def test_removing_an_earlier_track_keeps_the_current_one(self):
+        self.manager.set_current_playlist('mix', 1)
+        self.manager.set_track_index(10, 1)
+        self.manager.set_current_playlist('mix', 2)
+        self.manager.set_shuffle('on', 2)
+        self.manager.set_track_index(10, 2)
+
+        self.assertTrue(self.manager.remove_track('mix', 2))
+        for guild_id in (1, 2):
+            self.assertEqual(self.manager.get_current_track(guild_id).title, 'Song 10')
+            self.assertEqual(self.manager.playback(guild_id).track_index, 9)
+        self.assertEqual(self.manager.playback(2).shuffle.current(TRACKS - 1), 9)
+        self.assertEqual(self.manager.next_track(1).title, 'Song 11')
+        # Shuffle moves on from the current track (or ends, if it was the pass's last)
+        track = self.manager.next_track(2)
+        self.assertTrue(track is None or track.title != 'Song 10')
+
+    def test_queue_plays_before_playlist_and_survives_restart(self):
+        self.manager.set_current_playlist('mix', 3)
+        for name in ('a', 'b'):
+            self.manager.enqueue(Track(title=name, url=f"https://example.com/{name}.mp3", type='radio'), 3)
+        self.assertEqual(self.manager.enqueue(Track(title='c', url='/c.mp3', type='local'), 3, front=True), 0)
+        self.assertEqual(self.manager.remove_from_queue(2, 3).title, 'b')
+        self.assertIsNone(self.manager.remove_from_queue(2, 3))
+
+        titles = [self.manager.next_track(3).title for _ in range(3)]
+        self.assertEqual(titles, ['c', 'a', 'Song 1'])
+        self.assertEqual(self.manager.previous_track(3).title, 'Song 0')
+
+        for i in range(25):
+            self.manager.enqueue(Track(title=f"q{i}", url=f"/q/{i}.mp3", type='local'), 3)
+        self.assertEqual([t.title for t in self.manager.get_queue(3, 20, 10)], [f"q{i}" for i in range(20, 25)])
+        self.manager.next_track(3)
+        self.assertEqual(self.manager.checkpoint_queues(), 1)
+        self.assertEqual(self.manager.checkpoint_queues(), 0)
+
+        # The queued track that was playing is replayed after a restart
+        queue = self._open_manager().get_queue(3, 0, 100)
+        self.assertEqual(len(queue), 25)
+        self.assertEqual(queue[0].title, 'q0')
+        self.assertEqual(self.manager.clear_queue(3), 25)
+
+    def test_peek_next_predicts_without_advancing(self):
+        self.manager.set_current_playlist('mix', 4)
+        self.manager.set_track_index(TRACKS - 3, 4)
+        self.manager.enqueue(Track(title='q', url='/q.mp3', type='local'), 4)
+        titles = lambda tracks: [t.title for t in tracks]
+        self.assertEqual(titles(self.manager.peek_next(5, 4)), ['q', 'Song 18', 'Song 19'])
+
+        self.manager.set_repeat_mode('all', 4)
+        for shuffle in ('off', 'on'):
+            self.manager.set_shuffle(shuffle, 4)
+            peeked = titles(self.manager.peek_next(TRACKS + 5, 4))
+            self.assertEqual(titles(self.manager.peek_next(TRACKS + 5, 4)), peeked)
+            self.assertEqual(self.manager.queue_length(4), 1)
+            self.assertEqual([self.manager.next_track(4).title for _ in range(TRACKS + 5)], peeked)
+            self.manager.enqueue(Track(title='q', url='/q.mp3', type='local'), 4)
+
+        self.manager.set_repeat_mode('one', 4)
+        self.assertEqual(titles(self.manager.peek_next(2, 4)), [self.manager.get_current_track(4).title] * 2)
+
+if __name__ == '__main__':
+    unittest.main()
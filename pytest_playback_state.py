@@ -0,0 +1,111 @@
+import asyncio
+import random
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from async_playlist_manager import AsyncPlaylistManager
+from database_testcase import DatabaseTestCase
+from models import Track
+
+GUILD = 1
+LENGTHS = {'a': 5, 'b': 50}
+WRITES = 1500  # per writer
+
+class TestPlaybackStateSnapshots(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        for name, length in LENGTHS.items():
+            self.manager.create_playlist(name, [
+                Track(title=f"{name} {i}", url=f"/music/{name}/{i}.mp3", type='local') for i in range(length)])
+
+    def _write(self, rng: random.Random) -> None:
+        """One random change, as the web UI would make it"""
+        manager = self.manager
+        op = rng.randrange(7)
+        if op == 0:
+            manager.set_current_playlist(rng.choice('ab'), GUILD)
+        elif op == 1:
+            manager.set_track_index(rng.randrange(50), GUILD)
+        elif op == 2:
+            manager.next_track(GUILD)
+        elif op == 3:
+            manager.previous_track(GUILD)
+        elif op == 4:
+            manager.set_volume(rng.randrange(101), GUILD)
+        elif op == 5:
+            manager.set_paused(rng.random() < 0.5, GUILD)
+        else:
+            manager.set_shuffle(rng.choice(['off', 'on']), GUILD)
+
+    def test_readers_never_see_torn_state(self):
+        self.manager.set_current_playlist('a', GUILD)
+        stop = threading.Event()
+        problems = []
+
+        def reader():
+            last_version = -1
+            reads = 0
+            while not stop.is_set() or reads == 0:
+                state = self.manager.snapshot(GUILD)
+                reads += 1
+                if state.version < last_version:
+                    problems.append(f"version went back from {last_version} to {state.version}")
+                last_version = state.version
+                track = state.current_track
+                if track is not None and track.title != f"{state.playlist} {state.track_index}":
+                    problems.append(f"{track.title} paired with {state.playlist} #{state.track_index}")
+                if state.is_playing and state.is_paused:
+                    problems.append("playing and paused")
+                time.sleep(0)  # let the writers have the GIL
+            return reads
+
+        async def bot_side():
+            # The bot's writes arrive through the async facade's DB thread
+            async_manager = AsyncPlaylistManager(self.manager)
+            rng = random.Random(2)
+            try:
+                for _ in range(WRITES):
+                    if rng.random() < 0.5:
+                        await async_manager.next_track(GUILD)
+                    else:
+                        await async_manager.run(self._write, rng)
+            finally:
+                async_manager.shutdown()
+
+        def flask_writer(seed):
+            rng = random.Random(seed)
+            for _ in range(WRITES):
+                self._write(rng)
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            readers = [pool.submit(reader) for _ in range(3)]
+            flask_side = [pool.submit(flask_writer, seed) for seed in (0, 1)]
+            asyncio.run(bot_side())
+            for future in flask_side:
+                future.result()
+            stop.set()
+            self.assertTrue(all(future.result() > 0 for future in readers))
+
+        self.assertEqual(problems[:5], [])
+        # The last snapshot matches the state it was taken from
+        state = self.manager.playback(GUILD)
+        with state.lock:
+            self.assertEqual(state.freeze(state.snapshot.version, self.manager._current_track(state)), state.snapshot)
+
+    def test_versions_survive_eviction(self):
+        self.manager.set_current_playlist('b', GUILD)
+        self.manager.set_track_index(7, GUILD)
+        before = self.manager.snapshot(GUILD)
+        self.manager.db.flush_plays()
+        self.manager.evict_idle(0)
+        after = self.manager.snapshot(GUILD)
+        self.assertGreater(after.version, before.version)
+        self.assertEqual((after.playlist, after.track_index, after.current_track.title), ('b', 7, 'b 7'))
+        # No change, no new version
+        self.manager.set_volume(after.volume, GUILD)
+        self.assertIs(self.manager.snapshot(GUILD), after)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import sqlite3
+import unittest
+from database_testcase import DatabaseTestCase
+from models import Track
+from playlist_cache import PlaylistCache
+
+class TestPlaylistCache(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local') for i in range(50)]
+        self.manager.create_playlist('mix', tracks)
+
+    def test_navigation_is_served_from_cache(self):
+        self.manager.set_current_playlist('mix')
+        self.manager.get_current_track()
+        misses = self.manager.cache_stats()['misses']
+        for _ in range(20):
+            self.manager.get_current_track()
+            self.manager.next_track()
+        stats = self.manager.cache_stats()
+        self.assertEqual(stats['misses'], misses)
+        self.assertGreaterEqual(stats['hits'], 40)
+        self.assertEqual(self.manager.get_current_track().title, 'Song 20')
+
+    def test_own_writes_invalidate(self):
+        self.assertEqual(self.manager.get_track_count('mix'), 50)
+        self.manager.add_track('mix', Track(title='Extra', url='/extra.mp3', type='local'))
+        self.assertEqual(self.manager.get_track_count('mix'), 51)
+        self.manager.move_track('mix', 50, 0)
+        self.assertEqual(self.manager.get_playlist('mix').tracks[0].title, 'Extra')
+
+    def test_external_writes_invalidate(self):
+        self.assertEqual(self.manager.get_playlist('mix').tracks[0].title, 'Song 0')
+        # Another process editing the same file
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE tracks SET title = 'Renamed' WHERE url = '/music/0.mp3'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.manager.get_playlist('mix').tracks[0].title, 'Renamed')
+
+    def test_lru_eviction(self):
+        cache = PlaylistCache(2, lambda: 0)
+        loads = []
+        def loader(name):
+            loads.append(name)
+            return name.upper()
+        for name in ['a', 'b', 'a', 'c', 'a', 'b']:
+            cache.get(name, lambda: loader(name))
+        self.assertEqual(loads, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from database_testcase import DatabaseTestCase
+from models import Track, Playlist
+from shuffle import FeistelPermutation, Shuffle
+
+TRACK_COUNT = 50000
+
+class TestShuffle(unittest.TestCase):
+    def test_permutation_is_a_bijection(self):
+        for length in (1, 2, 3, 17, 1000):
+            perm = FeistelPermutation(length, 1234)
+            values = [perm.forward(i) for i in range(perm.size)]
+            self.assertEqual(sorted(values), list(range(perm.size)))
+            self.assertTrue(all(perm.inverse(v) == i for i, v in enumerate(values)))
+
+    def test_order_covers_playlist_and_walks_back(self):
+        shuffle = Shuffle('on', seed=99)
+        order = []
+        while (index := shuffle.next(300)) is not None:
+            order.append(index)
+        self.assertEqual(sorted(order), list(range(300)))
+        self.assertNotEqual(order, sorted(order))
+        back = [order[-1]]
+        while (index := shuffle.previous(300)) is not None:
+            back.append(index)
+        self.assertEqual(back, order[::-1])
+
+    def test_appended_tracks_join_the_unplayed_part(self):
+        shuffle = Shuffle('on', seed=5)
+        played = [shuffle.next(40) for _ in range(10)]
+        # 40 and 60 tracks share an order size, so the cursor stays valid
+        while (index := shuffle.next(60)) is not None:
+            played.append(index)
+        self.assertEqual(len(played), len(set(played)))
+        self.assertTrue(set(range(40)) <= set(played))
+
+    def test_weighted_prefers_heavy_tracks(self):
+        shuffle = Shuffle('weighted', seed=7)
+        picked = []
+        while (index := shuffle.next(1000, weight=lambda i: 1.0 if i % 2 else 0.1)) is not None:
+            picked.append(index)
+        self.assertEqual(sorted(picked), list(range(1000)))
+        heavy = sum(1 for i in picked[:500] if i % 2)
+        self.assertGreater(heavy, 4 * (500 - heavy))
+
+    def test_weighted_plays_every_track_once_per_pass(self):
+        plain = Shuffle('on', seed=11)
+        plain_order = [plain.next(100) for _ in range(100)]
+
+        equal = Shuffle('weighted', seed=11)
+        self.assertEqual([equal.next(100, weight=lambda i: 0.25) for _ in range(100)], plain_order)
+        self.assertIsNone(equal.next(100, weight=lambda i: 0.25))
+
+        # Tracks lose most of their weight once played, as with the cooldown
+        played = set()
+        weight = lambda i: 0.05 if i in played else (1.0 if i % 3 == 0 else 0.2)
+        shuffle = Shuffle('weighted', seed=3)
+        order = []
+        while (index := shuffle.next(1000, weight=weight)) is not None:
+            order.append(index)
+            played.add(index)
+        self.assertEqual(sorted(order), list(range(1000)))
+        self.assertGreater(sum(1 for i in order[:300] if i % 3 == 0), 150)
+
+        played.clear()
+        wrapped = [shuffle.next(1000, wrap=True, weight=weight) for _ in range(1000)]
+        self.assertEqual(sorted(wrapped), list(range(1000)))
+
+class TestManagerShuffle(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        tracks = [Track(title=f"Track {i}", url=f"/music/{i}.mp3", type='local') for i in range(TRACK_COUNT)]
+        self.manager.db.bulk_import_playlists([Playlist(name='big', tracks=tracks)])
+
+    def test_shuffle_survives_restart(self):
+        self.manager.set_current_playlist('big', 1)
+        self.assertTrue(self.manager.set_shuffle('on', 1))
+        seen = [self.manager.next_track(1).title for _ in range(50)]
+        self.assertEqual(len(set(seen)), 50)
+        self.assertEqual(self.manager.previous_track(1).title, seen[-2])
+        self.manager.next_track(1)
+
+        expected = [self.manager.next_track(1).title for _ in range(5)]
+        for _ in range(5):
+            self.manager.previous_track(1)
+        self.manager.db.flush_plays()
+        self._open_manager()
+        self.assertEqual(self.manager.playback(1).shuffle_mode, 'on')
+        self.assertEqual(self.manager.get_current_track(1).title, seen[-1])
+        self.assertEqual([self.manager.next_track(1).title for _ in range(5)], expected)
+
+    def test_shuffle_off_resumes_in_order(self):
+        self.manager.set_current_playlist('big', 2)
+        self.manager.set_shuffle('weighted', 2)
+        track = self.manager.next_track(2)
+        index = self.manager.playback(2).track_index
+        self.assertEqual(track.title, f"Track {index}")
+        self.manager.set_shuffle('off', 2)
+        self.assertEqual(self.manager.next_track(2).title, f"Track {index + 1}")
+        self.assertFalse(self.manager.set_shuffle('sideways', 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from database_testcase import DatabaseTestCase
+from models import Track
+from smart_playlist import SMART_PRESETS, SmartRule
+
+TRACKS = 12
+
+class TestSmartPlaylists(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self._open_manager()
+        self.tracks = [Track(title=f"Song {i}", url=f"/music/{i}.mp3", type='local', duration=60 + i)
+                       for i in range(TRACKS)]
+        self.manager.create_playlist('mix', self.tracks)
+
+    def _play(self, counts):
+        """Record counts[i] plays of track i and write them out"""
+        for i, plays in counts.items():
+            for _ in range(plays):
+                self.manager.db.record_play(self.tracks[i].url, 'local')
+        self.manager.db.flush_plays()
+
+    def test_rules_are_paged_from_the_library(self):
+        self._play({3: 5, 7: 2, 9: 2, 1: 1})
+        rule = SmartRule.from_dict(SMART_PRESETS['most-played'])
+        playlist = self.manager.create_smart_playlist('top', rule)
+        self.assertEqual([t.title for t in playlist.tracks], ['Song 3', 'Song 9', 'Song 7', 'Song 1'])
+        self.assertEqual([t.title for t in self.manager.get_tracks('top', 1, 2)], ['Song 9', 'Song 7'])
+        summary = {p.name: p for p in self.manager.get_playlist_summaries()}['top']
+        self.assertEqual((summary.type, summary.track_count, summary.total_duration), ('smart', 4, 63 + 69 + 67 + 61))
+
+        # Rules store no tracks, so they can't be edited track by track
+        self.assertFalse(self.manager.add_track('top', self.tracks[0]))
+        self.assertFalse(self.manager.move_track('top', 0, 1))
+
+        # More plays reorder it without rewriting anything
+        self._play({1: 10})
+        self.assertEqual([t.title for t in self.manager.get_playlist('top').tracks][:2], ['Song 1', 'Song 3'])
+        self.assertTrue(self.manager.set_current_playlist('top'))
+        self.assertEqual(self.manager.next_track().title, 'Song 3')
+
+        self.assertEqual(self.manager.get_track_count('unplayed'), None)
+        unplayed = SmartRule.from_dict(SMART_PRESETS['not-played-30-days'])
+        self.manager.create_smart_playlist('unplayed', unplayed)
+        self.assertEqual(self.manager.get_track_count('unplayed'), TRACKS - 4)
+
+    def test_rules_see_shared_and_own_tracks(self):
+        self.manager.create_playlist('mine', [Track(title='Mine', url='/mine.mp3', type='local', duration=5)],
+                                     guild_id=1)
+        rule = SmartRule.from_dict({'filters': [{'field': 'duration', 'op': '<', 'value': 62}],
+                                    'sort': [{'field': 'title', 'desc': True}], 'limit': 10})
+        self.manager.create_smart_playlist('short', rule, guild_id=0)
+        self.manager.create_smart_playlist('short', rule, guild_id=1)
+        self.assertEqual([t.title for t in self.manager.get_playlist('short', 0).tracks], ['Song 1', 'Song 0'])
+        self.assertEqual([t.title for t in self.manager.get_playlist('short', 1).tracks], ['Song 1', 'Song 0', 'Mine'])
+
+        rule = SmartRule.from_dict({'filters': [{'field': 'title', 'op': 'contains', 'value': 'g 1'}],
+                                    'sort': [{'field': 'duration'}], 'limit': 2})
+        self.assertEqual(SmartRule.from_json(rule.to_json()), rule)
+        self.assertEqual([t.title for t in self.manager.db.get_smart_tracks(rule, 0, 100)], ['Song 1', 'Song 10'])
+        self.assertEqual(self.manager.db.get_smart_tracks(rule, 1, 100)[0].title, 'Song 10')
+        self.assertEqual(self.manager.db.get_smart_totals(rule), (2, 61 + 70))
+
+    def test_invalid_rules_are_rejected(self):
+        for data in ({'filters': [{'field': 'url', 'op': '=', 'value': 'x'}]},
+                     {'filters': [{'field': 'play_count', 'op': '>', 'value': 'many'}]},
+                     {'filters': [{'field': 'title', 'op': 'within_days', 'value': 3}]},
+                     {'filters': [{'field': 'added_at', 'op': '>', 'value': 'yesterday'}]},
+                     {'sort': [{'field': 'title; DROP TABLE tracks'}]},
+                     {'limit': 0},
+                     {'order': []},
+                     None):
+            with self.assertRaises(ValueError):
+                SmartRule.from_dict(data)
+
+if __name__ == '__main__':
+    unittest.main()
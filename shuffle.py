@@ -0,0 +1,252 @@
+"""
+Shuffle - Lazily generated random play orders over playlist indexes
+"""
+import random
+from collections import deque
+from typing import Callable, Optional
+
+SHUFFLE_MODES = ("off", "on", "weighted")
+
+# Feistel rounds; four are enough for a well mixed play order
+FEISTEL_ROUNDS = 4
+
+# Weighted shuffle defers at most this many unlucky candidates in a row
+# before taking the next one regardless, so a playlist of tracks that all
+# just played can't stall next_track()
+MAX_REJECTIONS = 32
+
+_MASK64 = (1 << 64) - 1
+_MASK63 = (1 << 63) - 1  # seeds and cursors are stored as SQLite integers
+
+def _mix(x: int) -> int:
+    """splitmix64 finaliser: a cheap, well spread 64-bit hash"""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+def new_seed() -> int:
+    """A random seed for a fresh play order"""
+    return random.getrandbits(63)
+
+def _half_bits(length: int) -> int:
+    """Half the bits of the smallest even power of two >= length"""
+    return (max(1, (max(length, 1) - 1).bit_length()) + 1) // 2
+
+def play_weight(play_count: int, hours_since_played: Optional[float], cooldown_hours: float) -> float:
+    """Chance in (0, 1] of weighted shuffle taking a track
+
+    Often played tracks are favoured (a never played one still gets 0.25),
+    and anything played within cooldown_hours is held back in proportion,
+    down to a tenth.
+    """
+    favourite = 1 - 0.75 / (1 + play_count / 4)
+    if hours_since_played is None or cooldown_hours <= 0:
+        return favourite
+    return favourite * min(1.0, max(0.1, hours_since_played / cooldown_hours))
+
+class FeistelPermutation:
+    """Bijection on [0, 4**half_bits) computed one value at a time
+
+    forward(position) gives the value at a position of the shuffled order
+    and inverse(value) its position, both in O(FEISTEL_ROUNDS) without
+    materialising anything, so a 50k-track playlist costs no more to
+    shuffle than a 5-track one.
+    """
+
+    def __init__(self, length: int, seed: int):
+        self.half_bits = _half_bits(length)
+        self.size = 1 << (2 * self.half_bits)
+        self._mask = (1 << self.half_bits) - 1
+        self._keys = [_mix(seed * FEISTEL_ROUNDS + r) for r in range(FEISTEL_ROUNDS)]
+
+    def _round(self, key: int, half: int) -> int:
+        return _mix(key ^ half) & self._mask
+
+    def forward(self, position: int) -> int:
+        left, right = position >> self.half_bits, position & self._mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(key, right)
+        return (left << self.half_bits) | right
+
+    def inverse(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self._mask
+        for key in reversed(self._keys):
+            left, right = right ^ self._round(key, left), left
+        return (left << self.half_bits) | right
+
+class Shuffle:
+    """A guild's place in a shuffled play order: a seed and a cursor
+
+    The order over a playlist of length n is the permutation of
+    [0, size) with every value >= n skipped, where size is the first even
+    power of two >= n. Stepping visits O(1) positions on average (size is
+    under 4n), and appending tracks only slots the new indexes into the
+    unplayed part of the order - unless the playlist outgrows size, when
+    the order is re-keyed around the current track. Each pass through the
+    order derives a new seed, so repeat-all doesn't replay the same order.
+
+    In weighted mode each candidate is taken with the probability of its
+    weight relative to the heaviest seen so far in the pass, from a coin
+    derived from (seed, cursor), so equal weights give the plain order.
+    Passed-over tracks are deferred to the end of the same pass: once the
+    order runs out, cursors from size on step through the deferred list,
+    and every track still plays once per pass. The deferred list lives in
+    memory; after a restart its remaining tracks wait for the next pass.
+    Weights change as tracks are played, so going back replays a short
+    in-memory history instead of recomputing coins.
+    """
+
+    def __init__(self, mode: str = "on", seed: Optional[int] = None, cursor: int = -1):
+        if mode not in SHUFFLE_MODES[1:]:
+            raise ValueError(f"Unknown shuffle mode: {mode}")
+        self.mode = mode
+        self.seed = new_seed() if seed is None else seed & _MASK63
+        self.cursor = cursor  # position in the order; -1 before the first track
+        self._history = deque(maxlen=100)  # (seed, cursor) of earlier weighted steps
+        self._perm = None
+        self._deferred = []  # indexes passed over in this pass, played after the order
+        self._deferred_set = set()
+        self._max_weight = 0.0  # heaviest weight seen in this pass
+
+    @property
+    def weighted(self) -> bool:
+        return self.mode == "weighted"
+
+    def copy(self) -> 'Shuffle':
+        """A copy at the same place in the same order, e.g. to look ahead with"""
+        shuffle = Shuffle(self.mode, self.seed, self.cursor)
+        shuffle._perm = self._perm
+        shuffle._deferred = list(self._deferred)
+        shuffle._deferred_set = set(self._deferred_set)
+        shuffle._max_weight = self._max_weight
+        return shuffle
+
+    def _permutation(self, length: int) -> FeistelPermutation:
+        perm = self._perm
+        if perm is None or perm.half_bits != _half_bits(length):
+            perm = self._perm = FeistelPermutation(length, self.seed)
+        return perm
+
+    def current(self, length: int) -> Optional[int]:
+        """Track index at the cursor, or None if the cursor is not on a track"""
+        if self.cursor < 0:
+            return None
+        perm = self._permutation(length)
+        if self.cursor >= perm.size:
+            step = self.cursor - perm.size
+            index = self._deferred[step] if step < len(self._deferred) else length
+        else:
+            index = perm.forward(self.cursor)
+        return index if index < length else None
+
+    def seek(self, index: int, length: int) -> None:
+        """Put the cursor on a track index, e.g. after a jump or a playlist edit
+
+        While playing deferred tracks the cursor moves within the deferred
+        list, or stays put if index isn't in it.
+        """
+        if not 0 <= index < length:
+            return
+        perm = self._permutation(length)
+        if self.cursor >= perm.size:
+            if index in self._deferred_set:
+                self.cursor = perm.size + self._deferred.index(index)
+            return
+        self.cursor = perm.inverse(index)
+        if index in self._deferred_set:
+            # Played now, so not again at the end of the pass
+            self._deferred.remove(index)
+            self._deferred_set.discard(index)
+
+    def _new_pass(self) -> None:
+        self.seed = _mix(self.seed) & _MASK63
+        self.cursor = -1
+        self._perm = None
+        self._deferred = []
+        self._deferred_set = set()
+        self._max_weight = 0.0
+
+    def _defer(self, index: int) -> None:
+        if index not in self._deferred_set:
+            self._deferred.append(index)
+            self._deferred_set.add(index)
+
+    def next(self, length: int, wrap: bool = False,
+             weight: Optional[Callable[[int], float]] = None) -> Optional[int]:
+        """Advance to and return the next track index
+
+        At the end of the order returns None (the cursor stays put), or
+        starts a freshly shuffled pass if wrap is set. In weighted mode,
+        weight(index) in (0, 1] sets how likely a candidate is to be taken
+        now rather than deferred to the end of the pass.
+        """
+        if length <= 0:
+            return None
+        start = (self.seed, self.cursor)
+        rejected = 0
+        wrapped = False
+        while True:
+            perm = self._permutation(length)
+            position = self.cursor + 1
+            while position < perm.size and perm.forward(position) >= length:
+                position += 1
+            if position >= perm.size:
+                # The order is done; play what was deferred, then end the pass
+                step = position - perm.size
+                while step < len(self._deferred) and self._deferred[step] >= length:
+                    step += 1
+                if step < len(self._deferred):
+                    self.cursor = perm.size + step
+                    self._history.append(start)
+                    return self._deferred[step]
+                if not wrap or wrapped:
+                    self.seed, self.cursor = start
+                    self._perm = None
+                    return None
+                wrapped = True
+                self._new_pass()
+                continue
+            self.cursor = position
+            index = perm.forward(position)
+            if index in self._deferred_set:
+                # Passed over before going back; it comes round at the end
+                continue
+            if self.weighted and weight is not None and rejected < MAX_REJECTIONS:
+                chance = weight(index)
+                self._max_weight = max(self._max_weight, chance)
+                coin = _mix(self.seed ^ _mix(position)) / _MASK64
+                if coin * self._max_weight >= chance:
+                    rejected += 1
+                    self._defer(index)
+                    continue
+            if self.weighted:
+                self._history.append(start)
+            return index
+
+    def previous(self, length: int, wrap: bool = False) -> Optional[int]:
+        """Step back to and return the previous track index, or None at the start"""
+        if length <= 0:
+            return None
+        if self.weighted:
+            if not self._history:
+                return None
+            self.seed, self.cursor = self._history.pop()
+            self._perm = None
+            return self.current(length)
+        perm = self._permutation(length)
+        position = self.cursor - 1
+        while position >= 0 and perm.forward(position) >= length:
+            position -= 1
+        if position < 0:
+            if not wrap:
+                return None
+            position = perm.size - 1
+            while perm.forward(position) >= length:
+                position -= 1
+        self.cursor = position
+        return perm.forward(position)
+
+    def to_dict(self) -> dict:
+        """Convert shuffle state to dictionary for JSON serialization"""
+        return {"mode": self.mode, "seed": self.seed, "cursor": self.cursor}
@@ -0,0 +1,162 @@
+"""
+SmartRule - Playlists defined by a filter/sort/limit rule over the track library
+"""
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+# Track columns a rule may filter and sort on
+FIELDS = {
+    'title': 't.title',
+    'artist': 't.artist',
+    'duration': 't.duration',
+    'type': 't.type',
+    'added_at': 't.added_at',
+    'last_played_at': 't.last_played_at',
+    'play_count': 't.play_count',
+}
+TEXT_FIELDS = {'title', 'artist', 'type'}
+NUMBER_FIELDS = {'duration', 'play_count'}
+TIME_FIELDS = {'added_at', 'last_played_at'}
+
+COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+# Ops relative to the current time, on TIME_FIELDS; value is a number of days
+RELATIVE_OPS = ('within_days', 'not_within_days')
+OPS = COMPARISONS + ('contains',) + RELATIVE_OPS
+
+# Rules built into the bot and web UI, by name
+SMART_PRESETS = {
+    'most-played': {
+        'filters': [{'field': 'play_count', 'op': '>', 'value': 0}],
+        'sort': [{'field': 'play_count', 'desc': True}],
+        'limit': 100,
+    },
+    'recently-added': {
+        'sort': [{'field': 'added_at', 'desc': True}],
+        'limit': 100,
+    },
+    'not-played-30-days': {
+        'filters': [{'field': 'last_played_at', 'op': 'not_within_days', 'value': 30}],
+        'sort': [{'field': 'title'}],
+    },
+}
+
+def _check_value(name: str, op: str, value):
+    """Validate a filter value, converted to what is bound into the query"""
+    is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if op in RELATIVE_OPS:
+        if name not in TIME_FIELDS:
+            raise ValueError(f"'{op}' only applies to {', '.join(sorted(TIME_FIELDS))}")
+        if not is_number or value < 0:
+            raise ValueError(f"'{op}' needs a number of days, got {value!r}")
+        return value
+    if op == 'contains':
+        if name not in TEXT_FIELDS or not isinstance(value, str):
+            raise ValueError(f"'contains' needs text on one of {', '.join(sorted(TEXT_FIELDS))}")
+        return value
+    if name in NUMBER_FIELDS:
+        if not is_number:
+            raise ValueError(f"{name} must be compared with a number, got {value!r}")
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"{name} must be compared with text, got {value!r}")
+    if name in TIME_FIELDS:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"{name} must be compared with an ISO timestamp, got {value!r}") from None
+    return value
+
+@dataclass(frozen=True)
+class SmartRule:
+    """Which library tracks a smart playlist holds, and in what order
+
+    filters are (field, op, value) conditions that must all hold, sort is a
+    list of (field, descending) keys, and limit caps the number of tracks
+    (None for all). from_dict() builds one from its JSON form and validates it.
+    """
+    filters: Tuple[Tuple[str, str, object], ...] = ()
+    sort: Tuple[Tuple[str, bool], ...] = ()
+    limit: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SmartRule':
+        """Parse and validate a rule; raises ValueError if it is malformed"""
+        if not isinstance(data, dict):
+            raise ValueError("Rule must be an object")
+        unknown = set(data) - {'filters', 'sort', 'limit'}
+        if unknown:
+            raise ValueError(f"Unknown rule keys: {', '.join(sorted(unknown))}")
+
+        filters = []
+        for f in data.get('filters') or []:
+            if not isinstance(f, dict) or f.get('field') not in FIELDS:
+                raise ValueError(f"Filter field must be one of {', '.join(FIELDS)}")
+            if f.get('op') not in OPS:
+                raise ValueError(f"Filter op must be one of {', '.join(OPS)}")
+            _check_value(f['field'], f['op'], f.get('value'))
+            filters.append((f['field'], f['op'], f['value']))
+
+        sort = []
+        for key in data.get('sort') or []:
+            if not isinstance(key, dict) or key.get('field') not in FIELDS:
+                raise ValueError(f"Sort field must be one of {', '.join(FIELDS)}")
+            sort.append((key['field'], bool(key.get('desc', False))))
+
+        limit = data.get('limit')
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            raise ValueError(f"Limit must be a positive integer, got {limit!r}")
+        return cls(tuple(filters), tuple(sort), limit)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'SmartRule':
+        """Parse a rule as stored in playlists.rule"""
+        return cls.from_dict(json.loads(text))
+
+    def to_dict(self) -> dict:
+        """Convert rule to dictionary for JSON serialization"""
+        return {
+            'filters': [{'field': name, 'op': op, 'value': value} for name, op, value in self.filters],
+            'sort': [{'field': name, 'desc': desc} for name, desc in self.sort],
+            'limit': self.limit,
+        }
+
+    def to_json(self) -> str:
+        """Canonical JSON form, as stored and used in cache keys"""
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+
+    @property
+    def relative(self) -> bool:
+        """Whether the rule's tracks depend on the current time"""
+        return any(op in RELATIVE_OPS for _, op, _ in self.filters)
+
+    def where(self, now: datetime) -> Tuple[str, list]:
+        """SQL condition on tracks t and its parameters, with relative ops measured from now"""
+        clauses, params = [], []
+        for name, op, value in self.filters:
+            column = FIELDS[name]
+            value = _check_value(name, op, value)
+            if op == 'within_days':
+                clauses.append(f'{column} >= ?')
+                params.append(now - timedelta(days=value))
+            elif op == 'not_within_days':
+                # Never played counts as not played recently
+                clauses.append(f'({column} IS NULL OR {column} < ?)')
+                params.append(now - timedelta(days=value))
+            elif op == 'contains':
+                escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                clauses.append(f"{column} LIKE ? ESCAPE '\\'")
+                params.append(f'%{escaped}%')
+            else:
+                clauses.append(f'{column} {op} ?')
+                params.append(value)
+        return ' AND '.join(clauses) or '1', params
+
+    def order_by(self) -> str:
+        """SQL ordering of tracks t; ties fall back to t.id so pages never overlap"""
+        keys = [f"{FIELDS[name]} {'DESC' if desc else 'ASC'}" for name, desc in self.sort]
+        # Same direction as the last key, so a single-column index covers the whole ordering
+        last_desc = self.sort[-1][1] if self.sort else False
+        keys.append(f"t.id {'DESC' if last_desc else 'ASC'}")
+        return ', '.join(keys)
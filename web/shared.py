@@ -20,11 +20,18 @@ REPEAT_MODE = {
     'PLAYLIST': 'playlist'
 }
 
+SHUFFLE_MODE = {
+    'OFF': 'off',
+    'ON': 'on',
+    'WEIGHTED': 'weighted'
+}
+
 class Player:
     def __init__(self, session_id: str):
         self.session_id = session_id
         self.state = PLAYER_STATE['IDLE']
         self.repeat_mode = REPEAT_MODE['NONE']
+        self.shuffle_mode = SHUFFLE_MODE['OFF']
         self.volume = 100
         self.current_playlist = None
         self.current_track_index = None
@@ -35,6 +42,7 @@ class Player:
             'state': self.state,
             'playing': self.state == PLAYER_STATE['PLAYING'],
             'repeat': self.repeat_mode,
+            'shuffle': self.shuffle_mode,
             'volume': self.volume,
             'current_playlist': self.current_playlist,
             'current_track': self.current_track,
@@ -92,6 +100,11 @@ class Player:
         elif mode == 'playlist':
             self.repeat_mode = REPEAT_MODE['PLAYLIST']
         
+    def set_shuffle_mode(self, mode: str) -> None:
+        """Set shuffle mode; the order itself is kept by the bot"""
+        if mode in SHUFFLE_MODE.values():
+            self.shuffle_mode = mode
+        
     def toggle_repeat(self, mode: str = None) -> None:
         """Toggle between repeat modes or set a specific mode
         
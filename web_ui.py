@@ -1,14 +1,21 @@
 """Web UI for Beathoven"""
 import os
+import json
+import queue
+import threading
 import logging
 from typing import Optional
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
 import dotenv
 from models import Track, Playlist
 from playlist_manager import PlaylistManager
 from database import Database
-import time
-from datetime import datetime
+from normalizer import guess_track_type
+from events import PlaybackEvent
+from guild_playback import PlaybackState
+from smart_playlist import SMART_PRESETS, SmartRule
+import codec
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -21,10 +28,26 @@ app = Flask(__name__,
 _playlist_manager = PlaylistManager()
 db = Database()
 
-# Cache state to reduce unnecessary updates
-_last_state = None
-_last_state_time = 0
-_STATE_CACHE_TIME = 0.5  # seconds
+# Encoded player state served until the guild's next snapshot or a playlist edit
+_last_states = {}  # guild id -> (_state_key(), JSON bytes)
+
+# Encoded playlist responses, reused while PlaylistManager keeps handing back
+# the same playlist object (it loads a new one after any change)
+_playlist_pages = {}  # (guild id, name, offset, limit) -> (playlist, JSON bytes)
+_playlist_pages_lock = threading.Lock()
+_PLAYLIST_PAGES_MAX = 64
+
+# Tracks per page when the client doesn't ask for a page size
+TRACKS_PAGE_SIZE = 100
+
+# Seconds between keep-alive comments on idle event streams
+_EVENT_KEEPALIVE = 15
+
+def _state_key(snapshot: PlaybackState) -> tuple:
+    """Changes with each new snapshot of the guild and each commit to its databases"""
+    guild_db = Database.for_guild(snapshot.guild_id)
+    return (snapshot.version, db.data_version(),
+            guild_db.data_version() if guild_db is not db else None)
 
 _active_sessions = {}
 
@@ -47,30 +70,36 @@ class WebUI:
         """Start the web server"""
         start_web_server()
 
+def _guild_id() -> int:
+    """Guild from the ?guild_id= query parameter; 0 is the shared library"""
+    return request.args.get('guild_id', 0, type=int)
+
+def _json(body: bytes, status: int = 200) -> Response:
+    """Response for JSON already encoded by codec"""
+    return Response(body, status=status, mimetype='application/json')
+
 @app.route('/')
 def index():
     """Render main page"""
     try:
-        playlists = db.get_all_playlists()
+        guild_id = _guild_id()
+        state = _playlist_manager.snapshot(guild_id)
+        playlists = _playlist_manager.get_playlist_summaries(guild_id)
         current_playlist = None
-        current_track = None
         
         # Get current playlist if one is set
-        if _playlist_manager.current_playlist:
-            current_playlist = db.get_playlist(_playlist_manager.current_playlist)
-            
-        # Get current track if playing
-        current_track = _playlist_manager.get_current_track()
+        if state.playlist:
+            current_playlist = _playlist_manager.get_playlist(state.playlist, state.playlist_guild_id)
         
         return render_template(
             'dashboard.html',  
             playlists=playlists,
             current_playlist=current_playlist,
-            current_track=current_track,
-            is_playing=_playlist_manager.is_playing,
-            is_paused=_playlist_manager.is_paused,
-            volume=_playlist_manager.volume,
-            repeat_mode=_playlist_manager.repeat_mode
+            current_track=state.current_track,
+            is_playing=state.is_playing,
+            is_paused=state.is_paused,
+            volume=state.volume,
+            repeat_mode=state.repeat_mode
         )
     except Exception as e:
         logger.error(f"Error rendering index: {e}")
@@ -90,21 +119,21 @@ def dashboard(session_id: str):
             _active_sessions[session_id]['last_active'] = datetime.now()
             
         # Get playlists
-        playlists = _playlist_manager.get_all_playlists()
+        guild_id = _guild_id()
+        playlists = _playlist_manager.get_playlist_summaries(guild_id)
         
         # Get current state
-        current_playlist = _playlist_manager.current_playlist
-        current_track = _playlist_manager.get_current_track()
+        state = _playlist_manager.snapshot(guild_id)
         
         return render_template(
             'dashboard.html',
             playlists=playlists,
-            current_playlist=current_playlist,
-            current_track=current_track,
-            is_playing=_playlist_manager.is_playing,
-            is_paused=_playlist_manager.is_paused,
-            volume=_playlist_manager.volume,
-            repeat_mode=_playlist_manager.repeat_mode,
+            current_playlist=state.playlist,
+            current_track=state.current_track,
+            is_playing=state.is_playing,
+            is_paused=state.is_paused,
+            volume=state.volume,
+            repeat_mode=state.repeat_mode,
             session_id=session_id
         )
     except Exception as e:
@@ -113,87 +142,180 @@ def dashboard(session_id: str):
 
 @app.route('/api/playlists', methods=['GET'])
 def get_playlists():
-    """Get all playlists"""
+    """Get the playlists a guild sees (?guild_id=, default the shared library)"""
     try:
-        playlists = db.get_all_playlists()
-        return jsonify([{
-            'name': p.name,
-            'type': getattr(p, 'type', 'local'),  
-            'description': getattr(p, 'description', ''),  
-            'track_count': len(p.tracks),
-            'created_at': p.created_at.isoformat() if p.created_at else None,
-            'modified_at': p.modified_at.isoformat() if p.modified_at else None
-        } for p in playlists])
+        playlists = _playlist_manager.get_playlist_summaries(_guild_id())
+        return _json(codec.dumps([p.to_dict() for p in playlists]))
     except Exception as e:
         logger.error(f"Error getting playlists: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/playlists/<name>', methods=['GET'])
 def get_playlist(name: str):
-    """Get a specific playlist"""
+    """Get a specific playlist
+    
+    Optional ?offset=&limit= query parameters return one page of tracks,
+    and ?guild_id= looks the name up as that guild sees it.
+    """
     try:
-        playlist = db.get_playlist(name)
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        playlist = _playlist_manager.get_playlist(name, _guild_id())
         if not playlist:
             return jsonify({'error': 'Playlist not found'}), 404
         
-        return jsonify({
-            'name': playlist.name,
-            'type': getattr(playlist, 'type', 'local'),  
-            'description': getattr(playlist, 'description', ''),  
-            'tracks': [{
-                'title': t.title,
-                'artist': t.artist,
-                'url': t.url,
-                'type': getattr(t, 'type', 'local'),  
-                'duration': getattr(t, 'duration', 0),  
-                'thumbnail_url': getattr(t, 'thumbnail_url', '')  
-            } for t in playlist.tracks],
-            'created_at': playlist.created_at.isoformat() if playlist.created_at else None,
-            'modified_at': playlist.modified_at.isoformat() if playlist.modified_at else None
-        })
+        key = (_guild_id(), name, offset, limit)
+        cached = _playlist_pages.get(key)
+        if cached is not None and cached[0] is playlist:
+            return _json(cached[1])
+        body = codec.encode_playlist(playlist, offset, limit)
+        with _playlist_pages_lock:
+            _playlist_pages.pop(key, None)
+            _playlist_pages[key] = (playlist, body)
+            while len(_playlist_pages) > _PLAYLIST_PAGES_MAX:
+                del _playlist_pages[next(iter(_playlist_pages))]
+        return _json(body)
     except Exception as e:
         logger.error(f"Error getting playlist: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/playlists/<name>/tracks', methods=['GET'])
+def list_playlist_tracks(name: str):
+    """List a playlist's tracks from its column view, without loading Track objects
+
+    Optional ?type=, ?min_duration=, ?max_duration= and ?min_plays= filter
+    the tracks; ?offset=&limit= (default 0 and 100) page the result. Totals
+    cover all matching tracks.
+    """
+    try:
+        columns = _playlist_manager.get_playlist_columns(name, _guild_id())
+        if columns is None:
+            return jsonify({'error': 'Playlist not found'}), 404
+
+        matching = columns.filter(
+            type=request.args.get('type'),
+            min_duration=request.args.get('min_duration', type=int),
+            max_duration=request.args.get('max_duration', type=int),
+            min_plays=request.args.get('min_plays', type=int))
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', TRACKS_PAGE_SIZE, type=int), 0), 1000)
+        return _json(codec.dumps({
+            'name': name,
+            'track_count': len(matching),
+            'total_duration': matching.total_duration(),
+            'types': matching.type_counts(),
+            'offset': offset,
+            'tracks': matching[offset:offset + limit].to_dicts()
+        }))
+    except Exception as e:
+        logger.error(f"Error listing playlist tracks: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/search', methods=['GET'])
+def search_tracks():
+    """Search tracks by title or artist"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'error': 'Missing search query'}), 400
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        
+        guild_id = request.args.get('guild_id', type=int)
+        results = _playlist_manager.search_tracks(query, limit, guild_id)
+        return _json(codec.dumps([r.to_dict() for r in results]))
+    except Exception as e:
+        logger.error(f"Error searching tracks: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Play totals, top tracks and a timeline from the play history rollups
+    
+    Optional ?guild_id= limits to one server; ?days= (default 7) sets the
+    range, which is rounded down to whole hours or days.
+    """
+    try:
+        guild_id = request.args.get('guild_id', type=int)
+        days = min(max(request.args.get('days', 7, type=float), 1 / 24), 3650)
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        since = datetime.now() - timedelta(days=days)
+        # A sharded guild's history is in its own file; all-guild stats cover the main one
+        source = db if guild_id is None else Database.for_guild(guild_id)
+        
+        return _json(codec.dumps({
+            'guild_id': guild_id,
+            'since': since.isoformat(),
+            'totals': source.get_play_totals(guild_id, since),
+            'top_tracks': [t.to_dict() for t in source.get_top_tracks(guild_id, since, limit)],
+            'timeline': source.get_play_timeline(guild_id, since)
+        }))
+    except Exception as e:
+        logger.error(f"Error getting stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    """Get playlist cache hit/miss counters"""
+    try:
+        return jsonify(_playlist_manager.cache_stats())
+    except Exception as e:
+        logger.error(f"Error getting cache stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/playlists/<playlist_name>/play', methods=['POST'])
 def play_playlist(playlist_name: str):
-    """Start playing a playlist"""
+    """Start playing a playlist
+    
+    Returns the first TRACKS_PAGE_SIZE tracks and the track count; the
+    client pages through the rest with /api/playlists/<name>/tracks.
+    """
     try:
-        playlist = db.get_playlist(playlist_name)
-        if not playlist:
+        guild_id = _guild_id()
+        if not _playlist_manager.set_current_playlist(playlist_name, guild_id):
             return jsonify({'error': 'Playlist not found'}), 404
             
-        # Load the playlist and its tracks
-        _playlist_manager.set_current_playlist(playlist_name)
-        _playlist_manager.set_playing(True)
+        _playlist_manager.set_playing(True, guild_id)
         
         # Get the current track info
-        current_track = _playlist_manager.get_current_track()
+        current_track = _playlist_manager.get_current_track(guild_id)
+        tracks = _playlist_manager.get_tracks(playlist_name, 0, TRACKS_PAGE_SIZE, guild_id)
         
-        return jsonify({
+        return _json(codec.dumps({
             'status': 'success',
             'playlist': playlist_name,
-            'current_track': {
-                'title': current_track.title,
-                'artist': current_track.artist,
-                'url': current_track.url,
-                'type': getattr(current_track, 'type', 'local'),  
-                'duration': getattr(current_track, 'duration', 0),  
-                'thumbnail_url': getattr(current_track, 'thumbnail_url', '')  
-            } if current_track else None,
-            'tracks': [{
-                'title': t.title,
-                'artist': t.artist,
-                'url': t.url,
-                'type': getattr(t, 'type', 'local'),  
-                'duration': getattr(t, 'duration', 0),  
-                'thumbnail_url': getattr(t, 'thumbnail_url', '')  
-            } for t in playlist.tracks] if playlist.tracks else []
-        })
+            'current_track': current_track.to_dict() if current_track else None,
+            'track_count': _playlist_manager.get_track_count(playlist_name, guild_id),
+            'tracks': [t.to_dict() for t in tracks]
+        }))
     except Exception as e:
         logger.error(f"Error playing playlist: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/playlists/smart', methods=['POST'])
+def create_smart_playlist():
+    """Create a smart playlist: {"name", "rule" or "preset", optional "description"}"""
+    try:
+        name = (request.json.get('name') or '').strip()
+        if not name:
+            return jsonify({'error': 'Missing name'}), 400
+        preset = request.json.get('preset')
+        if preset is not None and preset not in SMART_PRESETS:
+            return jsonify({'error': f'Unknown preset: {preset}'}), 400
+        try:
+            rule = SmartRule.from_dict(SMART_PRESETS[preset] if preset is not None else request.json.get('rule'))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid rule: {e}'}), 400
+            
+        playlist = _playlist_manager.create_smart_playlist(
+            name, rule, request.json.get('description') or '', _guild_id())
+        if playlist is None:
+            return jsonify({'error': 'Playlist already exists'}), 409
+        return jsonify({'status': 'success', 'name': name, 'track_count': len(playlist.tracks),
+                        'rule': rule.to_dict()})
+    except Exception as e:
+        logger.error(f"Error creating smart playlist: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/playlists/<name>/delete', methods=['POST'])
 def delete_playlist(name: str):
     """Delete a playlist"""
@@ -203,7 +325,7 @@ def delete_playlist(name: str):
         if not admin_password or admin_password != os.getenv('ADMIN_PASSWORD'):
             return jsonify({'error': 'Invalid admin password'}), 403
             
-        if _playlist_manager.delete_playlist(name):
+        if _playlist_manager.delete_playlist(name, _guild_id()):
             return jsonify({'status': 'success'})
         else:
             return jsonify({'error': 'Playlist not found'}), 404
@@ -213,56 +335,85 @@ def delete_playlist(name: str):
 
 @app.route('/api/player/state', methods=['GET'])
 def get_player_state():
-    """Get current player state"""
-    global _last_state, _last_state_time
-    
+    """Get a guild's current player state"""
     try:
-        current_time = time.time()
+        guild_id = _guild_id()
+        
+        # One consistent snapshot, even while the bot is changing tracks
+        playback = _playlist_manager.snapshot(guild_id)
         
-        # Return cached state if it's fresh enough
-        if _last_state and (current_time - _last_state_time) < _STATE_CACHE_TIME:
-            return jsonify(_last_state)
+        # Return cached state if nothing changed since
+        key = _state_key(playback)
+        cached = _last_states.get(guild_id)
+        if cached is not None and cached[0] == key:
+            return _json(cached[1])
         
-        current_track = _playlist_manager.get_current_track()
+        current_track = playback.current_track
         current_playlist = None
-        if _playlist_manager.current_playlist:
-            current_playlist = db.get_playlist(_playlist_manager.current_playlist)
+        if playback.playlist:
+            # Metadata and track count only; no tracks are loaded
+            current_playlist = _playlist_manager.get_playlist(playback.playlist, playback.playlist_guild_id)
         
-        state = {
-            'is_playing': _playlist_manager.is_playing,
-            'is_paused': _playlist_manager.is_paused,
-            'volume': _playlist_manager.volume,
-            'repeat_mode': _playlist_manager.repeat_mode,
+        state = codec.dumps({
+            'guild_id': guild_id,
+            'version': playback.version,
+            'is_playing': playback.is_playing,
+            'is_paused': playback.is_paused,
+            'volume': playback.volume,
+            'repeat_mode': playback.repeat_mode,
+            'shuffle_mode': playback.shuffle_mode,
             'current_playlist': {
                 'name': current_playlist.name,
                 'type': getattr(current_playlist, 'type', 'local'),  
                 'track_count': len(current_playlist.tracks)
             } if current_playlist else None,
-            'current_track': {
-                'title': current_track.title,
-                'artist': current_track.artist,
-                'url': current_track.url,
-                'type': getattr(current_track, 'type', 'local'),  
-                'duration': getattr(current_track, 'duration', 0),  
-                'thumbnail_url': getattr(current_track, 'thumbnail_url', '')  
-            } if current_track else None
-        }
+            'current_track': current_track.to_dict() if current_track else None
+        })
         
-        # Cache the state
-        _last_state = state
-        _last_state_time = current_time
+        # Cache the state, unless a playlist was edited while it was read
+        if _state_key(playback) == key:
+            _last_states[guild_id] = (key, state)
         
-        return jsonify(state)
+        return _json(state)
     except Exception as e:
         logger.error(f"Error getting player state: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/player/events', methods=['GET'])
+def player_events():
+    """Server-sent events stream of a guild's player state changes"""
+    guild_id = _guild_id()
+    events = queue.Queue(maxsize=100)
+    
+    def handler(event: PlaybackEvent) -> None:
+        if event.guild_id == guild_id:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass  # Client isn't reading; it re-fetches the state anyway
+    
+    unsubscribe = _playlist_manager.events.subscribe(handler)
+    
+    def stream():
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=_EVENT_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event.type}\ndata: {json.dumps(event.to_dict())}\n\n"
+        finally:
+            unsubscribe()
+    
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/api/player/play', methods=['POST'])
 def play():
     """Resume playback"""
     try:
-        _playlist_manager.set_paused(False)
-        _playlist_manager.set_playing(True)
+        # Also clears paused
+        _playlist_manager.set_playing(True, _guild_id())
         return jsonify({'status': 'success'})
     except Exception as e:
         logger.error(f"Error playing: {e}")
@@ -272,8 +423,8 @@ def play():
 def pause():
     """Pause playback"""
     try:
-        _playlist_manager.set_playing(False)
-        _playlist_manager.set_paused(True)
+        # Also clears playing
+        _playlist_manager.set_paused(True, _guild_id())
         return jsonify({'status': 'success'})
     except Exception as e:
         logger.error(f"Error pausing: {e}")
@@ -283,9 +434,10 @@ def pause():
 def next_track():
     """Skip to next track"""
     try:
-        track = _playlist_manager.next_track()
+        guild_id = _guild_id()
+        track = _playlist_manager.next_track(guild_id)
         if track:
-            _playlist_manager.set_playing(True)  # Ensure we're playing
+            _playlist_manager.set_playing(True, guild_id)  # Ensure we're playing
             return jsonify({
                 'status': 'success',
                 'track': {
@@ -296,7 +448,7 @@ def next_track():
                 }
             })
         else:
-            _playlist_manager.set_playing(False)  # Stop if no next track
+            _playlist_manager.set_playing(False, guild_id)  # Stop if no next track
             return jsonify({'status': 'end'})
     except Exception as e:
         logger.error(f"Error skipping track: {e}", exc_info=True)
@@ -306,7 +458,7 @@ def next_track():
 def previous_track():
     """Go to previous track"""
     try:
-        track = _playlist_manager.previous_track()
+        track = _playlist_manager.previous_track(_guild_id())
         return jsonify({
             'status': 'success',
             'current_track': {
@@ -327,7 +479,7 @@ def set_volume():
     """Set player volume"""
     try:
         volume = request.json.get('volume', 100)
-        _playlist_manager.set_volume(volume)
+        _playlist_manager.set_volume(volume, _guild_id())
         return jsonify({'status': 'success', 'volume': volume})
     except Exception as e:
         logger.error(f"Error setting volume: {e}")
@@ -338,12 +490,77 @@ def set_repeat():
     """Set repeat mode"""
     try:
         mode = request.json.get('mode', 'none')
-        _playlist_manager.set_repeat_mode(mode)
+        _playlist_manager.set_repeat_mode(mode, _guild_id())
         return jsonify({'status': 'success', 'repeat_mode': mode})
     except Exception as e:
         logger.error(f"Error setting repeat mode: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/player/shuffle', methods=['POST'])
+def set_shuffle():
+    """Set shuffle mode (off, on, weighted)"""
+    try:
+        mode = request.json.get('mode', 'on')
+        if not _playlist_manager.set_shuffle(mode, _guild_id()):
+            return jsonify({'error': f'Invalid shuffle mode: {mode}'}), 400
+        return jsonify({'status': 'success', 'shuffle_mode': mode})
+    except Exception as e:
+        logger.error(f"Error setting shuffle mode: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/queue', methods=['GET'])
+def get_queue():
+    """One page of a guild's queue (?offset=&limit=)"""
+    try:
+        guild_id = _guild_id()
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 50, type=int), 0), 500)
+        return _json(codec.dumps({
+            'length': _playlist_manager.queue_length(guild_id),
+            'offset': offset,
+            'tracks': [t.to_dict() for t in _playlist_manager.get_queue(guild_id, offset, limit)]
+        }))
+    except Exception as e:
+        logger.error(f"Error getting queue: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/queue', methods=['POST'])
+def add_to_queue():
+    """Queue a link: {"url", optional "title", "front"}"""
+    try:
+        url = (request.json.get('url') or '').strip()
+        if not url:
+            return jsonify({'error': 'Missing url'}), 400
+        track = Track(title=request.json.get('title') or url, url=url, type=guess_track_type(url))
+        position = _playlist_manager.enqueue(track, _guild_id(), bool(request.json.get('front')))
+        if position is None:
+            return jsonify({'error': 'Queue is full'}), 409
+        return jsonify({'status': 'success', 'position': position})
+    except Exception as e:
+        logger.error(f"Error adding to queue: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/queue/<int:index>', methods=['DELETE'])
+def remove_from_queue(index: int):
+    """Remove the track at a 0-based queue position"""
+    try:
+        track = _playlist_manager.remove_from_queue(index, _guild_id())
+        if track is None:
+            return jsonify({'error': 'No such queue position'}), 404
+        return jsonify({'status': 'success', 'track': track.to_dict()})
+    except Exception as e:
+        logger.error(f"Error removing from queue: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/queue/clear', methods=['POST'])
+def clear_queue():
+    """Empty a guild's queue"""
+    try:
+        return jsonify({'status': 'success', 'removed': _playlist_manager.clear_queue(_guild_id())})
+    except Exception as e:
+        logger.error(f"Error clearing queue: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/sessions/<session_id>/validate', methods=['POST'])
 def validate_session(session_id: str):
     """Validate a session"""